@@ -6,22 +6,44 @@ import copy
 import random
 import json
 from datetime import datetime, timedelta
-from multiprocessing import Pool, cpu_count
+import threading
+from multiprocessing import Pool, Lock, cpu_count
 from decimal import Decimal
 import logging
 
+import numpy as np
+
 #sys.path.append(os.path.expanduser("/data3/dzh/project/grep/dev"))
 
-from mcts.mcts import Node, State
+from mcts.mcts import Node, State, backpropagate_path, set_expansion_policy
+from mcts.reward_cache import RewardCache
+from mcts.compact_state import CompactState, ConfigSchema
+from mcts.shared_tree import SharedNodeStats, SharedStatsNode
+from mcts.transposition import TranspositionTable
+from mcts.anytime import SearchBudget, BestConfiguration
+from mcts.checkpoint import save_checkpoint, load_checkpoint
+from mcts.rollout import RandomRollout, make_rollout_policy
+from mcts.action_pruning import ActionPruning
+from mcts.tracing import tracer, DEBUG, INFO
 from estimator.operators import *
 from estimator.ch_query_params import *
 from estimator.ch_partition_meta import *
 from estimator.ch_query_card import *
 from estimator.ch_query_cost import *
 from estimator.ch_columns_ranges_meta import *
+from estimator.statistics_catalog import load_statistics_catalog, get_statistics_catalog
+from estimator.plan_cache import set_plan_cache_path, set_plan_layout
+from estimator.table_meta_store import get_table_meta_store, TableMetaView, build_table_meta, build_table_columns, writable_table_meta
 from config import Config
 from log.logging_config import setup_logging
-from workload.workload_analyzer import get_normalized_column_usage, tp_column_usage
+from workload.workload_analyzer import get_normalized_column_usage, WorkloadProfile, get_workload_rates, load_workload_rates
+
+# calculate_reward的缓存, 在__main__中初始化, 为None时不使用缓存
+reward_cache = None
+# 增量reward计算, 在__main__中初始化, 为None时每次完整计算calculate_reward
+incremental_evaluator = None
+# rollout策略(mcts/rollout.py), 为None时使用原来的均匀随机策略
+rollout_policy = None
 
 # update metadata given the partition and replica candidate
 # candidate format:{'name': , 'columns':, 'partitionable_columns': , 'partition_keys': [], 'replicas': [], 'replica_partition_keys': []}
@@ -57,57 +79,82 @@ def update_meta(table_columns, table_meta, candidates):
             #     print('minmaxvalue type: ', type(minmaxvalues[0][1]))
 
             # get tables keys ranges 划定每个分区的范围, 支持多个列
-            # [[],[]] table_ranges[i]:第i个分区键的范围列表，默认分成4份
+            # [[],[]] table_ranges[i]:第i个分区键的范围列表, 分区数由get_partition_count配置, 默认分成4份
+            # [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, 用来由keys_partition_cnt估计分区行数
+            partition_count = get_partition_count(table_name)
+            catalog = get_statistics_catalog()
+            use_catalog = get_partition_strategy() == 'equi-depth' and catalog is not None and all(catalog.has_column(table_name, key) for key in partition_keys)
             table_ranges = [] 
+            fractions = []
             #print(minmaxvalues)
-            for minmaxvalue in minmaxvalues:
-                try:
-                    # 检查是否为整数类型
-                    if isinstance(minmaxvalue[0], int) and isinstance(minmaxvalue[1], int):
-                        min_val = minmaxvalue[0]
-                        max_val = minmaxvalue[1]
-                        # 对于整型，直接均匀分成四份
-                        step = (max_val - min_val) / 4
-                        table_ranges.append([min_val + i * step for i in range(1, 5)])
-                    # 检查是否为字符串类型并尝试转换为整数
-                    elif isinstance(minmaxvalue[0], str) and isinstance(minmaxvalue[1], str):
-                        min_val = int(minmaxvalue[0])
-                        max_val = int(minmaxvalue[1])
-                        # 对于整型，直接均匀分成四份
-                        step = (max_val - min_val) / 4
-                        table_ranges.append([min_val + i * step for i in range(1, 5)])
-                    # 检查是否为Decimal类型
-                    elif isinstance(minmaxvalue[0], Decimal) and isinstance(minmaxvalue[1], Decimal):
-                        min_val = minmaxvalue[0]
-                        max_val = minmaxvalue[1]
-                        # 对于Decimal类型，直接均匀分成四份
-                        step = (max_val - min_val) / 4
-                        table_ranges.append([min_val + i * step for i in range(1, 5)])                    
-                    else:
-                        raise ValueError("Unsupported type for partition keys")
-                except ValueError:
-                    try:
-                        # 检查是否为datetime类型
-                        if isinstance(minmaxvalue[0], datetime) and isinstance(minmaxvalue[1], datetime):
-                            min_val = minmaxvalue[0]
-                            max_val = minmaxvalue[1]
-                        else:
-                            # 尝试将字符串转换为datetime
-                            min_val = datetime.strptime(minmaxvalue[0], '%Y-%m-%d %H:%M:%S')
-                            max_val = datetime.strptime(minmaxvalue[1], '%Y-%m-%d %H:%M:%S')
-                        # 对于datetime类型，根据天均匀分成四份
-                        total_days = (max_val - min_val).days
-                        step = total_days / 4
-                        table_ranges.append([min_val + timedelta(days=i * step) for i in range(1, 5)])
-                    except ValueError:
-                        raise ValueError(f"Unsupported type for partition keys: {minmaxvalue}")
+            for key, minmaxvalue in zip(partition_keys, minmaxvalues):
+                if use_catalog:
+                    # 等深边界直接由统计目录的直方图得到, 分区行数也由统计目录估计
+                    table_ranges.append(catalog_key_ranges(catalog, table_name, key, minmaxvalue, partition_count))
+                    fractions.append(None)
+                elif get_partition_strategy() == 'equi-depth' and key in table_meta[idx].keys_partition_cnt:
+                    key_fractions = equi_depth_fractions(table_meta[idx].keys_partition_cnt[key], partition_count)
+                    table_ranges.append(key_partition_ranges(minmaxvalue, partition_count, key_fractions))
+                    fractions.append(key_fractions)
+                else:
+                    table_ranges.append(key_partition_ranges(minmaxvalue, partition_count))
+                    fractions.append([i / partition_count for i in range(1, partition_count + 1)])
 
             if i == 0: 
                 # 更新meta类的分区元信息
-                table_meta[idx].update_partition_metadata(partition_keys, table_ranges)
+                writable_table_meta(table_meta, idx).update_partition_metadata(partition_keys, table_ranges, fractions)
             elif i==1:
                 # 更新replica_meta类的分区元信息
-                table_meta[idx + 12].update_partition_metadata(partition_keys, table_ranges)
+                writable_table_meta(table_meta, idx + 12).update_partition_metadata(partition_keys, table_ranges, fractions)
+
+# 分区键的最小最大值
+def key_min_max(minmaxvalue):
+    # 检查是否为整数类型
+    if isinstance(minmaxvalue[0], int) and isinstance(minmaxvalue[1], int):
+        return minmaxvalue[0], minmaxvalue[1]
+    # 检查是否为字符串类型并尝试转换为整数
+    elif isinstance(minmaxvalue[0], str) and isinstance(minmaxvalue[1], str):
+        try:
+            return int(minmaxvalue[0]), int(minmaxvalue[1])
+        except ValueError:
+            # 尝试将字符串转换为datetime
+            try:
+                return datetime.strptime(minmaxvalue[0], '%Y-%m-%d %H:%M:%S'), datetime.strptime(minmaxvalue[1], '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                raise ValueError(f"Unsupported type for partition keys: {minmaxvalue}")
+    # 检查是否为Decimal类型或datetime类型
+    elif isinstance(minmaxvalue[0], (Decimal, datetime)) and isinstance(minmaxvalue[1], (Decimal, datetime)):
+        return minmaxvalue[0], minmaxvalue[1]
+    raise ValueError(f"Unsupported type for partition keys: {minmaxvalue}")
+
+# 一个分区键每个分区的上界
+# fractions为None时均匀分成partition_count份; 否则按fractions(0~1)在[min, max]中的位置划分
+def key_partition_ranges(minmaxvalue, partition_count, fractions=None):
+    min_val, max_val = key_min_max(minmaxvalue)
+    if isinstance(min_val, datetime):
+        # 对于datetime类型，根据天划分
+        total_days = (max_val - min_val).days
+        if fractions is None:
+            step = total_days / partition_count
+            return [min_val + timedelta(days=i * step) for i in range(1, partition_count + 1)]
+        return [min_val + timedelta(days=fraction * total_days) for fraction in fractions]
+    if fractions is None:
+        # 对于整型和Decimal类型，直接均匀划分
+        step = (max_val - min_val) / partition_count
+        return [min_val + i * step for i in range(1, partition_count + 1)]
+    if isinstance(min_val, Decimal):
+        return [min_val + Decimal(repr(fraction)) * (max_val - min_val) for fraction in fractions]
+    return [min_val + fraction * (max_val - min_val) for fraction in fractions]
+
+# 统计目录中的等深边界, 转换成分区键的类型
+def catalog_key_ranges(catalog, table_name, key, minmaxvalue, partition_count):
+    min_val, _ = key_min_max(minmaxvalue)
+    bounds = catalog.equi_depth_bounds(table_name, key, partition_count)
+    if isinstance(min_val, datetime):
+        return [datetime.fromtimestamp(bound) for bound in bounds]
+    if isinstance(min_val, Decimal):
+        return [Decimal(repr(bound)) for bound in bounds]
+    return bounds
 
 
 # 更新每个Qcard类的rowSize
@@ -253,17 +300,21 @@ def update_rowsize(table_columns, candidates):
 
 # 计算候选的reward
 # candidates是每个表的分区和副本设置
-def calculate_reward(table_columns, table_meta, candidates, timing_dict=None):
+def calculate_reward(table_columns, table_meta, candidates, timing_dict=None, reward_cache=None):
     # timing_dict: 用于记录各部分耗时
+    # reward_cache: 已经评估过的配置直接返回缓存的reward
+    if reward_cache is not None:
+        cached_reward = reward_cache.get(candidates)
+        if cached_reward is not None:
+            return cached_reward
+
     if timing_dict is not None:
         t0 = time.perf_counter()
     # 根据分区副本情况更新元数据    
     if timing_dict is not None:
         t_update_meta_start = time.perf_counter()
     
-    logging.info("Start Update meta data")
     update_meta(table_columns, table_meta, candidates)
-    logging.info("Finish Update meta data")
 
     if timing_dict is not None:
         t_update_meta_end = time.perf_counter()
@@ -274,7 +325,6 @@ def calculate_reward(table_columns, table_meta, candidates, timing_dict=None):
         t_update_rowsize_start = time.perf_counter()
 
     qcard_list = update_rowsize(table_columns, candidates)
-    logging.info("Finish Update rowsize")    
 
     if timing_dict is not None:
         t_update_rowsize_end = time.perf_counter()
@@ -284,7 +334,6 @@ def calculate_reward(table_columns, table_meta, candidates, timing_dict=None):
     if timing_dict is not None:
         t_get_qcard_start = time.perf_counter()
     get_qcard(table_meta, qcard_list, candidates)
-    logging.info("Finish Get Qcard")
 
     if timing_dict is not None:
         t_get_qcard_end = time.perf_counter()
@@ -302,12 +351,17 @@ def calculate_reward(table_columns, table_meta, candidates, timing_dict=None):
     engine = 'Tiflash'
     
     reward = 0.0
-    # 计算22条query的代价
+    # 计算22条query的代价, 按每条query的到达率加权(默认等权, 权重都是1)
+    query_weights = get_workload_rates().query_weights()
+    query_costs = [] if tracer.debug_active else None
     for i in range(0,22):
         cost = 0
         cost = calculate_query_cost(i, qparams_list)
-        reward += cost
-        logging.info(f"Query{i+1}: {cost}")
+        reward += query_weights[i] * cost
+        if query_costs is not None:
+            query_costs.append(cost)
+    if query_costs is not None:
+        tracer.emit(DEBUG, 'query_costs', costs=query_costs)
 
     # reward += calculate_q1(engine, qparams_list[0])
     # reward += calculate_q2(engine, qparams_list[1])
@@ -348,59 +402,294 @@ def calculate_reward(table_columns, table_meta, candidates, timing_dict=None):
     removed_replcas_reward = 0
     columns_size = 0
     for candidate in candidates:
-        table_name = candidate['name']
-        replicas = candidate['replicas']
-        table_column = next((tc for tc in table_columns if tc.name == table_name), None)
-
-        if table_name not in tp_column_usage:
-            continue
-
-        if table_column:
-            missing_columns = set(table_column.columns) - set(replicas)
-            for missing_column in missing_columns:  # usage * size
-                if missing_column in tp_column_usage[table_name]:
-                    tp_usage = tp_column_usage[table_name][missing_column]
-                    column_size = table_column.columns_size[table_column.columns.index(missing_column)]
-                    removed_replcas_reward += column_size * tp_usage
-
-            missing_columns_size = sum(table_column.columns_size[table_column.columns.index(col)] for col in missing_columns)
-            columns_size += missing_columns_size
-            # logging.info(f"Table: {table_name}, Missing Columns: {missing_columns}, Total Size: {missing_columns_size}")
-    logging.info(f"Total Missing Column Size: {columns_size}")
-    logging.info(f"Total Removed Replica Reward: {removed_replcas_reward}")
+        table_reward, missing_columns_size = calculate_removed_replica_reward(table_columns, candidate)
+        removed_replcas_reward += table_reward
+        columns_size += missing_columns_size
+    if tracer.active:
+        tracer.emit(INFO, 'removed_replicas', columns_size=columns_size, reward=removed_replcas_reward)
     reward += (removed_replcas_reward)
 
+    if reward_cache is not None:
+        reward_cache.put(candidates, reward)
+
     return reward    
 
+# 单个表移除replica列带来的reward: 移除列的size * tp_column_usage频率
+# tp_column_usage按事务的执行率加权, 见workload_analyzer.WorkloadRates
+# 返回(reward, 移除列的总size)
+def calculate_removed_replica_reward(table_columns, candidate):
+    tp_column_usage = get_workload_rates().tp_column_usage()
+    table_name = candidate['name']
+    replicas = candidate['replicas']
+    table_column = next((tc for tc in table_columns if tc.name == table_name), None)
+
+    if table_name not in tp_column_usage or not table_column:
+        return 0, 0
+
+    removed_replcas_reward = 0
+    missing_columns = set(table_column.columns) - set(replicas)
+    for missing_column in missing_columns:  # usage * size
+        if missing_column in tp_column_usage[table_name]:
+            tp_usage = tp_column_usage[table_name][missing_column]
+            column_size = table_column.columns_size[table_column.columns.index(missing_column)]
+            removed_replcas_reward += column_size * tp_usage
+
+    missing_columns_size = sum(table_column.columns_size[table_column.columns.index(col)] for col in missing_columns)
+    # logging.info(f"Table: {table_name}, Missing Columns: {missing_columns}, Total Size: {missing_columns_size}")
+    return removed_replcas_reward, missing_columns_size
+
+
+# 单独计算第qry_idx条query的代价, table_meta需要已经按照candidates更新过分区元数据
+def calculate_single_query_cost(qry_idx, table_columns, table_meta, candidates):
+    qcard = qcard_classes[qry_idx]()
+    qcard.init()
+    qcard.update_table_rowsize(table_columns, candidates)
+    qcard.get_query_card(table_meta, candidates)
+    # calculate_query_cost只访问qparams_list[qry_idx]
+    qparams_list = {qry_idx: qcard_to_qparams(qry_idx, qcard)}
+    return calculate_query_cost(qry_idx, qparams_list)
+
+
+# 批量计算多个候选配置每条query的代价, 返回 N×22 的NumPy数组
+# 每个配置仍然单独更新元数据和Qcard, 22条query的代价用NumPy对所有配置一起计算
+def calculate_query_costs_matrix(table_columns, candidates_list):
+    params_batch = QueryParamsBatch(len(candidates_list))
+    batch_table_meta = get_table_meta_store().new_view()
+    for row, candidates in enumerate(candidates_list):
+        reset_table_meta(batch_table_meta)
+        update_meta(table_columns, batch_table_meta, candidates)
+        qcard_list = update_rowsize(table_columns, candidates)
+        get_qcard(batch_table_meta, qcard_list, candidates)
+        params_batch.set_row(row, update_qparams_with_qcard(qcard_list))
+    return calculate_query_costs_batch(params_batch)
+
+# 批量计算多个候选配置按query权重加权的代价(归一化之前, 不含移除replica的reward), 返回NumPy数组
+def calculate_workload_costs_batch(table_columns, candidates_list):
+    query_weights = np.array(get_workload_rates().query_weights())
+    return (calculate_query_costs_matrix(table_columns, candidates_list) * query_weights).sum(axis=1)
+
+# 批量计算多个候选配置的reward, 返回和candidates_list顺序一致的reward列表
+# 每个配置仍然单独更新元数据和Qcard, 22条query的代价用NumPy对所有配置一起计算
+def calculate_rewards_batch(table_columns, candidates_list, reward_cache=None):
+    rewards = [None] * len(candidates_list)
+    pending = []
+    for i, candidates in enumerate(candidates_list):
+        if reward_cache is not None:
+            rewards[i] = reward_cache.get(candidates)
+        if rewards[i] is None:
+            pending.append(i)
+    if not pending:
+        return rewards
+
+    removed_replica_rewards = np.zeros(len(pending))
+    for row, i in enumerate(pending):
+        for candidate in candidates_list[i]:
+            table_reward, _ = calculate_removed_replica_reward(table_columns, candidate)
+            removed_replica_rewards[row] += table_reward
+
+    costs = calculate_workload_costs_batch(table_columns, [candidates_list[i] for i in pending])
+    batch_rewards = normalize_reward(costs) + removed_replica_rewards
+    for row, i in enumerate(pending):
+        rewards[i] = float(batch_rewards[row])
+        if reward_cache is not None:
+            reward_cache.put(candidates_list[i], rewards[i])
+    return rewards
+
+
+# 每条query的代价依赖的表: query_operators里的tables
+# 'plan'模型下再加上计划树扫描的表(包括CTE), 例如Q20的计划扫描stock, Q22的计划扫描orders, query_operators中没有
+def query_dependency_tables():
+    query_tables = [set(query_info['tables']) for query_info in query_operators]
+    if get_query_cost_model() == 'plan':
+        plan_model = get_plan_cost_model()
+        for qry_idx, tables in enumerate(query_tables):
+            if plan_model.has_plan(qry_idx):
+                tables |= plan_model.query_tables(qry_idx)
+    return query_tables
+
+
+## 增量计算reward
+## 一次MCTS action只修改一个表, 只需要重新计算涉及这个表的query
+## 维护上一次评估的配置, 每个表的元数据, 每条query的代价和每个表移除replica的reward
+## 新配置和上一次评估的配置比较, 只更新发生变化的表的元数据, 只重新计算读取这些表的query(query_dependency_tables)
+## 每条query依赖的表在创建时按当前的代价模型确定, 切换代价模型后需要重新创建
+class IncrementalRewardEvaluator:
+    def __init__(self, table_columns):
+        self.table_columns = table_columns
+        self.table_meta = get_table_meta_store().new_view()
+        self.table_dict = {'customer': 0, 'district': 1, 'history': 2, 'item': 3, 'nation': 4, 'new_order': 5, 'order_line': 6, 'orders': 7, 'region': 8, 'stock': 9, 'supplier': 10, 'warehouse': 11}
+
+        # 每条query读取的表
+        self.query_tables = query_dependency_tables()
+
+        self.table_configs = {} # table_name -> 上一次评估时这个表的配置
+        self.query_costs = [None] * len(query_operators)
+        self.removed_replica_rewards = {} # table_name -> 移除replica的reward
+
+        # 统计增量计算节省的query代价计算次数
+        self.evaluations = 0
+        self.recomputed_queries = 0
+
+    # 表配置的指纹, 和RewardCache一致
+    def table_config(self, candidate):
+        replicas = tuple(sorted(candidate['replicas'])) if candidate['replicas'] is not None else None
+        return (tuple(candidate['partition_keys']), replicas, tuple(candidate['replica_partition_keys']))
+
+    # 重建一个表的元数据(原表和replica): 丢弃overlay, 再按新配置更新
+    def rebuild_table_meta(self, candidate):
+        idx = self.table_dict.get(candidate['name'])
+        self.table_meta.discard(idx)
+        self.table_meta.discard(idx + 12)
+        update_meta(self.table_columns, self.table_meta, [candidate])
+
+    # 和上一次评估的配置比较, 返回配置发生变化的表
+    def changed_tables(self, candidates):
+        changed = []
+        for candidate in candidates:
+            if self.table_configs.get(candidate['name']) != self.table_config(candidate):
+                changed.append(candidate)
+        return changed
+
+    def calculate_reward(self, candidates, reward_cache=None):
+        if reward_cache is not None:
+            cached_reward = reward_cache.get(candidates)
+            if cached_reward is not None:
+                return cached_reward
+
+        changed = self.changed_tables(candidates)
+        changed_names = set()
+        for candidate in changed:
+            self.rebuild_table_meta(candidate)
+            reward, _ = calculate_removed_replica_reward(self.table_columns, candidate)
+            self.removed_replica_rewards[candidate['name']] = reward
+            self.table_configs[candidate['name']] = self.table_config(candidate)
+            changed_names.add(candidate['name'])
+
+        # 只重新计算读取了变化表的query
+        for qry_idx, tables in enumerate(self.query_tables):
+            if self.query_costs[qry_idx] is None or tables & changed_names:
+                self.query_costs[qry_idx] = calculate_single_query_cost(qry_idx, self.table_columns, self.table_meta, candidates)
+                self.recomputed_queries += 1
+        self.evaluations += 1
+
+        query_weights = get_workload_rates().query_weights()
+        reward = normalize_reward(sum(weight * cost for weight, cost in zip(query_weights, self.query_costs)))
+        reward += sum(self.removed_replica_rewards[candidate['name']] for candidate in candidates)
+
+        if reward_cache is not None:
+            reward_cache.put(candidates, reward)
+        return reward
+
+    def stats(self):
+        total = self.evaluations * len(self.query_costs)
+        return {'evaluations': self.evaluations, 'recomputed_queries': self.recomputed_queries, 'total_queries': total}
+
+
 def simulate(state, depth, max_depth=10, timing_dict=None):
-    # 随机模拟直到终止状态
+    reward, _ = simulate_state(state, depth, max_depth, timing_dict)
+    return reward
+
+# 当前reward函数下一个配置的reward, 有增量计算器时使用增量计算
+def evaluate_reward(tables, timing_dict=None):
+    if incremental_evaluator is not None:
+        return incremental_evaluator.calculate_reward(tables, reward_cache=reward_cache)
+    # 传递 timing_dict 给 calculate_reward
+    return calculate_reward(table_columns, table_meta, tables, timing_dict=timing_dict, reward_cache=reward_cache)
+
+# 模拟并返回(reward, 模拟的终止状态)
+def simulate_state(state, depth, max_depth=10, timing_dict=None):
+    t_start = time.perf_counter()
+    state_simu = rollout(state, depth, max_depth)
+    reward = evaluate_reward(state_simu.tables, timing_dict)
+    get_rollout_policy().record(time.perf_counter() - t_start, reward)
+    return reward, state_simu
+
+def set_rollout_policy(policy):
+    global rollout_policy
+    rollout_policy = policy
+
+def get_rollout_policy():
+    global rollout_policy
+    if rollout_policy is None:
+        rollout_policy = RandomRollout()
+    return rollout_policy
+
+# 按rollout策略模拟直到终止状态(或策略的最大步数), 返回终止状态
+def rollout(state, depth, max_depth=10):
     state_simu = copy.deepcopy(state)
+    policy = get_rollout_policy()
 
-    # 获取列的查询更新信息, 设置action优先级
-    qcard_list = [Q1card(), Q2card(), Q3card(), Q4card(), Q5card(), Q6card(), Q7card(), Q8card(), Q9card(), Q10card(), Q11card(), Q12card(), Q13card(), Q14card(), Q15card(), Q16card(), Q17card(), Q18card(), Q19card(), Q20card(), Q21card(), Q22card()]
-    for qcard in qcard_list:
-        qcard.init()           
-    normalized_usage, zero_values, _, _ = get_normalized_column_usage(qcard_list, tp_column_usage)    
-    
-    while depth < max_depth:
+    # 获取列的查询更新信息, 设置action优先级. profile在整个搜索中只计算一次
+    profile = state.profile
+    steps = 0
+    while depth < max_depth and (policy.max_steps is None or steps < policy.max_steps):
         possible_actions = state_simu.get_possible_actions()
-        possible_actions = state_simu.sort_actions(possible_actions, normalized_usage, zero_values)
-
         if not possible_actions:
             break  # 如果没有可能的动作，退出循环
-        action = random.choice(possible_actions)
+        action = policy.choose(state_simu, possible_actions, profile)
         state_simu = state_simu.take_action(action)
-        depth += 1      
-        logging.info(action)
-    # 传递 timing_dict 给 calculate_reward
-    return calculate_reward(table_columns, table_meta, state_simu.tables, timing_dict=timing_dict)
+        depth += 1
+        steps += 1
+        if tracer.debug_active:
+            tracer.emit(DEBUG, 'rollout_action', depth=depth, action=action)
+    return state_simu
+
+## reward归一化: reward = (reward_offset - 加权代价) / reward_scale
+## 常数按'operators'模型的代价量级设定(默认配置的代价约3e10)
+## 'plan'模型的代价量级高得多, 而且每条query差别很大(Q9约2.7e14), 不能用同样的常数, 也不能直接求和
+## calibrate_reward_normalization在求和之前按query缩放'plan'模型的代价(ch_query_cost.plan_query_scales), 两个常数不变
+reward_offset = 30000000000.0
+reward_scale = 10000000.0
 
 def normalize_reward(reward):
     # 归一化
-    N = 30000000000.0
-    return (N - reward) / 10000000.0
-
-def monte_carlo_tree_search(root, iterations, max_depth):
+    return (reward_offset - reward) / reward_scale
+
+# candidates: 默认配置(搜索的初始配置). 在设置代价模型, 代价因子和分区布局之后调用
+# 每条query的缩放系数 = 默认配置下'operators'代价 / 'plan'代价, 缩放后每条query的代价是它在'plan'模型下相对默认配置的变化,
+# 按这条query在'operators'模型下的代价加权. 两个模型给出的reward只在默认配置处相同, 不能互相比较
+def calibrate_reward_normalization(table_columns, candidates):
+    set_plan_query_scales(None)
+    model = get_query_cost_model()
+    if model == 'operators':
+        return
+    costs = calculate_query_costs_matrix(table_columns, [candidates])[0]
+    set_query_cost_model('operators')
+    try:
+        base_costs = calculate_query_costs_matrix(table_columns, [candidates])[0]
+    finally:
+        set_query_cost_model(model)
+    plan_model = get_plan_cost_model()
+    scales = {}
+    for qry_idx, (cost, base_cost) in enumerate(zip(costs, base_costs)):
+        if not plan_model.has_plan(qry_idx):
+            continue
+        if cost <= 0 or base_cost <= 0:
+            logging.warning(f"reward normalization: Q{qry_idx + 1} default configuration cost {cost} ({model}), {base_cost} (operators), not scaled")
+            continue
+        scales[qry_idx] = base_cost / cost
+    set_plan_query_scales(scales)
+    logging.info(f"reward normalization for {model} model: per-query scales " + ', '.join(f"Q{qry_idx + 1} {scale:.3g}" for qry_idx, scale in scales.items()))
+
+# transpositions: 置换表(TranspositionTable), 相同配置共享一个节点. None表示不使用
+# expansion: 子节点扩展策略, 'widening'(渐进扩展, 子节点数 widening_k * visits^widening_alpha) 或 'fixed'(最多50个子节点)
+#            为None时使用Node当前的设置
+# 停止条件: iterations轮(None表示不限制), time_budget秒, 或最佳reward连续patience轮提升不超过min_improvement
+# best: BestConfiguration, 可以由调用方传入, 搜索中(例如另一个线程)随时读取当前最佳配置
+# 返回BestConfiguration. 搜索被Ctrl-C中断时也返回目前为止的最佳配置
+# checkpoint_path: 每checkpoint_interval轮和搜索结束时把整棵树保存到检查点(mcts/checkpoint.py), 为None时不保存
+# start_iteration: 从检查点继续时之前已完成的轮数, checkpoint_tag: workload的标识, 继续搜索时检查
+def monte_carlo_tree_search(root, iterations, max_depth, transpositions=None, expansion=None, widening_k=None, widening_alpha=None,
+                            time_budget=None, patience=None, min_improvement=0.0, best=None,
+                            checkpoint_path=None, checkpoint_interval=500, checkpoint_tag=None, start_iteration=0):
+    if expansion is not None:
+        set_expansion_policy(expansion, widening_k, widening_alpha)
+    budget = SearchBudget(iterations, time_budget, patience)
+    if best is None:
+        best = BestConfiguration(min_improvement)
+    if transpositions is not None:
+        root.transpositions = transpositions
+        transpositions.register(root)
     # 新增：记录各部分总耗时
     total_timing = {
         'search_round': 0.0,
@@ -410,52 +699,20 @@ def monte_carlo_tree_search(root, iterations, max_depth):
         'get_qcard': 0.0,
         'update_qparams_with_qcard': 0.0,
     }
-    for i in range(iterations):
-        t_round_start = time.perf_counter()
-        print(i)
-        node = root
-        reward = 0
-        # 选择. 对于完全扩展的节点，选择最佳子节点，直到达到最大深度
-        while node.is_fully_expanded() and node.depth < max_depth:
-            if not node.state.get_possible_actions():
-                break
-            node = node.best_child()          
-        if not node.state.get_possible_actions():
-            t_round_end = time.perf_counter()
-            total_timing['search_round'] += t_round_end - t_round_start
-            continue
-
-        # 扩展
-        if node.depth < max_depth:
-            node = node.expand()
-
-        # 模拟
-        t_calculate_reward_start = time.perf_counter()
-        timing_dict = {
-            'update_meta': 0.0,
-            'update_rowsize': 0.0,
-            'get_qcard': 0.0,
-            'update_qparams_with_qcard': 0.0,
-        }
-        
-        reward = simulate(node.state, node.depth, max_depth, timing_dict=timing_dict)
-
-        t_calculate_reward_end = time.perf_counter()
-        total_timing['calculate_reward'] += t_calculate_reward_end - t_calculate_reward_start
-        total_timing['update_meta'] += timing_dict['update_meta']
-        total_timing['update_rowsize'] += timing_dict['update_rowsize']
-        total_timing['get_qcard'] += timing_dict['get_qcard']
-        total_timing['update_qparams_with_qcard'] += timing_dict['update_qparams_with_qcard']
-
-        logging.info(f"Reward: {reward}")
-
-        # 反向传播
-        while node is not None:
-            node.update(reward)
-            node = node.parent
-
-        t_round_end = time.perf_counter()
-        total_timing['search_round'] += t_round_end - t_round_start
+    budget.start()
+    i = 0
+    try:
+        while not budget.exhausted(i, best):
+            search_round(root, max_depth, i, best, total_timing)
+            i += 1
+            if checkpoint_path is not None and checkpoint_interval and i % checkpoint_interval == 0:
+                save_checkpoint(checkpoint_path, root, start_iteration + i, best, checkpoint_tag)
+    except KeyboardInterrupt:
+        budget.stop_reason = 'interrupted'
+    tracer.end_iteration()
+    if checkpoint_path is not None:
+        save_checkpoint(checkpoint_path, root, start_iteration + i, best, checkpoint_tag)
+    logging.info(f"MCTS stopped after {i} iterations ({budget.stop_reason}), {budget.elapsed():.2f}s, best: {best.stats()}")
 
     # 搜索完成后输出各部分总耗时
     logging.info("==== MCTS各部分总耗时(秒) ====")
@@ -465,193 +722,320 @@ def monte_carlo_tree_search(root, iterations, max_depth):
     logging.info(f"总update_rowsize耗时: {total_timing['update_rowsize']:.6f}")
     logging.info(f"总get_qcard耗时: {total_timing['get_qcard']:.6f}")
     logging.info(f"总update_qparams_with_qcard耗时: {total_timing['update_qparams_with_qcard']:.6f}")
+    if reward_cache is not None:
+        logging.info(f"reward cache: {reward_cache.stats()}")
+    if incremental_evaluator is not None:
+        logging.info(f"incremental evaluator: {incremental_evaluator.stats()}")
+    if root.transpositions is not None:
+        logging.info(f"transposition table: {root.transpositions.stats()}")
+    logging.info(f"rollout policy: {get_rollout_policy().stats()}")
+    return best
+
+# 从检查点继续搜索, 返回 (根节点, BestConfiguration)
+# decay为None: 进程中断后继续, 检查点的tag必须和当前workload一致, 恢复统计和最佳配置
+# decay不为None: 热启动, 加载前一次(workload略有变化)的树, 旧的visits按decay缩小作为先验
+# 两种情况下当前不可执行(例如被ActionPruning裁剪)的action对应的子树都不恢复(load_checkpoint),
+# 检查点的最佳配置按当前的reward函数重新计算后作为初始的最佳配置
+# iterations: 总轮数, 继续搜索时只执行检查点之后剩下的轮数
+# 其余参数和monte_carlo_tree_search相同, 新的检查点保存到checkpoint_path
+def resume_monte_carlo_tree_search(checkpoint_path, schema, profile, iterations, max_depth, transpositions=None, decay=None,
+                                   checkpoint_tag=None, min_improvement=0.0, **kwargs):
+    root, header = load_checkpoint(checkpoint_path, schema, profile, transpositions=transpositions, decay=decay)
+    best = BestConfiguration(min_improvement)
+    start_iteration = 0
+    if decay is None:
+        if header['tag'] != checkpoint_tag:
+            raise ValueError(f"Checkpoint {checkpoint_path} was saved for workload {header['tag']}, use decay to warm start")
+        start_iteration = header['iterations']
+        if iterations is not None:
+            iterations = max(iterations - start_iteration, 0)
+    if header['best'] is not None:
+        best_state = CompactState.from_tables(schema, header['best']['tables'], profile=profile)
+        reward = evaluate_reward(best_state.tables)
+        logging.info(f"checkpoint best reward: {header['best']['reward']}, rescored: {reward}")
+        best.update(0, reward, best_state)
+    best = monte_carlo_tree_search(root, iterations, max_depth, transpositions, best=best, checkpoint_path=checkpoint_path,
+                                   checkpoint_tag=checkpoint_tag, start_iteration=start_iteration, **kwargs)
+    return root, best
+
+# monte_carlo_tree_search的一轮: 选择, 扩展, 模拟, 反向传播, 同时更新最佳配置
+def search_round(root, max_depth, i, best, total_timing):
+    t_round_start = time.perf_counter()
+    tracer.start_iteration(i)
+    reward = 0
+    # 选择和扩展, path记录从根节点到叶节点的路径
+    path = []
+    node = select_and_expand(root, max_depth, path)
+    if node is None:
+        t_round_end = time.perf_counter()
+        total_timing['search_round'] += t_round_end - t_round_start
+        tracer.end_iteration()
+        return
 
-def expand_root(root, max_depth):
-    # 扩展根节点
-    actions = root.state.get_possible_actions()
-    child_nodes = []
-    while not root.is_fully_expanded():
-        for action in actions:
-            if action not in [child.state.action for child in root.children]:
-                new_state = root.state.take_action(action)
-                child_node = Node(new_state, root, root.depth + 1)  # 更新子节点的深度
-                root.children.append(child_node)
-                logging.info(f"take action: {action}")
-                logging.info(f"append child to node depth: {root.depth}")
-                child_nodes.append(child_node)   
-
-    # 计算reward
-    for child_node in child_nodes:
-        reward = simulate(child_node.state, child_node.depth, max_depth)
+    # 模拟
+    t_calculate_reward_start = time.perf_counter()
+    timing_dict = {
+        'update_meta': 0.0,
+        'update_rowsize': 0.0,
+        'get_qcard': 0.0,
+        'update_qparams_with_qcard': 0.0,
+    }
     
-        # 反向传播
-        while child_node is not None:
-            child_node.update(reward)
-            child_node = child_node.parent    
-    return child_nodes
-
-def worker_process(root, iterations, max_depth):
-    local_root = copy.deepcopy(root)
-    for _ in range(iterations):
-        node = local_root
-        # 选择. 对于完全扩展的节点，选择最佳子节点，直到达到最大深度
-        while node.is_fully_expanded() and node.depth < max_depth:
-            if not node.state.get_possible_actions():
-                break
-            node = node.best_child()
-        if not node.state.get_possible_actions():
-            continue
-
-        # 扩展
-        if node.depth < max_depth:
-            node = node.expand()
-
-        # 模拟
-        reward = simulate(node.state, node.depth, max_depth)
-
-        # 反向传播
+    reward, final_state = simulate_state(node.state, node.depth, max_depth, timing_dict=timing_dict)
+
+    t_calculate_reward_end = time.perf_counter()
+    total_timing['calculate_reward'] += t_calculate_reward_end - t_calculate_reward_start
+    total_timing['update_meta'] += timing_dict['update_meta']
+    total_timing['update_rowsize'] += timing_dict['update_rowsize']
+    total_timing['get_qcard'] += timing_dict['get_qcard']
+    total_timing['update_qparams_with_qcard'] += timing_dict['update_qparams_with_qcard']
+
+    # 反向传播, 记录reward最高的配置
+    improved = best.update(i, reward, final_state, node)
+    if tracer.active:
+        tracer.emit(INFO, 'reward', depth=node.depth, reward=reward, best=best.reward, improved=improved)
+    if root.transpositions is not None:
+        backpropagate_path(path, reward)
+    else:
         while node is not None:
             node.update(reward)
             node = node.parent
 
-    return local_root
+    t_round_end = time.perf_counter()
+    total_timing['search_round'] += t_round_end - t_round_start
+    tracer.end_iteration()
+
 
-def parallel_monte_carlo_tree_search(root, iterations, max_depth, num_processes):
-    #扩展根节点全部的一层子节点
-    nodes = expand_root(root, max_depth) # [node in root.children]
+# 选择并扩展一个节点, 没有可执行的action时返回None
+# path: 不为None时记录从根节点到返回节点的路径(使用置换表时节点可能有多个父节点)
+def select_and_expand(root, max_depth, path=None):
+    node = root
+    if path is not None:
+        path.append(node)
+    # 选择. 对于完全扩展的节点，选择最佳子节点，直到达到最大深度
+    while node.is_fully_expanded() and node.depth < max_depth:
+        if not node.state.get_possible_actions():
+            break
+        node = node.best_child()
+        if path is not None:
+            path.append(node)
+    if not node.state.get_possible_actions():
+        return None
+
+    # 扩展
+    if node.depth < max_depth:
+        node = node.expand()
+        if path is not None:
+            path.append(node)
+    return node
+
+# 一轮mcts: 选择, 扩展, 模拟, 反向传播
+# rollout_fn: 为None时在当前进程调用simulate; 否则rollout_fn(state, depth, max_depth)返回reward列表(叶并行)
+def mcts_iteration(root, max_depth, rollout_fn=None):
+    path = []
+    node = select_and_expand(root, max_depth, path)
+    if node is None:
+        return
+
+    # 模拟
+    if rollout_fn is None:
+        rewards = [simulate(node.state, node.depth, max_depth)]
+    else:
+        rewards = rollout_fn(node.state, node.depth, max_depth)
+
+    # 反向传播
+    if root.transpositions is not None:
+        for reward in rewards:
+            backpropagate_path(path, reward)
+        return
+    while node is not None:
+        for reward in rewards:
+            node.update(reward)
+        node = node.parent
+
+# 记录树上每条边的(action路径, visits, reward), 父节点在子节点之前. 根节点的路径为()
+# 使用置换表时树是DAG, 每个节点只展开一次, 保证每条边只记录一次
+def collect_node_stats(root):
+    stats = [((), root.visits, root.reward)]
+    stack = [(root, ())]
+    seen = set()
+    while stack:
+        node, path = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        visits, rewards, _, _ = node.children_stats()
+        for slot, (child, action) in enumerate(zip(node.children, node.child_actions)):
+            child_path = path + (action,)
+            stats.append((child_path, visits[slot], rewards[slot]))
+            stack.append((child, child_path))
+    return stats
+
+# 根并行的worker: 在root的副本上独立搜索, 返回每个节点相对搜索开始时新增的visits和reward
+def worker_process(root, iterations, max_depth, seed=None):
+    if seed is not None:
+        random.seed(seed)
+    local_root = copy.deepcopy(root)
+    base_stats = {path: (visits, reward) for path, visits, reward in collect_node_stats(local_root)}
 
+    for _ in range(iterations):
+        mcts_iteration(local_root, max_depth)
+
+    deltas = []
+    for path, visits, reward in collect_node_stats(local_root):
+        base_visits, base_reward = base_stats.get(path, (0, 0))
+        if visits > base_visits:
+            deltas.append((path, visits - base_visits, reward - base_reward))
+    return deltas
+
+# 按action路径把worker的统计信息合并回root, 不存在的节点新建
+def merge_node_stats(root, deltas):
+    for path, visits, reward in deltas:
+        node = root
+        parent = None
+        slot = None
+        for action in path:
+            slot = next((i for i, a in enumerate(node.child_actions) if a == action), None)
+            if slot is None:
+                new_state = node.state.take_action(action)
+                child = node.transpositions.lookup(new_state) if node.transpositions is not None else None
+                if child is None:
+                    child = node.new_child(new_state)
+                node.add_child(child, action)
+                slot = len(node.children) - 1
+            parent = node
+            node = node.children[slot]
+        # 路径最后一条边的统计
+        if parent is None:
+            node.visits += visits
+            node.reward += reward
+        else:
+            parent.child_visits[slot] += visits
+            parent.child_rewards[slot] += reward
+        # 配置的统计是所有入边统计之和
+        if root.transpositions is not None:
+            node.state_visits += visits
+            node.state_reward += reward
+
+# 叶并行的worker: 从state开始做一次rollout
+def rollout_worker(state, depth, max_depth, seed):
+    random.seed(seed)
+    return simulate(state, depth, max_depth)
+
+# 并行mcts
+# mode='root': 根并行, 每个进程在root的副本上搜索iterations // num_processes轮, 结果按action路径合并回root
+# mode='leaf': 叶并行, 每轮扩展一个叶节点, 在进程池中同时做batch_size次rollout
+def parallel_monte_carlo_tree_search(root, iterations, max_depth, num_processes=None, mode='root', batch_size=None, seed=None):
     if num_processes is None:
         num_processes = cpu_count()
+    if seed is None:
+        seed = random.randrange(1 << 30)
+
+    if mode == 'root':
+        iterations_per_process = [iterations // num_processes] * num_processes
+        for i in range(iterations % num_processes):
+            iterations_per_process[i] += 1
+        with Pool(processes=num_processes) as pool:
+            results = pool.starmap(worker_process, [(root, iterations_per_process[i], max_depth, seed + i) for i in range(num_processes)])
+        # 合并结果
+        for deltas in results:
+            merge_node_stats(root, deltas)
+
+    elif mode == 'leaf':
+        if batch_size is None:
+            batch_size = num_processes
+        rollout_seed = [seed]
+        with Pool(processes=num_processes) as pool:
+            def rollout_fn(state, depth, max_depth):
+                args = [(state, depth, max_depth, rollout_seed[0] + i) for i in range(batch_size)]
+                rollout_seed[0] += batch_size
+                return pool.starmap(rollout_worker, args)
+            # 每轮做batch_size次rollout, 总rollout次数和iterations一致
+            for _ in range(max(1, iterations // batch_size)):
+                mcts_iteration(root, max_depth, rollout_fn)
+
+    else:
+        raise ValueError(f"Unsupported parallel mode: {mode}")
 
-    iterations_per_process = iterations // num_processes
-    #iterations_per_process = iterations
-    nodes_per_process = len(nodes) // num_processes
-    node_chunks = [nodes[i:i + nodes_per_process] for i in range(0, len(nodes), nodes_per_process)]
-
-    with Pool(processes=num_processes) as pool:
-        # results = pool.starmap(worker_process, [(root, iterations_per_process, max_depth)] * num_processes)
-        pool.starmap(worker_process, [(node, iterations_per_process, max_depth) for node in nodes])
-
-    # # 合并结果
-    # for result in results:
-    #     for child in result.children:
-    #         if child not in root.children:
-    #             root.children.append(child)
-    #         else:
-    #             existing_child = root.children[root.children.index(child)]
-    #             existing_child.visits += child.visits
-    #             existing_child.reward += child.reward
+    return root
 
+# rollout进程attach的共享节点统计和锁, 由init_shared_stats_worker初始化
+shared_stats = None
+shared_stats_lock = None
+
+def init_shared_stats_worker(name, capacity, lock):
+    global shared_stats, shared_stats_lock
+    shared_stats = SharedNodeStats(capacity, name)
+    shared_stats_lock = lock
+
+# 树并行的rollout: 模拟结束后直接按path_ids更新共享内存里的统计, 同时撤销virtual loss
+def shared_rollout_worker(state, depth, max_depth, seed, path_ids, virtual_loss):
+    random.seed(seed)
+    reward = simulate(state, depth, max_depth)
+    with shared_stats_lock:
+        shared_stats.backpropagate(path_ids, reward, virtual_loss)
+    return reward
+
+# 树并行mcts: 所有rollout进程共享同一棵树
+# 主进程做选择和扩展, 在路径上加virtual loss后把rollout交给进程池, 最多num_processes个rollout同时进行
+# 节点的visits/reward在共享内存数组中(SharedNodeStats), rollout进程直接反向传播
+# virtual_loss: 加在reward上的值, 越小并发的选择越分散
+def tree_parallel_monte_carlo_tree_search(root_state, iterations, max_depth, num_processes=None, virtual_loss=0.0, seed=None):
+    if num_processes is None:
+        num_processes = cpu_count()
+    if seed is None:
+        seed = random.randrange(1 << 30)
+
+    stats = SharedNodeStats(iterations + 1)
+    root = SharedStatsNode(root_state, stats)
+    lock = Lock()
+    in_flight = threading.Semaphore(num_processes)
+    errors = []
+
+    def on_error(error):
+        errors.append(error)
+        in_flight.release()
+
+    try:
+        with Pool(processes=num_processes, initializer=init_shared_stats_worker, initargs=(stats.name, stats.capacity, lock)) as pool:
+            pending = []
+            for i in range(iterations):
+                in_flight.acquire()
+                if errors:
+                    break
+                node = select_and_expand(root, max_depth)
+                if node is None:
+                    in_flight.release()
+                    continue
+                path_ids = node.path_ids()
+                with lock:
+                    stats.add_virtual_loss(path_ids, virtual_loss)
+                pending.append(pool.apply_async(shared_rollout_worker, (node.state, node.depth, max_depth, seed + i, path_ids, virtual_loss), callback=lambda _: in_flight.release(), error_callback=on_error))
+            for result in pending:
+                result.wait()
+        if errors:
+            raise errors[0]
+        root.detach()
+    finally:
+        stats.close()
     return root
 
 
+# 评估结束后恢复table_meta的keys, partition_cnt, partition_range
+# TableMetaView只丢弃overlay; 普通列表重新构造24个*_Meta对象
 def reset_table_meta(table_meta):
-    #reset keys, partition_cnt, partition_range in table_meta
+    if isinstance(table_meta, TableMetaView):
+        table_meta.reset()
+        return
     table_meta.clear()
-    customer_meta = Customer_Meta()
-    district_meta = District_Meta()
-    history_meta = History_Meta()
-    item_meta = Item_Meta()
-    nation_meta = Nation_Meta()
-    new_order_meta = New_Order_Meta()
-    order_line_meta = Order_Line_Meta()
-    orders_meta = Orders_Meta()
-    region_meta = Region_Meta()
-    stock_meta = Stock_Meta()
-    supplier_meta = Supplier_Meta()
-    warehouse_meta = Warehouse_Meta()
-    table_meta.extend([customer_meta, district_meta, history_meta, item_meta, nation_meta, new_order_meta, order_line_meta, orders_meta, region_meta, stock_meta, supplier_meta, warehouse_meta])
-
-    customer_replica_meta = Customer_Meta()
-    district_replica_meta = District_Meta()
-    history_replica_meta = History_Meta()
-    item_replica_meta = Item_Meta()
-    nation_replica_meta = Nation_Meta()
-    new_order_replica_meta = New_Order_Meta()
-    order_line_replica_meta = Order_Line_Meta()
-    orders_replica_meta = Orders_Meta()
-    region_replica_meta = Region_Meta()
-    stock_replica_meta = Stock_Meta()
-    supplier_replica_meta = Supplier_Meta()
-    warehouse_replica_meta = Warehouse_Meta()
-
-    customer_replica_meta.isreplica = True
-    district_replica_meta.isreplica = True
-    history_replica_meta.isreplica = True
-    item_replica_meta.isreplica = True
-    nation_replica_meta.isreplica = True
-    new_order_replica_meta.isreplica = True
-    order_line_replica_meta.isreplica = True
-    orders_replica_meta.isreplica = True
-    region_replica_meta.isreplica = True
-    stock_replica_meta.isreplica = True
-    supplier_replica_meta.isreplica = True
-    warehouse_replica_meta.isreplica = True
-
-    table_meta.extend([customer_replica_meta, district_replica_meta, history_replica_meta, item_replica_meta, nation_replica_meta, new_order_replica_meta, order_line_replica_meta, orders_replica_meta, region_replica_meta, stock_replica_meta, supplier_replica_meta, warehouse_replica_meta])    
+    table_meta.extend(build_table_meta())
 
 if __name__ == "__main__":
-    # 1. 初始化表参数
-    table_meta = []
-    customer_meta = Customer_Meta()
-    district_meta = District_Meta()
-    history_meta = History_Meta()
-    item_meta = Item_Meta()
-    nation_meta = Nation_Meta()
-    new_order_meta = New_Order_Meta()
-    order_line_meta = Order_Line_Meta()
-    orders_meta = Orders_Meta()
-    region_meta = Region_Meta()
-    stock_meta = Stock_Meta()
-    supplier_meta = Supplier_Meta()
-    warehouse_meta = Warehouse_Meta()
-    # append的顺序要求一致
-    table_meta.extend([customer_meta, district_meta, history_meta, item_meta, nation_meta, new_order_meta, order_line_meta, orders_meta, region_meta, stock_meta, supplier_meta, warehouse_meta]) 
-
-    # 初始化列存表的参数
-    customer_replica_meta = Customer_Meta()
-    district_replica_meta = District_Meta()
-    history_replica_meta = History_Meta()
-    item_replica_meta = Item_Meta()
-    nation_replica_meta = Nation_Meta()
-    new_order_replica_meta = New_Order_Meta()
-    order_line_replica_meta = Order_Line_Meta()
-    orders_replica_meta = Orders_Meta()
-    region_replica_meta = Region_Meta()
-    stock_replica_meta = Stock_Meta()
-    supplier_replica_meta = Supplier_Meta()
-    warehouse_replica_meta = Warehouse_Meta()
-
-    customer_replica_meta.isreplica = True
-    district_replica_meta.isreplica = True
-    history_replica_meta.isreplica = True
-    item_replica_meta.isreplica = True
-    nation_replica_meta.isreplica = True
-    new_order_replica_meta.isreplica = True
-    order_line_replica_meta.isreplica = True
-    orders_replica_meta.isreplica = True
-    region_replica_meta.isreplica = True
-    stock_replica_meta.isreplica = True
-    supplier_replica_meta.isreplica = True
-    warehouse_replica_meta.isreplica = True
-
-    table_meta.extend([customer_replica_meta, district_replica_meta, history_replica_meta, item_replica_meta, nation_replica_meta, new_order_replica_meta, order_line_replica_meta, orders_replica_meta, region_replica_meta, stock_replica_meta, supplier_replica_meta, warehouse_replica_meta])
+    # 1. 初始化表参数, 所有评估共享只读的元数据原型
+    table_meta = get_table_meta_store().new_view()
 
     # 2. 初始化表的列参数
-    table_columns = []
-    customer_columns = Customer_columns()
-    district_columns = District_columns()
-    history_columns = History_columns()    
-    item_columns = Item_columns()
-    nation_columns = Nation_columns()
-    new_order_columns = New_order_columns()
-    order_line_columns = Order_line_columns()    
-    orders_columns = Orders_columns()
-    region_columns = Region_columns()
-    stock_columns = Stock_columns()
-    supplier_columns = Supplier_columns()
-    warehouse_columns = Warehouse_columns()
-    table_columns.extend([customer_columns, district_columns, history_columns, item_columns, nation_columns, new_order_columns, order_line_columns, orders_columns, region_columns, stock_columns, supplier_columns, warehouse_columns])
+    table_columns = build_table_columns()
 
     
     # 3.构建mcts树的根节点
@@ -670,6 +1054,57 @@ if __name__ == "__main__":
     # 设置日志
     setup_logging()
 
+    # 列统计目录, 存在时由直方图估计分区行数, 否则使用keys_partition_cnt
+    statistics_catalog = load_statistics_catalog('Output/statistics_catalog_ch.bin')
+
+    # 离线计划缓存, 第一次使用计划时才读取, 不需要连接数据库
+    set_plan_cache_path('Output/plan_cache_ch.bin')
+    # 计划按数据库当前的物理设计(搜索的初始配置)抓取
+    set_plan_layout(table_columns)
+
+    # workload的到达率: 驱动程序保存的Workload_Statistics计数(workload_analyzer.save_workload_statistics)
+    # 文件不存在时每条query和每种事务等权
+    workload_rates = load_workload_rates('Output/workload_statistics_ch.json')
+
+    # 校准的代价因子(estimator/cost_calibration.py生成), 文件不存在时使用默认因子. 编译计划缓存了因子, 加载后清空
+    cost_factors = load_factor_profile('Output/cost_factors_ch.json')
+    reset_compiled_query_plans()
+
+    # query代价模型: python advisor.py <new|resume|warm_start> <operators|plan> [分区数] [uniform|equi-depth]
+    # 'plan'使用EXPLAIN计划树计算连接/聚合/排序的代价, 每条query的代价按默认配置下和'operators'代价之比缩放后再求和
+    set_query_cost_model(sys.argv[2] if len(sys.argv) > 2 else 'operators')
+
+    # 分区数和分区边界的划分方式(ch_partition_meta.set_partition_layout), 默认4个分区, [min, max]均匀划分
+    # 需要单独设置某些表的分区数时在partition_table_counts中配置, 例如{'order_line': 8}
+    partition_table_counts = {}
+    set_partition_layout(int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_PARTITION_COUNT,
+                         sys.argv[4] if len(sys.argv) > 4 else 'uniform', partition_table_counts)
+    calibrate_reward_normalization(table_columns, tables)
+
+    # reward缓存, 相同workload的多次运行可以从磁盘加载. 分区行数的来源和代价模型不同, reward也不同
+    reward_cache_path = 'Output/reward_cache_ch.pkl'
+    reward_cache_tag = 'ch' if statistics_catalog is None else 'ch_catalog'
+    if get_query_cost_model() != 'operators':
+        reward_cache_tag += '_' + get_query_cost_model()
+    if cost_factors:
+        reward_cache_tag += '_calibrated_' + factor_profile_fingerprint(cost_factors)
+    if workload_rates is not None:
+        reward_cache_tag += '_weighted_' + workload_rates.fingerprint()
+    if partition_layout_fingerprint() is not None:
+        reward_cache_tag += '_partitions_' + partition_layout_fingerprint()
+    reward_cache = RewardCache(capacity=200000, tag=reward_cache_tag)
+    if reward_cache.load(reward_cache_path):
+        logging.info(f"load reward cache: {len(reward_cache)} entries")
+
+    # 增量计算reward, 只重新计算配置变化的表涉及的query
+    incremental_evaluator = IncrementalRewardEvaluator(table_columns)
+
+    # rollout策略: 'random', 'greedy', 'epsilon_greedy'(epsilon=...), 'truncated'(steps=..., base=...)
+    set_rollout_policy(make_rollout_policy('random'))
+
+    # 搜索过程的跟踪(mcts/tracing.py), 写成JSON lines. level: 'debug'(每个rollout action和每条query的代价), 'info', 'off'
+    # sample_every: 每几轮记录一轮
+    tracer.configure('Output/mcts_trace_ch.jsonl', level='info', sample_every=10)
 
     # #*************************独立测试时用的代码*************************
     # initial_state = State(tables)
@@ -711,38 +1146,68 @@ if __name__ == "__main__":
 
 
     # 4. 进行并行化的mcts搜索
-    initial_state = State(tables)
+    # workload的列使用情况只计算一次, workload变化时调用profile.invalidate()
+    profile = WorkloadProfile.from_rates(get_workload_rates())
+    # 用列下标位图表示每个表的配置, take_action不再deepcopy所有表
+    schema = ConfigSchema(table_columns)
+    # 静态分析workload, 去掉不会改变reward的action, 等价的action只保留一个
+    profile.action_pruning = ActionPruning.from_profile(schema, table_columns, profile)
+    logging.info(f"action pruning: {profile.action_pruning.stats()}")
+    initial_state = CompactState.from_tables(schema, tables, profile=profile)
     root = Node(initial_state) 
 
     print('cpu_count: ', cpu_count())
 
     start_time = time.time()
-    #parallel_monte_carlo_tree_search(root, iterations=1000, max_depth=10, num_processes=3)
-    monte_carlo_tree_search(root, iterations=6000, max_depth=25)
+    #parallel_monte_carlo_tree_search(root, iterations=6000, max_depth=25, num_processes=32, mode='root')
+    #root = tree_parallel_monte_carlo_tree_search(initial_state, iterations=6000, max_depth=25, num_processes=32)
+    # 置换表: 不同action顺序到达的相同配置共享一个节点
+    transpositions = TranspositionTable()
+    # 搜索预算: 最多6000轮; 夜间调优窗口固定时设置time_budget(秒), 最佳reward长时间不提升时用patience提前停止
+    search_options = dict(expansion='widening', widening_k=1.0, widening_alpha=0.5, time_budget=None, patience=None)
+    # 检查点: python advisor.py resume 从中断的搜索继续; python advisor.py warm_start 用前一次的树热启动(workload略有变化)
+    checkpoint_path = 'Output/mcts_checkpoint_ch.bin'
+    search_mode = sys.argv[1] if len(sys.argv) > 1 else 'new'
+    if search_mode in ('resume', 'warm_start') and os.path.exists(checkpoint_path):
+        decay = 0.1 if search_mode == 'warm_start' else None
+        root, best = resume_monte_carlo_tree_search(checkpoint_path, schema, profile, 6000, 25, transpositions, decay=decay,
+                                                    checkpoint_tag=reward_cache_tag, **search_options)
+    else:
+        best = monte_carlo_tree_search(root, iterations=6000, max_depth=25, transpositions=transpositions,
+                                       checkpoint_path=checkpoint_path, checkpoint_tag=reward_cache_tag, **search_options)
     mcts_time = time.time() - start_time
+    reward_cache.save(reward_cache_path)
+    tracer.close()
 
     start_time = time.time()
-    # 从根节点开始，选择最佳子节点，直到叶子节点
-    node = root.best_child(c_param=0)
-    node1 = copy.deepcopy(node)
-    while True:
-        if len(node.children) == 0:
-            break        
-        node = node.best_child(c_param=0)
-        if (node.reward / node.visits) > (node1.reward / node1.visits):
-            print("node1 copy")
-            node1 = copy.deepcopy(node)         
+    # 从根节点开始，选择最佳子节点，直到叶子节点. 树在搜索结束后不再修改, 不需要deepcopy节点
+    # 搜索提前停止(时间预算, patience)时有没有访问过的子节点, 只沿访问过的子节点向下走
+    node1 = root
+    node = root.best_visited_child()
+    while node is not None:
+        if node1 is root or (node.reward / node.visits) > (node1.reward / node1.visits):
+            node1 = node
+        node = node.best_visited_child()
     selection_time = time.time() - start_time
 
+    # reward是确定的代价模型算出来的, 搜索中评估过的reward最高的配置(反向传播时记录)不低于任何节点的平均reward
+    # 没有完成任何一轮搜索时输出平均reward最高的树节点
+    if best.reward is not None:
+        best_tables = best.tables
+        best_reward = best.reward
+    else:
+        best_tables = node1.state.tables
+        best_reward = node1.reward / node1.visits if node1.visits > 0 else None
+
     #print("最佳分区键和副本设置:", node1.state.tables)
     #print("最佳分区键和副本设置:")
     # 使用 json.dumps 格式化输出
-    formatted_output = json.dumps(node1.state.tables, indent=4, ensure_ascii=False)
+    formatted_output = json.dumps(best_tables, indent=4, ensure_ascii=False)
     # 将格式化后的输出写入到文件
     with open('Output/best_advisor_0717_6000.txt', 'w', encoding='utf-8') as f:
         f.write(formatted_output)
 
-    print("最佳收益:", node1.reward / node1.visits)
+    print("最佳收益:", best_reward)
     print("访问次数:", node1.visits)    
     print("层数:", node1.depth)
 
@@ -750,15 +1215,15 @@ if __name__ == "__main__":
     print(f"选择最佳子节点时间: {selection_time:.2f}秒")
 
 
-    logging.info("最佳收益:", node1.reward / node1.visits)
-    logging.info("访问次数:", node1.visits)    
-    logging.info("层数:", node1.depth)
+    logging.info(f"最佳收益: {best_reward}")
+    logging.info(f"访问次数: {node1.visits}")    
+    logging.info(f"层数: {node1.depth}")
     logging.info("最佳配置:")
     logging.info(formatted_output)
 
 
     
-    for table, initial_table in zip(node1.state.tables, initial_state.tables):
+    for table, initial_table in zip(best_tables, initial_state.tables):
         logging.info(f"{table['name']}:")
         action_partition_keys = set(table['partition_keys'])
         action_replicas = set(initial_table['replicas']) - set(table['replicas'])
@@ -1,4 +1,8 @@
 import math
+import json
+import bisect
+import hashlib
+import itertools
 import sys
 import os
 from datetime import datetime, timedelta
@@ -9,6 +13,7 @@ import mysql.connector
 from mysql.connector import MySQLConnection
 from mysql.connector.cursor import MySQLCursor
 from config import get_connection, Config
+from estimator.statistics_catalog import get_statistics_catalog
 
 def get_connection(autocommit: bool = True) -> MySQLConnection:
     config = Config()
@@ -33,6 +38,142 @@ def get_connection(autocommit: bool = True) -> MySQLConnection:
 
 ##根据sql本身的物理执行计划,找到tablescan算子对应的表,然后在现有分区配置下估计tablescan需要扫描到的数据量,最后修改ch_query_params里的Qparams类的变量
 
+# 从统计目录(estimator/statistics_catalog.py)估计每个分区的行数, 返回(表的行数, partition_cnt)
+# 统计目录没有启用或者缺少分区键的直方图时返回None, 使用keys_partition_cnt
+# 和keys_partition_cnt一致, 多个分区键时使用最后一个分区键的分区行数
+def catalog_partition_cnt(table_name, keys, ranges):
+  catalog = get_statistics_catalog()
+  if catalog is None or not all(catalog.has_column(table_name, key) for key in keys):
+    return None
+  partition_cnt = []
+  for key_idx, key in enumerate(keys):
+    partition_cnt = catalog.partition_counts(table_name, key, ranges[key_idx])
+  return catalog.table_count(table_name), partition_cnt
+
+## 分区数和分区边界的划分方式
+## keys_partition_cnt是按[min, max]均匀分成DEFAULT_PARTITION_COUNT个分区时手动填写的行数
+## 其他分区数/边界时, 把keys_partition_cnt看作DEFAULT_PARTITION_COUNT个桶的直方图, 在桶内线性插值得到每个分区的行数
+DEFAULT_PARTITION_COUNT = 4
+partition_count = DEFAULT_PARTITION_COUNT
+table_partition_counts = {} # table_name -> 分区数, 没有配置的表使用partition_count
+partition_strategy = 'uniform' # 'uniform': [min, max]均匀划分; 'equi-depth': 每个分区的行数相同
+
+def set_partition_layout(count=DEFAULT_PARTITION_COUNT, strategy='uniform', table_counts=None):
+  global partition_count, partition_strategy, table_partition_counts
+  if strategy not in ('uniform', 'equi-depth'):
+    raise ValueError(f"Unsupported partition strategy: {strategy}")
+  partition_count = count
+  partition_strategy = strategy
+  table_partition_counts = dict(table_counts or {})
+
+def get_partition_count(table_name):
+  return table_partition_counts.get(table_name, partition_count)
+
+def get_partition_strategy():
+  return partition_strategy
+
+# 分区数和划分方式的标识, 作为reward缓存tag的一部分. 默认划分返回None
+def partition_layout_fingerprint():
+  if partition_count == DEFAULT_PARTITION_COUNT and partition_strategy == 'uniform' and not table_partition_counts:
+    return None
+  layout = [partition_count, partition_strategy, sorted(table_partition_counts.items())]
+  return hashlib.sha1(json.dumps(layout).encode('utf-8')).hexdigest()[:12]
+
+# 分区键的[min, max]均匀分成len(counts)个桶, 返回位置fraction(0~1)之前的行数
+def uniform_counts_cdf(counts, fraction):
+  position = min(max(fraction, 0.0), 1.0) * len(counts)
+  bucket = min(int(position), len(counts) - 1)
+  return sum(counts[:bucket]) + counts[bucket] * (position - bucket)
+
+# 分区边界在[min, max]中的位置fractions(最后一个为1), 按keys_partition_cnt估计每个分区的行数
+# fractions为None或者正好是均匀的len(counts)个分区时直接返回counts
+def resample_partition_cnt(counts, fractions):
+  if fractions is None or list(fractions) == [(i + 1) / len(counts) for i in range(len(counts))]:
+    return counts
+  partition_cnt = []
+  previous = 0
+  for i, fraction in enumerate(fractions):
+    cumulative = round(uniform_counts_cdf(counts, fraction)) if i < len(fractions) - 1 else sum(counts)
+    partition_cnt.append(cumulative - previous)
+    previous = cumulative
+  return partition_cnt
+
+# 等深划分: 每个分区行数相同的边界位置fractions, 由keys_partition_cnt的分布反推
+def equi_depth_fractions(counts, count):
+  total = sum(counts)
+  fractions = []
+  for j in range(1, count):
+    target = total * j / count
+    cumulative = 0
+    fraction = 1.0
+    for bucket, bucket_cnt in enumerate(counts):
+      if bucket_cnt > 0 and cumulative + bucket_cnt >= target:
+        fraction = (bucket + (target - cumulative) / bucket_cnt) / len(counts)
+        break
+      cumulative += bucket_cnt
+    fractions.append(fraction)
+  fractions.append(1.0)
+  return fractions
+
+## 分区裁剪
+## partition_range[k]是第k个分区键每个分区的上界(VALUES LESS THAN), 单调递增, bisect查找
+## 返回第一个分区键上的过滤条件对应的分区区间[start, end]
+## 和原来逐个分区比较的结果一致: gt/ge/eq的值超过最大边界, 或者lt/le的值不超过最小边界时扫描全部分区
+def prune_partition_range(bounds, operator, value):
+  start = 0
+  end = len(bounds) - 1
+  if operator == 'gt' or operator == 'ge':
+    i = bisect.bisect_right(bounds, value)
+    if i < len(bounds):
+      start = i
+  elif operator == 'lt' or operator == 'le':
+    i = bisect.bisect_left(bounds, value) - 1
+    if i >= 0:
+      end = min(i + 1, len(bounds) - 1)
+  elif operator == 'eq':
+    i = bisect.bisect_right(bounds, value)
+    if i < len(bounds):
+      start = i
+      end = i
+  return start, end
+
+## 多列分区键(RANGE COLUMNS): 分区i是[B_{i-1}, B_i), B_i = (partition_range[0][i], partition_range[1][i], ...)
+## 前几个分区键都是等值条件时, 用元组bisect求下一个分区键的条件对应的分区区间
+# eq_prefix: 前几个分区键的等值; lower/upper: 下一个分区键的下界和上界, None表示没有
+def prune_partition_columns(partition_range, eq_prefix, lower, upper):
+  num_partitions = len(partition_range[0])
+  j = len(eq_prefix)
+  prefix_bounds = [tuple(partition_range[k][i] for k in range(j)) for i in range(num_partitions)]
+  column_bounds = [tuple(partition_range[k][i] for k in range(j + 1)) for i in range(num_partitions)]
+  prefix = tuple(eq_prefix)
+  if lower is None:
+    start = bisect.bisect_left(prefix_bounds, prefix)
+  else:
+    start = bisect.bisect_right(column_bounds, prefix + (lower,))
+  if upper is None:
+    end = bisect.bisect_right(prefix_bounds, prefix)
+  else:
+    end = bisect.bisect_right(column_bounds, prefix + (upper,))
+  # 最后一个分区是MAXVALUE
+  return min(start, num_partitions - 1), min(end, num_partitions - 1)
+
+# partition_cnt的前缀和, 按partition_cnt列表缓存在meta上
+def partition_prefix_sums(partition_meta):
+  cached = getattr(partition_meta, 'partition_prefix', None)
+  if cached is not None and cached[0] is partition_meta.partition_cnt:
+    return cached[1]
+  prefix = [0]
+  prefix.extend(itertools.accumulate(partition_meta.partition_cnt))
+  partition_meta.partition_prefix = (partition_meta.partition_cnt, prefix)
+  return prefix
+
+# 分区区间[start, end]的行数, O(1)
+def partition_range_card(partition_meta, start, end):
+  if end < start:
+    return 0
+  prefix = partition_prefix_sums(partition_meta)
+  return prefix[end + 1] - prefix[start]
+
 ##建立保存表分区元数据的类
 ##每个表选定分区键之后默认四个分区
 class Customer_Meta:
@@ -59,7 +200,8 @@ class Customer_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -69,10 +211,16 @@ class Customer_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("customer", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -135,7 +283,8 @@ class District_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -145,10 +294,16 @@ class District_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("district", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -214,7 +369,8 @@ class History_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -224,10 +380,16 @@ class History_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("history", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -289,7 +451,8 @@ class Item_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -299,10 +462,16 @@ class Item_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("item", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -364,7 +533,8 @@ class Nation_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -374,10 +544,16 @@ class Nation_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("nation", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -440,7 +616,8 @@ class New_Order_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -450,10 +627,16 @@ class New_Order_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("new_order", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -521,7 +704,8 @@ class Order_Line_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -531,10 +715,16 @@ class Order_Line_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("order_line", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -602,7 +792,8 @@ class Orders_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -612,10 +803,16 @@ class Orders_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("orders", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -676,7 +873,8 @@ class Region_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -686,10 +884,16 @@ class Region_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("region", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -754,7 +958,8 @@ class Stock_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -764,10 +969,16 @@ class Stock_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("stock", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -829,7 +1040,8 @@ class Supplier_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -839,10 +1051,16 @@ class Supplier_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("supplier", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -903,7 +1121,8 @@ class Warehouse_Meta:
 
   # 更新meta类的keys partition_cnt partition_range
   # keys: [] ranges: [[],[]] ranges[i]:第i个分区键的范围
-  def update_partition_metadata(self, keys, ranges):
+  # fractions: [[],[]] fractions[i]:第i个分区键每个分区的边界在[min, max]中的位置, None表示均匀的DEFAULT_PARTITION_COUNT个分区
+  def update_partition_metadata(self, keys, ranges, fractions=None):
     self.keys.clear()
     self.partition_range = []
     self.partition_cnt = []
@@ -913,10 +1132,16 @@ class Warehouse_Meta:
     for i in range(len(ranges)):
       self.partition_range.append(ranges[i])
     
+    # 统计目录中有分区键的直方图时, 按分区边界估计每个分区的行数
+    catalog_cnt = catalog_partition_cnt("warehouse", keys, ranges)
+    if catalog_cnt is not None:
+      self.count, self.partition_cnt = catalog_cnt
+      return
+
     # 新增：直接用keys_partition_cnt
     if all(key in self.keys_partition_cnt for key in keys):
-      for key in keys:
-        self.partition_cnt = self.keys_partition_cnt[key]
+      for key_idx, key in enumerate(keys):
+        self.partition_cnt = resample_partition_cnt(self.keys_partition_cnt[key], None if fractions is None else fractions[key_idx])
       return
 
     # 原有数据库查询代码，已注释
@@ -6,83 +6,24 @@ from estimator.ch_query_params import *
 ## 因此每个Qcard类只需要找到selection算子，再通过get_query_card方法计算基数
 ## 最后修改ch_query_params里的Qparams类的变量
 
+# 每个表全表扫描的行数, rows_tablescan和rows_selection的默认值(原表和replica相同), rowsize默认为0
+table_default_rows = {'nation': 25, 'region': 5, 'customer': 120000, 'supplier': 10000, 'item': 100000, 'order_line': 1250435, 'stock': 400000, 'orders': 125038, 'district': 40, 'warehouse': 4, 'new_order': 36418, 'history': 124913}
+
+default_params = [0] * len(param_names)
+for _table, _rows in table_default_rows.items():
+    for _replica in (False, True):
+        default_params[param_index(plan_table_index[_table], _replica, PARAM_ROWS)] = _rows ##tbd
+        default_params[param_index(plan_table_index[_table], _replica, PARAM_ROWS_SELECTION)] = _rows
+
+# Q*card类 -> table_offsets
+qcard_table_offsets = {}
+
+## Qcard的参数(rows_tablescan_*, rows_selection_*, rowsize_tablescan_*)存放在params数组中, 按param_index(表, 是否replica, 字段)下标访问
+## 原来的属性名仍然可以读写(Q*card.init, update_param, getattr), 由property映射到数组
+## Qcard直接作为qparams传给代价计算, 不需要复制到Q*params
 class Qcard():
     def __init__(self):
-        self.rows_tablescan_nation = 25 ##tbd
-        self.rows_selection_nation = 25
-        self.rows_tablescan_region = 5 ##tbd
-        self.rows_selection_region = 5 ##tbd
-        self.rows_tablescan_customer = 120000 ##tbd
-        self.rows_selection_customer = 120000
-        self.rows_tablescan_supplier = 10000 ##tbd
-        self.rows_selection_supplier = 10000
-        self.rows_tablescan_item = 100000 ##tbd
-        self.rows_selection_item = 100000 ##tbd
-        self.rows_tablescan_order_line = 1250435 ##tbd
-        self.rows_selection_order_line = 1250435 ##tbd
-        self.rows_tablescan_stock = 400000 ##tbd
-        self.rows_selection_stock = 400000 ##tbd
-        self.rows_tablescan_orders = 125038 ##tbd
-        self.rows_selection_orders = 125038 ##tbd    
-        self.rows_tablescan_district = 40
-        self.rows_selection_district = 40
-        self.rows_tablescan_warehouse = 4
-        self.rows_selection_warehouse = 4
-        self.rows_tablescan_new_order = 36418
-        self.rows_selection_new_order = 36418
-        self.rows_tablescan_history = 124913
-        self.rows_selection_history = 124913
-
-        self.rowsize_tablescan_nation = 0
-        self.rowsize_tablescan_region = 0
-        self.rowsize_tablescan_customer = 0
-        self.rowsize_tablescan_supplier = 0
-        self.rowsize_tablescan_item = 0
-        self.rowsize_tablescan_order_line = 0
-        self.rowsize_tablescan_stock = 0
-        self.rowsize_tablescan_orders = 0
-        self.rowsize_tablescan_district = 0
-        self.rowsize_tablescan_warehouse = 0
-        self.rowsize_tablescan_new_order = 0
-        self.rowsize_tablescan_history = 0
-
-        self.rows_tablescan_nation_replica = 25
-        self.rows_selection_nation_replica = 25
-        self.rows_tablescan_region_replica = 5
-        self.rows_selection_region_replica = 5
-        self.rows_tablescan_customer_replica = 120000
-        self.rows_selection_customer_replica = 120000
-        self.rows_tablescan_supplier_replica = 10000
-        self.rows_selection_supplier_replica = 10000
-        self.rows_tablescan_item_replica = 100000
-        self.rows_selection_item_replica = 100000
-        self.rows_tablescan_order_line_replica = 1250435
-        self.rows_selection_order_line_replica = 1250435
-        self.rows_tablescan_stock_replica = 400000
-        self.rows_selection_stock_replica = 400000
-        self.rows_tablescan_orders_replica = 125038
-        self.rows_selection_orders_replica = 125038
-        self.rows_tablescan_district_replica = 40
-        self.rows_selection_district_replica = 40
-        self.rows_tablescan_warehouse_replica = 4
-        self.rows_selection_warehouse_replica = 4
-        self.rows_tablescan_new_order_replica = 36418
-        self.rows_selection_new_order_replica = 36418
-        self.rows_tablescan_history_replica = 124913
-        self.rows_selection_history_replica = 124913
-
-        self.rowsize_tablescan_nation_replica = 0
-        self.rowsize_tablescan_region_replica = 0
-        self.rowsize_tablescan_customer_replica = 0
-        self.rowsize_tablescan_supplier_replica = 0
-        self.rowsize_tablescan_item_replica = 0
-        self.rowsize_tablescan_order_line_replica = 0
-        self.rowsize_tablescan_stock_replica = 0
-        self.rowsize_tablescan_orders_replica = 0
-        self.rowsize_tablescan_district_replica = 0
-        self.rowsize_tablescan_warehouse_replica = 0
-        self.rowsize_tablescan_new_order_replica = 0
-        self.rowsize_tablescan_history_replica = 0
+        self.params = list(default_params)
 
         # 维护访问replica的表, 记录table_name
         self.scan_table_replica = []
@@ -95,6 +36,15 @@ class Qcard():
         else:
             raise ValueError(f"Attribute {key} does not exist")  
 
+    # self.tables中每个表在params中的起始下标: (原表, replica), 加上PARAM_*得到参数下标
+    # 每个Q*card类的tables固定, 按类缓存
+    def table_offsets(self):
+        offsets = qcard_table_offsets.get(type(self))
+        if offsets is None:
+            offsets = [(param_index(plan_table_index[table], False, 0), param_index(plan_table_index[table], True, 0)) for table in self.tables]
+            qcard_table_offsets[type(self)] = offsets
+        return offsets
+
     # get the card of the table
     # table_idx: the index of the table in self.tables
     # update the row_tablescan params
@@ -108,25 +58,22 @@ class Qcard():
             scanned_partitions = [0, 1, 2, 3]
             scanned_partition_card = partition_meta.count
 
-            # 判断是replica_meta还是table_meta, 相应更新的参数名称不一样
-            if not partition_meta.isreplica: # 不是replica
-                self.update_param('rows_tablescan_' + self.tables[table_idx], scanned_partition_card)
-                self.update_param('rows_selection_' + self.tables[table_idx], scanned_partition_card)            
-                return scanned_partitions, scanned_partition_card
-            else:
-                self.update_param('rows_tablescan_' + self.tables[table_idx] +  '_replica', scanned_partition_card)
-                self.update_param('rows_selection_' + self.tables[table_idx] + '_replica', scanned_partition_card)            
-                return scanned_partitions, scanned_partition_card                
+            # 判断是replica_meta还是table_meta, 相应更新的参数不一样
+            offset = self.table_offsets()[table_idx][1 if partition_meta.isreplica else 0]
+            self.params[offset + PARAM_ROWS] = scanned_partition_card
+            self.params[offset + PARAM_ROWS_SELECTION] = scanned_partition_card
+            return scanned_partitions, scanned_partition_card
         
         # 默认扫描全部分区
-        for i in range(len(partition_meta.partition_range[0])):
-            scanned_partitions.append(i)  
-
+        num_partitions = len(partition_meta.partition_range[0])
+        start_partition = 0
+        end_partition = num_partitions - 1
 
         # print(self.keys[table_idx])
         # print(partition_meta.partition_range)
 
         #遍历这个表所有的过滤条件
+        predicates = []
         for key_idx, key in enumerate(self.keys[table_idx]):
             if key == None:
                 continue
@@ -140,79 +87,66 @@ class Qcard():
             if (key not in candidates[table_idx]['replicas']) and table_idx >= 12:
                 # print("skip original table key")
                 continue
+            predicates.append((key, self.operators[table_idx][key_idx], self.values[table_idx][key_idx]))
 
             # 检查key是否命中分区键
             # 如果是,根据filter operators values从partition_meta类获取基数
             # 否则所有分区都要扫描
-            #print("key_idx: ", key_idx)
             if key != partition_meta.keys[0]:
-                scanned_partition = []
-                for i in range(len(partition_meta.partition_range[0])):
-                    scanned_partition.append(i)
-                # 求各个过滤条件的交集
-                scanned_partitions = list(set(scanned_partitions) & set(scanned_partition))   
-                continue                 
-                    
-            start_partition = 0
-            end_partition = len(partition_meta.partition_range[0]) - 1
-
-
-            # 根据第key_idx个的key operator 和 value 确定需要扫描的分区
-            operator = self.operators[table_idx][key_idx]
-            value = self.values[table_idx][key_idx]
-
-            if operator == 'gt' or operator == 'ge':
-                # 大于或大于等于
-                for i in range(start_partition, end_partition + 1):
-                    #print("debug partition_meta.partition_range[i][0]: ", partition_meta.partition_range[key_idx][i])
-                    #print("debug value: ", value)
-                    if partition_meta.partition_range[0][i] > value:
-                        start_partition = i
-                        break
-            elif operator == 'lt' or operator == 'le':
-                # 小于或小于等于
-                #print("check: ",end_partition, start_partition)
-                for i in range(end_partition, start_partition-1, -1):
-                    #print(i)
-                    # print("check: ",partition_meta.partition_range)
-                    #print("check: ", partition_meta.partition_range[0][i], value)
-                    if partition_meta.partition_range[0][i] < value: 
-                        end_partition = i+1
-                        break
-            elif operator == 'eq':
-                # 等于
-                for i in range(start_partition, end_partition + 1):
-                    if partition_meta.partition_range[0][i] > value:
-                        start_partition = i
-                        end_partition = i
-                        break
-
-            # 计算需要扫描的分区及其基数
-            scanned_partition = []
-            for i in range(start_partition, end_partition + 1):
-                scanned_partition.append(i)
-                # #print("check artition_meta.partition_cnt[i]: ", partition_meta.partition_cnt[i])
-                # scanned_partition_card += partition_meta.partition_cnt[i]
-
-            # 求各个过滤条件的交集
-            scanned_partitions = list(set(scanned_partitions) & set(scanned_partition))
-
-        # 计算需要扫描分区的基数
-        for p in scanned_partitions:
-            scanned_partition_card += partition_meta.partition_cnt[p]
-
-        # 判断是replica_meta还是table_meta, 相应更新的参数名称不一样
-        if not partition_meta.isreplica: # 不是replica
-            self.update_param('rows_tablescan_' + self.tables[table_idx], scanned_partition_card)
-            self.update_param('rows_selection_' + self.tables[table_idx], scanned_partition_card)            
-            return scanned_partitions, scanned_partition_card
-        else:
-            self.update_param('rows_tablescan_' + self.tables[table_idx] +  '_replica', scanned_partition_card)
-            self.update_param('rows_selection_' + self.tables[table_idx] + '_replica', scanned_partition_card)           
+                continue
+
+            # 根据第key_idx个的key operator 和 value 确定需要扫描的分区, 求各个过滤条件的交集
+            key_start, key_end = prune_partition_range(partition_meta.partition_range[0], self.operators[table_idx][key_idx], self.values[table_idx][key_idx])
+            start_partition = max(start_partition, key_start)
+            end_partition = min(end_partition, key_end)
+
+        # 多列分区键: 前面的分区键有等值条件时, 后面分区键的条件也可以裁剪分区
+        if len(partition_meta.keys) > 1:
+            columns_range = self.get_partition_columns_range(partition_meta, predicates)
+            if columns_range is not None:
+                start_partition = max(start_partition, columns_range[0])
+                end_partition = min(end_partition, columns_range[1])
+
+        # 计算需要扫描分区的基数, partition_cnt的前缀和
+        scanned_partitions = list(range(start_partition, end_partition + 1))
+        scanned_partition_card = partition_range_card(partition_meta, start_partition, end_partition)
+
+        # 判断是replica_meta还是table_meta, 相应更新的参数不一样
+        offset = self.table_offsets()[table_idx][1 if partition_meta.isreplica else 0]
+        self.params[offset + PARAM_ROWS] = scanned_partition_card
+        self.params[offset + PARAM_ROWS_SELECTION] = scanned_partition_card
         # print(self.rows_selection_order_line)            
         
         return scanned_partitions, scanned_partition_card
 
+    # 多列分区键的分区区间, 不能裁剪时返回None
+    # predicates: [(key, operator, value)] 这个表上的过滤条件
+    def get_partition_columns_range(self, partition_meta, predicates):
+        eq_prefix = []
+        for key in partition_meta.keys:
+            eq_values = [value for predicate_key, operator, value in predicates if predicate_key == key and operator == 'eq']
+            if not eq_values:
+                break
+            eq_prefix.append(eq_values[0])
+        if not eq_prefix:
+            return None
+        # 所有分区键都是等值条件, 最后一个分区键的等值作为上下界
+        if len(eq_prefix) == len(partition_meta.keys):
+            value = eq_prefix.pop()
+            return prune_partition_columns(partition_meta.partition_range, eq_prefix, value, value)
+
+        next_key = partition_meta.keys[len(eq_prefix)]
+        lower = None
+        upper = None
+        for key, operator, value in predicates:
+            if key != next_key:
+                continue
+            if operator in ('gt', 'ge') and (lower is None or value > lower):
+                lower = value
+            elif operator in ('lt', 'le') and (upper is None or value < upper):
+                upper = value
+        return prune_partition_columns(partition_meta.partition_range, eq_prefix, lower, upper)
+
 
 
     # # get the card of the key_idx-th operator
@@ -394,14 +328,9 @@ class Qcard():
             rowsize_replica += primary_keys_size
 
             ## 根据query读取行存replica的情况更新rowsize
-            if scan_row:
-                self.update_param('rowsize_tablescan_' + table_name, rowsize)
-            else:
-                self.update_param('rowsize_tablescan_' + table_name, 0)
-            if scan_replica:
-                self.update_param('rowsize_tablescan_' + table_name + '_replica', rowsize_replica)
-            else:
-                self.update_param('rowsize_tablescan_' + table_name + '_replica', 0)
+            offset, replica_offset = self.table_offsets()[table_idx]
+            self.params[offset + PARAM_ROWSIZE] = rowsize if scan_row else 0
+            self.params[replica_offset + PARAM_ROWSIZE] = rowsize_replica if scan_replica else 0
 
 
 
@@ -935,6 +864,10 @@ class Q22card(Qcard):
         self.operators = [['gt'], []] # filter operators '>'             
 
 
+# 22条query的Qcard类, 下标和qry_idx一致
+qcard_classes = [Q1card, Q2card, Q3card, Q4card, Q5card, Q6card, Q7card, Q8card, Q9card, Q10card, Q11card, Q12card, Q13card, Q14card, Q15card, Q16card, Q17card, Q18card, Q19card, Q20card, Q21card, Q22card]
+
+
 # 根据分区metadata, 获取每一个query的查询基数
 #def get_qcard(customer_meta, district_meta, history_meta, item_meta, nation_meta, new_order_meta, order_line_meta, orders_meta, region_meta, stock_meta, supplier_meta, warehouse_meta):
 def get_qcard(table_meta, qcard_list, candidates):
@@ -1074,23 +1007,24 @@ def get_qcard(table_meta, qcard_list, candidates):
 
     # return qcard
 
+# Qcard的参数已经按param_index存放在params数组中, 直接作为第qry_idx条query的qparams使用
+def qcard_to_qparams(qry_idx, qcard):
+    return qcard
+
 def update_qparams_with_qcard(qcard_list):
-    qparams_list = []
-    
-    for i, qcard in enumerate(qcard_list, start=1):
-        qparams_class_name = f"Q{i}params"
-        qparams = globals()[qparams_class_name]()
-        
-        # Copy attributes from qcard to qparams
-        for attr in dir(qcard):
-            # print("attr: ", attr)
-            if not attr.startswith('__') and not callable(getattr(qcard, attr)):
-                setattr(qparams, attr, getattr(qcard, attr))
-        
-        qparams_list.append(qparams)
-        # print("qparams.rows_tablescan_order_line_replica: ", qparams.rows_tablescan_order_line_replica)
-    
-    return qparams_list    
+    return list(qcard_list)
+
+
+# 参数的属性名映射到params数组
+def make_param_property(i):
+    def get_param(self):
+        return self.params[i]
+    def set_param(self, value):
+        self.params[i] = value
+    return property(get_param, set_param)
+
+for _i, _name in enumerate(param_names):
+    setattr(Qcard, _name, make_param_property(_i))
 
 
 # 示例使用
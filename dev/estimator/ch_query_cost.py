@@ -2,6 +2,9 @@ import os
 import sys
 import logging
 import copy
+import math
+
+import numpy as np
 
 sys.path.append(os.path.expanduser("/data3/dzh/project/grep/dev"))
 
@@ -11,6 +14,7 @@ from estimator.ch_partition_meta import *
 from estimator.ch_query_card import *
 from estimator.query_operators import query_operators
 from estimator.ch_columns_ranges_meta import *
+from estimator.plan_cost import calculate_plan_query_cost, get_plan_cost_model
 from log.logging_config import setup_logging
 
 ##
@@ -51,8 +55,251 @@ def update_query_operators_with_replica(qry_idx, qparams_list, query_operators):
         #     print("scan_table_replica: ", scan_table_replica)
     return local_query_operators
 
+## 编译后的query代价计划
+## calculate_query_cost_interpreted每次调用都要deepcopy query_operators, 用f-string拼属性名再getattr, 实例化算子类(每个算子还会新建Global_Params)
+## CompiledQueryPlan把每条query的算子列表编译一次, 得到(算子类型, 表下标, engine, 是否replica)元组的列表
+## 代价在数值参数向量上计算, 结果和calculate_query_cost_interpreted一致
+
+OP_TABLESCAN = 0
+OP_SELECTION = 1
+OP_TABLEREADER = 2
+OP_HASHJOIN = 3
+operator_kinds = {"TableScan": OP_TABLESCAN, "Selection": OP_SELECTION, "TableReader": OP_TABLEREADER}
+
+# 参数向量的布局(plan_tables, param_index, param_names)在ch_query_params中定义, Qcard的params数组使用相同的布局
+
+
+class CompiledQueryPlan:
+    def __init__(self, qry_idx):
+        self.qry_idx = qry_idx
+        query_info = query_operators[qry_idx]
+
+        # calculate_query_cost里engine固定为Tikv, replica额外的HashJoin在Tiflash上
+        self.base_ops = []
+        self.replica_ops = {}
+        for operator, table in zip(query_info["operators"], query_info["tables"]):
+            kind = operator_kinds.get(operator)
+            if kind is None:
+                continue
+            table_idx = plan_table_index[table]
+            self.base_ops.append((kind, table_idx, 'Tikv', False))
+            # 读取这个表的replica时, 对原表的每个算子加一个replica算子和一个HashJoin
+            ops = self.replica_ops.setdefault(table, [])
+            ops.append((kind, table_idx, 'Tikv', True))
+            ops.append((OP_HASHJOIN, table_idx, 'Tiflash', True))
+
+        # 用到的参数下标, 参数向量只需要填这些位置
+        used = set()
+        for table in set(query_info["tables"]):
+            table_idx = plan_table_index[table]
+            for replica in (False, True):
+                for field in range(len(param_fields)):
+                    used.add(param_index(table_idx, replica, field))
+        self.param_idxs = sorted(used)
+
+        # 每个表主键的数量, HashJoin的nKeys
+        self.nkeys = {}
+        for table in set(query_info["tables"]):
+            table_columns_class = globals()[f"{table.capitalize()}_columns"]
+            self.nkeys[plan_table_index[table]] = len(table_columns_class().primary_keys)
+
+        global_params = Global_Params()
+        self.scan_factors = {'Tikv': global_params.tikv_scan_factor, 'Tiflash': global_params.tiflash_scan_factor}
+        self.cpu_factors = {'Tidb': global_params.tidb_cpu_factor, 'Tikv': global_params.tikv_cpu_factor, 'Tiflash': global_params.tiflash_cpu_factor}
+        self.mem_factors = {'Tidb': global_params.tidb_mem_factor, 'Tikv': global_params.tikv_mem_factor, 'Tiflash': global_params.tiflash_mem_factor}
+        self.net_factors = {'Tidb': global_params.tidb_flash_net_factor, 'Tikv': global_params.tidb_kv_net_factor, 'Tiflash': global_params.tiflash_mpp_net_factor}
+
+    # 从qparams构建参数向量. Qcard本身就是按param_index存放的数组, 直接使用
+    def param_vector(self, qparams):
+        params = getattr(qparams, 'params', None)
+        if params is not None:
+            return params
+        values = vars(qparams)
+        vector = [0] * len(param_names)
+        for i in self.param_idxs:
+            vector[i] = values[param_names[i]]
+        return vector
+
+    # 和TableScan/Selection/TableReader/HashJoin.calculate_cost的公式一致
+    def operator_cost(self, op, vector):
+        kind, table_idx, engine, replica = op
+        if kind == OP_TABLESCAN:
+            rowsize = vector[param_index(table_idx, replica, PARAM_ROWSIZE)]
+            if rowsize == 0:  ## 不读取这个表
+                return 0
+            rows = vector[param_index(table_idx, replica, PARAM_ROWS)]
+            scan_factor = self.scan_factors.get(engine, 0)
+            return rows * math.log2(rowsize) * scan_factor + (10000 * math.log2(rowsize) * scan_factor)
+        elif kind == OP_SELECTION:
+            rows_selection = vector[param_index(table_idx, replica, PARAM_ROWS_SELECTION)]
+            return rows_selection * self.cpu_factors.get(engine, 0) * 1
+        elif kind == OP_TABLEREADER:
+            rows = vector[param_index(table_idx, replica, PARAM_ROWS)]
+            rowsize = vector[param_index(table_idx, replica, PARAM_ROWSIZE)]
+            if engine in self.net_factors:
+                return rows * rowsize * self.net_factors[engine] / 4
+            return rows * rowsize * 10 / 1
+        elif kind == OP_HASHJOIN:
+            # build: 原表, probe: replica
+            build_rows = vector[param_index(table_idx, False, PARAM_ROWS)]
+            build_rowsize = vector[param_index(table_idx, False, PARAM_ROWSIZE)]
+            probe_rows = vector[param_index(table_idx, True, PARAM_ROWS)]
+            probe_rowsize = vector[param_index(table_idx, True, PARAM_ROWSIZE)]
+            nkeys = self.nkeys[table_idx]
+            cpu_factor = self.cpu_factors.get(engine, 0)
+            mem_factor = self.mem_factors.get(engine, 0)
+            concurrency = 3 if engine == 'Tiflash' else 5
+            cost = (build_rows * 1 * cpu_factor + build_rows * nkeys * cpu_factor + build_rows * build_rowsize * mem_factor + build_rows * cpu_factor + probe_rows * 1 * cpu_factor + probe_rows * nkeys * cpu_factor + probe_rows * probe_rowsize * mem_factor + probe_rows * cpu_factor) / concurrency
+            if engine == 'Tiflash':
+                return cost
+            return cost + 10*3*cpu_factor   ## startup cost
+        return 0
+
+    # scan_table_replica: query要读取replica的表, 和Qcard.scan_table_replica一致
+    def evaluate(self, vector, scan_table_replica):
+        cost = 0
+        for op in self.base_ops:
+            cost += self.operator_cost(op, vector)
+        for table in scan_table_replica:
+            for op in self.replica_ops.get(table, ()):
+                cost += self.operator_cost(op, vector)
+        return cost
+
+    ## 批量计算: N个配置的参数向量组成N×K矩阵, 所有配置一起用NumPy计算
+    # matrix: N×K, 每行是一个配置的param_vector
+    # replica_counts: N×12, 每个配置的scan_table_replica中各个表出现的次数
+    def evaluate_batch(self, matrix, replica_counts):
+        cost = np.zeros(matrix.shape[0])
+        for op in self.base_ops:
+            cost += self.operator_cost_batch(op, matrix)
+        for table, ops in self.replica_ops.items():
+            counts = replica_counts[:, plan_table_index[table]]
+            if not counts.any():
+                continue
+            table_cost = np.zeros(matrix.shape[0])
+            for op in ops:
+                table_cost += self.operator_cost_batch(op, matrix)
+            cost += counts * table_cost
+        return cost
+
+    # operator_cost的向量版本, 返回N个配置上这个算子的代价
+    def operator_cost_batch(self, op, matrix):
+        kind, table_idx, engine, replica = op
+        if kind == OP_TABLESCAN:
+            rowsize = matrix[:, param_index(table_idx, replica, PARAM_ROWSIZE)]
+            rows = matrix[:, param_index(table_idx, replica, PARAM_ROWS)]
+            scan_factor = self.scan_factors.get(engine, 0)
+            read = rowsize != 0  ## rowsize为0表示不读取这个表
+            log_rowsize = np.log2(np.where(read, rowsize, 1))
+            return np.where(read, rows * log_rowsize * scan_factor + (10000 * log_rowsize * scan_factor), 0)
+        elif kind == OP_SELECTION:
+            rows_selection = matrix[:, param_index(table_idx, replica, PARAM_ROWS_SELECTION)]
+            return rows_selection * self.cpu_factors.get(engine, 0) * 1
+        elif kind == OP_TABLEREADER:
+            rows = matrix[:, param_index(table_idx, replica, PARAM_ROWS)]
+            rowsize = matrix[:, param_index(table_idx, replica, PARAM_ROWSIZE)]
+            if engine in self.net_factors:
+                return rows * rowsize * self.net_factors[engine] / 4
+            return rows * rowsize * 10 / 1
+        elif kind == OP_HASHJOIN:
+            build_rows = matrix[:, param_index(table_idx, False, PARAM_ROWS)]
+            build_rowsize = matrix[:, param_index(table_idx, False, PARAM_ROWSIZE)]
+            probe_rows = matrix[:, param_index(table_idx, True, PARAM_ROWS)]
+            probe_rowsize = matrix[:, param_index(table_idx, True, PARAM_ROWSIZE)]
+            nkeys = self.nkeys[table_idx]
+            cpu_factor = self.cpu_factors.get(engine, 0)
+            mem_factor = self.mem_factors.get(engine, 0)
+            concurrency = 3 if engine == 'Tiflash' else 5
+            cost = (build_rows * 1 * cpu_factor + build_rows * nkeys * cpu_factor + build_rows * build_rowsize * mem_factor + build_rows * cpu_factor + probe_rows * 1 * cpu_factor + probe_rows * nkeys * cpu_factor + probe_rows * probe_rowsize * mem_factor + probe_rows * cpu_factor) / concurrency
+            if engine == 'Tiflash':
+                return cost
+            return cost + 10*3*cpu_factor   ## startup cost
+        return np.zeros(matrix.shape[0])
+
+# 每条query的编译计划, 第一次使用时编译
+compiled_query_plans = {}
+
+def get_compiled_query_plan(qry_idx):
+    plan = compiled_query_plans.get(qry_idx)
+    if plan is None:
+        plan = CompiledQueryPlan(qry_idx)
+        compiled_query_plans[qry_idx] = plan
+    return plan
+
+# Global_Params或query_operators变化后, 清空编译计划
+def reset_compiled_query_plans():
+    compiled_query_plans.clear()
+
+## query代价模型
+## 'operators': query_operators编译的计划, 只计算每个表的TableScan/Selection/TableReader
+## 'plan': estimator.plan_cost基于EXPLAIN计划树的模型, 计入连接/聚合/排序/投影. 没有有效计划的query仍按'operators'计算
+query_cost_models = ('operators', 'plan')
+query_cost_model = 'operators'
+
+def set_query_cost_model(model):
+    global query_cost_model
+    if model not in query_cost_models:
+        raise ValueError(f"Unknown query cost model '{model}', expected one of {query_cost_models}")
+    query_cost_model = model
+
+def get_query_cost_model():
+    return query_cost_model
+
+## 'plan'模型每条query的缩放系数 qry_idx -> scale, 计划树代价乘以scale
+## 各query的计划树代价量级相差很大(Q9的笛卡尔积估计约1.5e12行, 投影/聚合的代价约2.7e14), 直接求和时一条query决定整个workload的代价
+## advisor.calibrate_reward_normalization按默认配置设置 scale = 'operators'代价 / 'plan'代价,
+## 每条query在默认配置下的代价和'operators'模型相同, 'plan'模型只决定代价随配置的相对变化. 没有缩放系数的query不缩放
+plan_query_scales = {}
+
+def set_plan_query_scales(scales):
+    global plan_query_scales
+    plan_query_scales = dict(scales or {})
+
+def get_plan_query_scales():
+    return plan_query_scales
+
 # 计算指定第qry_idx条query的代价
 def calculate_query_cost(qry_idx, qparams_list):
+    if query_cost_model == 'plan' and get_plan_cost_model().has_plan(qry_idx):
+        return calculate_plan_query_cost(qry_idx, qparams_list) * plan_query_scales.get(qry_idx, 1.0)
+    qparams = qparams_list[qry_idx]
+    plan = get_compiled_query_plan(qry_idx)
+    return plan.evaluate(plan.param_vector(qparams), qparams.scan_table_replica)
+
+## 批量计算N个配置所有query的代价
+## 每个配置的qparams编码成 N×22×K 的参数矩阵(每条query每个(表, 是否replica)的rows/rowsize)和 N×22×12 的replica读取次数
+class QueryParamsBatch:
+    def __init__(self, n):
+        self.params = np.zeros((n, len(query_operators), len(param_names)))
+        self.replica_counts = np.zeros((n, len(query_operators), len(plan_tables)))
+
+    # 第row个配置的qparams_list
+    def set_row(self, row, qparams_list):
+        for qry_idx in range(len(query_operators)):
+            qparams = qparams_list[qry_idx]
+            plan = get_compiled_query_plan(qry_idx)
+            self.params[row, qry_idx] = plan.param_vector(qparams)
+            for table in qparams.scan_table_replica:
+                self.replica_counts[row, qry_idx, plan_table_index[table]] += 1
+
+# 返回 N×22 的代价矩阵
+def calculate_query_costs_batch(params_batch):
+    costs = np.zeros(params_batch.params.shape[:2])
+    model = get_plan_cost_model() if query_cost_model == 'plan' else None
+    for qry_idx in range(len(query_operators)):
+        if model is not None and model.has_plan(qry_idx):
+            # 计划树模型逐个配置计算
+            for row in range(costs.shape[0]):
+                scan_table_replica = [plan_tables[t] for t in np.nonzero(params_batch.replica_counts[row, qry_idx])[0]]
+                costs[row, qry_idx] = model.evaluate(qry_idx, params_batch.params[row, qry_idx], scan_table_replica)
+            costs[:, qry_idx] *= plan_query_scales.get(qry_idx, 1.0)
+            continue
+        plan = get_compiled_query_plan(qry_idx)
+        costs[:, qry_idx] = plan.evaluate_batch(params_batch.params[:, qry_idx], params_batch.replica_counts[:, qry_idx])
+    return costs
+
+# 计算指定第qry_idx条query的代价, 逐个实例化算子解释执行. 和calculate_query_cost结果一致, 用于核对编译计划
+def calculate_query_cost_interpreted(qry_idx, qparams_list):
     local_query_operators = update_query_operators_with_replica(qry_idx, qparams_list, query_operators)
     query_info = local_query_operators[qry_idx]
     operators = query_info["operators"]
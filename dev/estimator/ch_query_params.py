@@ -1,3 +1,23 @@
+## 每条query的代价参数按(表, 是否replica, 字段)编号, 存放在一个数组中
+## Qcard的params数组和CompiledQueryPlan的参数向量都使用这个布局
+plan_tables = ['customer', 'district', 'history', 'item', 'nation', 'new_order', 'order_line', 'orders', 'region', 'stock', 'supplier', 'warehouse']
+plan_table_index = {table: idx for idx, table in enumerate(plan_tables)}
+PARAM_ROWS = 0 # rows_tablescan
+PARAM_ROWSIZE = 1 # rowsize_tablescan
+PARAM_ROWS_SELECTION = 2 # rows_selection
+param_fields = ['rows_tablescan', 'rowsize_tablescan', 'rows_selection']
+
+def param_index(table_idx, replica, field):
+    return (table_idx * 2 + int(replica)) * 3 + field
+
+# param_names[i]: 第i个参数原来的属性名, 例如 rows_tablescan_order_line_replica
+param_names = [None] * (len(plan_tables) * 2 * 3)
+for _table_idx, _table in enumerate(plan_tables):
+    for _replica in (False, True):
+        for _field, _field_name in enumerate(param_fields):
+            param_names[param_index(_table_idx, _replica, _field)] = f"{_field_name}_{_table}" + ("_replica" if _replica else "")
+param_name_index = {name: i for i, name in enumerate(param_names)}
+
 
 
 
@@ -0,0 +1,202 @@
+import re
+import logging
+
+import numpy as np
+
+from estimator import operators
+from estimator.operators import calibrated_factors, get_factor_profile, set_factor_profile, save_factor_profile, Global_Params
+from estimator.plan_cache import get_plan_cache, read_sql_file, workload_sql_file
+from estimator.plan_cost import PlanCostModel, build_plan_tree, sql_table_aliases
+from estimator.ch_query_card import default_params
+
+## 代价因子校准
+## Global_Params的因子(tikv_scan_factor=40.7等)是TiDB默认硬件上的值, 实际的TiKV/TiFlash硬件不同
+## 1. 分批对workload执行EXPLAIN ANALYZE, 结果保存在计划缓存中(estimator/plan_cache.py)
+## 2. 用PlanCostModel按实际行数(actRows)实例化每个算子; 算子的代价对因子是线性的,
+##    只把一个因子设为1其余设为0计算代价, 就得到这个因子的系数. 所有算子的系数组成 N×F 的矩阵
+## 3. 每个engine分别用非负最小二乘拟合: 系数矩阵 × 因子 ≈ 算子自身的执行时间(execution info的time减去子算子的time)
+## 4. 拟合的因子整体缩放到和默认因子相同的代价量级(normalize_reward依赖代价的量级), 写入版本化的配置文件, Global_Params启动时加载
+
+# 每个engine的算子用到的因子, TableReader的engine是数据来源的engine
+engine_factors = {
+    'Tidb': ['tidb_cpu_factor', 'tidb_mem_factor', 'tidb_disk_factor'],
+    'Tikv': ['tikv_scan_factor', 'tikv_cpu_factor', 'tikv_mem_factor', 'tidb_kv_net_factor'],
+    'Tiflash': ['tiflash_scan_factor', 'tiflash_cpu_factor', 'tiflash_mem_factor', 'tidb_flash_net_factor', 'tiflash_mpp_net_factor'],
+}
+
+# execution info中的时间, root算子是 time:1.2ms, cop算子是 tikv_task:{time:5ms, ...}
+execution_time_pattern = re.compile(r'time:\s*(\d+(?:\.\d+)?)\s*(ns|µs|us|ms|s)')
+time_units = {'ns': 1e-6, 'µs': 1e-3, 'us': 1e-3, 'ms': 1.0, 's': 1000.0}
+
+# 返回毫秒, 没有时间信息时返回None
+def parse_execution_time(execution_info):
+    match = execution_time_pattern.search(execution_info or '')
+    if match is None:
+        return None
+    value, unit = match.groups()
+    return float(value) * time_units[unit]
+
+# 算子自身的执行时间: 算子的时间减去最慢的子算子
+def exclusive_time(node):
+    total = parse_execution_time(node.execution_info)
+    if total is None:
+        return None
+    child_times = [t for t in (parse_execution_time(child.execution_info) for child in node.children) if t is not None]
+    return max(total - max(child_times, default=0.0), 0.0)
+
+def walk_plan(root):
+    stack = [root] + root.ctes
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(node.children)
+
+
+class OperatorTimings:
+    def __init__(self):
+        self.operators = [] # operators中的算子对象, 行数是actRows
+        self.engines = []
+        self.times = [] # 算子自身的执行时间(ms)
+        self.missing = 0 # 计划缓存中没有EXPLAIN ANALYZE结果的query数
+
+    def __len__(self):
+        return len(self.operators)
+
+    # 从一条query的EXPLAIN ANALYZE结果中收集算子
+    def add_plan(self, columns, rows, aliases):
+        root = build_plan_tree(rows, columns, aliases)
+        if root is None:
+            return
+        for node in walk_plan(root):
+            if node.act_rows is not None:
+                node.est_rows = node.act_rows
+        # default_params是全表的行数, 扫描的裁剪比例为1, 每个算子的行数就是actRows
+        model = PlanCostModel({0: root})
+        model.trace = []
+        model.evaluate(0, default_params, [])
+        for node, operator in model.trace:
+            elapsed = exclusive_time(node)
+            if elapsed is None:
+                continue
+            self.operators.append(operator)
+            self.engines.append(operator.engine)
+            self.times.append(elapsed)
+
+    # N×F的系数矩阵: 第j列是只有第j个因子为1时每个算子的代价
+    def coefficients(self):
+        matrix = np.zeros((len(self.operators), len(calibrated_factors)))
+        profile = get_factor_profile()
+        try:
+            for j, name in enumerate(calibrated_factors):
+                set_factor_profile({factor: 1.0 if factor == name else 0.0 for factor in calibrated_factors})
+                matrix[:, j] = [operator.calculate_cost() for operator in self.operators]
+        finally:
+            set_factor_profile(profile)
+        return matrix
+
+
+# 分批执行EXPLAIN ANALYZE, 每批之后保存计划缓存, 中断后已经抓取的结果不会丢失
+def capture_operator_timings(connection, sql_list, cache=None, batch_size=8, cache_path=None, layout=None):
+    cache = cache if cache is not None else get_plan_cache()
+    pending = [sql for sql in sql_list if cache.get(sql, 'explain_analyze', layout) is None]
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        cache.capture(connection, batch, ('explain_analyze',), layout)
+        if cache_path is not None:
+            cache.save(cache_path)
+        logging.info(f"Calibration: captured {min(start + batch_size, len(pending))}/{len(pending)} queries")
+    return cache
+
+def collect_operator_timings(sql_list, cache=None, layout=None):
+    cache = cache if cache is not None else get_plan_cache()
+    timings = OperatorTimings()
+    for sql in sql_list:
+        entry = cache.get(sql, 'explain_analyze', layout)
+        if entry is None:
+            timings.missing += 1
+            continue
+        timings.add_plan(entry[0], entry[1], sql_table_aliases(sql))
+    return timings
+
+# 非负最小二乘: 解出负的因子时去掉最小的一列重新求解
+def nonnegative_lstsq(A, y):
+    # 各列的量级差别很大(扫描的系数远大于内存的系数), 先按列范数缩放
+    norms = np.linalg.norm(A, axis=0)
+    norms[norms == 0] = 1.0
+    scaled = A / norms
+    keep = np.ones(A.shape[1], dtype=bool)
+    x = np.zeros(A.shape[1])
+    while keep.any():
+        solution, _, _, _ = np.linalg.lstsq(scaled[:, keep], y, rcond=None)
+        if (solution >= 0).all():
+            x[keep] = solution
+            break
+        keep[np.flatnonzero(keep)[np.argmin(solution)]] = False
+    return x / norms
+
+# 返回 (因子, 拟合信息). 样本不足或者拟合结果为0的因子保留默认值
+def fit_factors(timings, min_samples=5):
+    profile = get_factor_profile()
+    set_factor_profile({})
+    try:
+        global_params = Global_Params()
+    finally:
+        set_factor_profile(profile)
+    defaults = np.array([getattr(global_params, name) for name in calibrated_factors])
+
+    coefficients = timings.coefficients()
+    times = np.array(timings.times)
+    engines = np.array(timings.engines)
+    fitted = np.full(len(calibrated_factors), np.nan)
+    fit = {}
+    for engine, names in engine_factors.items():
+        rows = engines == engine
+        columns = np.array([calibrated_factors.index(name) for name in names])
+        A = coefficients[rows][:, columns]
+        active = A.any(axis=0)
+        if rows.sum() < max(min_samples, active.sum()):
+            logging.info(f"Calibration: {engine} has {int(rows.sum())} operator samples, keep default factors")
+            continue
+        x = np.zeros(len(columns))
+        x[active] = nonnegative_lstsq(A[:, active], times[rows])
+        fitted[columns[x > 0]] = x[x > 0]
+        residual = A @ x - times[rows]
+        fit[engine] = {'samples': int(rows.sum()), 'rmse_ms': float(np.sqrt(np.mean(residual ** 2))), 'total_ms': float(times[rows].sum())}
+
+    # 拟合的因子单位是毫秒, 整体缩放到默认因子的代价量级, 只改变因子之间的比例
+    calibrated = ~np.isnan(fitted)
+    factors = defaults.copy()
+    if calibrated.any():
+        default_cost = (coefficients[:, calibrated] @ defaults[calibrated]).sum()
+        fitted_cost = (coefficients[:, calibrated] @ fitted[calibrated]).sum()
+        scale = default_cost / fitted_cost if fitted_cost > 0 else 1.0
+        factors[calibrated] = fitted[calibrated] * scale
+        fit['scale'] = float(scale)
+    fit['calibrated'] = [name for name, flag in zip(calibrated_factors, calibrated) if flag]
+    return {name: float(value) for name, value in zip(calibrated_factors, factors)}, fit
+
+def calibrate(sql_list, cache=None, min_samples=5):
+    timings = collect_operator_timings(sql_list, cache)
+    if timings.missing:
+        logging.info(f"Calibration: {timings.missing} queries have no EXPLAIN ANALYZE in the plan cache")
+    factors, fit = fit_factors(timings, min_samples)
+    fit['operators'] = len(timings)
+    return factors, fit
+
+
+if __name__ == "__main__":
+    import sys
+    from estimator.plan_cache import plan_cache_path
+    # python -m estimator.cost_calibration [workload.sql] [capture]
+    # 指定capture时先连接TiDB分批抓取缓存中缺少的EXPLAIN ANALYZE
+    sql_file = sys.argv[1] if len(sys.argv) > 1 else workload_sql_file
+    sql_list = read_sql_file(sql_file)
+    if len(sys.argv) > 2 and sys.argv[2] == 'capture':
+        from config import get_connection
+        with get_connection(autocommit=False) as connection:
+            capture_operator_timings(connection, sql_list, cache_path=plan_cache_path)
+
+    factors, fit = calibrate(sql_list)
+    save_factor_profile(operators.factor_profile_path, factors, fit)
+    print(fit)
+    print(factors)
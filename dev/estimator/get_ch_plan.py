@@ -6,12 +6,7 @@ import time
 
 sys.path.append(os.path.expanduser("/data3/dzh/project/grep/dev"))
 
-import mysql.connector
-from mysql.connector import MySQLConnection
-from mysql.connector.cursor import MySQLCursor
-from config import *
-from collector import replica_progresss_collector
-from collector import sync_metrics_collector
+from estimator.plan_cache import get_plan_cache, read_sql_file, workload_sql_file
 
 
 # def get_connection(autocommit: bool = True) -> MySQLConnection:
@@ -41,12 +36,12 @@ def read_queries_from_file(file_path):
         queries = f.readlines()
     return [query.strip() for query in queries]
 
-# 执行EXPLAIN ANALYZE并解析结果
-def get_explain_analyze(conn, query):
-    with conn.cursor() as cursor:
-        cursor.execute(f"EXPLAIN ANALYZE {query}")
-        result = cursor.fetchall()
-    return result
+# 从计划缓存读取EXPLAIN ANALYZE的结果, 缓存由 python -m estimator.plan_cache capture 批量抓取
+def get_explain_analyze(query):
+    entry = get_plan_cache().get(query, 'explain_analyze')
+    if entry is None:
+        return []
+    return entry[1]
 
 def extract_operators(explain_result):
     operators = set()
@@ -59,18 +54,19 @@ def extract_operators(explain_result):
 # 主程序
 def main():
     # 读取查询文件
-    queries = read_queries_from_file('../workload/workload.bak.sql')
+    queries = read_sql_file(workload_sql_file)
     
-    # 创建数据库连接
-    with get_connection(autocommit=False) as conn:
-        # 遍历每个查询
-        for query in queries:
-            #print(f"Executing query: {query}")
-            explain_result = get_explain_analyze(conn, query)
-            operators = extract_operators(explain_result)
-            
-            # 输出算子名称
-            #print(f"Operators for the query: {operators}")
+    # 遍历每个查询
+    for query in queries:
+        #print(f"Executing query: {query}")
+        explain_result = get_explain_analyze(query)
+        if not explain_result:
+            print(f"No cached plan for query: {query[:80]}")
+            continue
+        operators = extract_operators(explain_result)
+        
+        # 输出算子名称
+        #print(f"Operators for the query: {operators}")
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,8 @@
+import os
 import math
+import json
+import hashlib
+import logging
 
 #from ch_query_params import Q1params,Q2params,Q3params,Q4params,Q5params,Q6params,Q7params,Q8params,Q9params,Q10params,Q11params,Q12params,Q13params,Q14params,Q15params,Q16params,Q17params,Q18params,Q19params,Q20params,Q21params,Q22params
 
@@ -47,6 +51,69 @@ class Global_Params:
         self.tidb_disk_factor = 200.0  # TiDBDisk
         self.tidb_request_factor = 6000000.0  # TiDBRequest   
         self.memQuota = 1024*1024  #memory quota 1GB
+        # 校准得到的代价因子覆盖默认值
+        for name, value in get_factor_profile().items():
+            setattr(self, name, value)
+
+## 代价因子配置
+## Global_Params的默认因子是TiDB默认硬件上的值, estimator/cost_calibration.py用EXPLAIN ANALYZE测得的算子时间拟合出新的因子
+## 配置文件是json: {"format": "jasper-cost-factors", "version": 1, "factors": {...}}, 第一次构造Global_Params时加载
+## 修改因子后要调用ch_query_cost.reset_compiled_query_plans, 编译计划缓存了因子
+FACTOR_PROFILE_FORMAT = 'jasper-cost-factors'
+FACTOR_PROFILE_VERSION = 1
+
+# 可以校准的因子
+calibrated_factors = ['tikv_scan_factor', 'tiflash_scan_factor', 'tidb_cpu_factor', 'tikv_cpu_factor', 'tiflash_cpu_factor',
+                      'tidb_kv_net_factor', 'tidb_flash_net_factor', 'tiflash_mpp_net_factor',
+                      'tidb_mem_factor', 'tikv_mem_factor', 'tiflash_mem_factor', 'tidb_disk_factor']
+
+factor_profile = None
+factor_profile_path = 'Output/cost_factors_ch.json'
+
+def set_factor_profile(factors):
+    global factor_profile
+    factor_profile = dict(factors)
+
+# 文件不存在时使用默认因子
+def load_factor_profile(path=None):
+    global factor_profile, factor_profile_path
+    if path is not None:
+        factor_profile_path = path
+    factor_profile = {}
+    if not os.path.exists(factor_profile_path):
+        return factor_profile
+    with open(factor_profile_path, 'r', encoding='utf-8') as f:
+        profile = json.load(f)
+    if profile.get('format') != FACTOR_PROFILE_FORMAT or profile.get('version') != FACTOR_PROFILE_VERSION:
+        raise ValueError(f"Unsupported cost factor profile in {factor_profile_path}")
+    factor_profile = {name: float(value) for name, value in profile['factors'].items() if name in calibrated_factors}
+    logging.info(f"load cost factors from {factor_profile_path}: {factor_profile}")
+    return factor_profile
+
+def get_factor_profile():
+    if factor_profile is None:
+        load_factor_profile()
+    return factor_profile
+
+# 因子的指纹, 作为reward缓存tag的一部分. 重新校准后, 按旧因子计算的reward不再使用
+def factor_profile_fingerprint(factors=None):
+    if factors is None:
+        factors = get_factor_profile()
+    encoded = json.dumps({name: repr(float(value)) for name, value in factors.items()}, sort_keys=True)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()[:12]
+
+def save_factor_profile(path, factors, fit=None):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    profile = {'format': FACTOR_PROFILE_FORMAT, 'version': FACTOR_PROFILE_VERSION, 'factors': factors}
+    if fit is not None:
+        profile['fit'] = fit
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, indent=2)
+    os.replace(tmp_path, path)
+
 
 class Operator_Params:
     def __init__(self, rows, rowSize, buildRows, buildRowSize, probeRows, probeRowSize, aggFuncs, numFuncs, nKeys, sortitems, leftRows, leftRowSize, rightRows, rightRowSize, buildFilters, probeFilters):
@@ -113,8 +180,8 @@ class HashAgg(TreeNode):
     def __init__(self, content, rows, aggFuncs, numFuncs, buildRows, buildRowSize, nKeys, probeRows):
         super().__init__(content)
         self.rows = rows
-        self.aggFunc = aggFuncs
-        self.numFUncs = numFuncs
+        self.aggFuncs = aggFuncs
+        self.numFuncs = numFuncs
         self.buildRows = buildRows
         self.buildRowSize = buildRowSize
         self.nKeys = nKeys
@@ -123,7 +190,7 @@ class HashAgg(TreeNode):
         global_params = Global_Params()
         if self.engine == "Tidb":
             cpuFactor = global_params.tidb_cpu_factor
-            memFactor = Global_Params.tidb_mem_factor
+            memFactor = global_params.tidb_mem_factor
             concurrency = 4
         elif self.engine == "Tikv":
             cpuFactor = global_params.tikv_cpu_factor
@@ -149,7 +216,8 @@ class Sort(TreeNode):
         self.numFuncs = numFuncs
 
     def calculate_cost(self):
-        global_params = global_params()
+        global_params = Global_Params()
+        ## 只有TiDB会把超出memory quota的数据落盘, TiKV/TiFlash没有disk factor
         if self.engine == "Tidb":
             cpuFactor = global_params.tidb_cpu_factor
             memFactor = global_params.tidb_mem_factor
@@ -157,17 +225,17 @@ class Sort(TreeNode):
         elif self.engine == "Tikv":
             cpuFactor = global_params.tikv_cpu_factor
             memFactor = global_params.tikv_mem_factor
-            diskFactor = global_params.tikv_disk_factor
+            diskFactor = 0
         elif self.engine == "Tiflash":
             cpuFactor = global_params.tiflash_cpu_factor
             memFactor = global_params.tiflash_mem_factor
-            diskFactor = global_params.tiflash_disk_factor
+            diskFactor = 0
         else:
             cpuFactor = 0
             memFactor = 0 
             diskFactor = 0      
-        cost = self.rows * math.log2(self.rows) * len(self.sortitems) * cpuFactor
-        if self.rows * self.rowSize > global_params.mem_quota:   ## memory quota exceeded
+        cost = self.rows * math.log2(max(self.rows, 1)) * len(self.sortitems) * cpuFactor
+        if self.rows * self.rowSize > global_params.memQuota:   ## memory quota exceeded
             cost += global_params.memQuota*memFactor + self.rows * self.rowSize * diskFactor
         else:
             cost += self.rows * self.rowSize * memFactor
@@ -179,7 +247,7 @@ class MergeJoin(TreeNode):
         self.leftRows = leftRows
         self.leftRowSize = leftRowSize
         self.rightRows = rightRows
-        self.rightRowsSize = rightRowSize
+        self.rightRowSize = rightRowSize
         self.numFuncs = numFuncs
     
     def calculate_cost(self):
@@ -191,16 +259,16 @@ class MergeJoin(TreeNode):
         elif self.engine == "Tikv":
             cpuFactor = global_params.tikv_cpu_factor
             memFactor = global_params.tikv_mem_factor
-            diskFactor = global_params.tikv_disk_factor
+            diskFactor = 0
         elif self.engine == "Tiflash":
             cpuFactor = global_params.tiflash_cpu_factor
             memFactor = global_params.tiflash_mem_factor
-            diskFactor = global_params.tiflash_disk_factor
+            diskFactor = 0
         else:
             cpuFactor = 0
             memFactor = 0 
             diskFactor = 0          
-        cost = self.leftRows * self.leftRowSize * cpuFactor + self.rightRows * self.rightRowSize * cpuFactor + self.leftrows * self.numFuncs * cpuFactor + self.rightrows * self.numFuncs * cpuFactor
+        cost = self.leftRows * self.leftRowSize * cpuFactor + self.rightRows * self.rightRowSize * cpuFactor + self.leftRows * self.numFuncs * cpuFactor + self.rightRows * self.numFuncs * cpuFactor
         return cost
 
 class HashJoin(TreeNode):
@@ -282,7 +350,7 @@ class Projection(TreeNode):
             cpuFactor = 0
             memFactor = 0 
             concurrency = 1         
-        cost = self.row * cpuFactor * self.numFuncs / concurrency
+        cost = self.rows * cpuFactor * self.numFuncs / concurrency
         return cost
 
 
@@ -0,0 +1,290 @@
+import os
+import re
+import struct
+import hashlib
+import logging
+
+## 离线执行计划缓存
+## get_ch_plan.py和tools/flat_vector/get_data.py原来每条query单独连接TiDB执行EXPLAIN / EXPLAIN ANALYZE
+## PlanCache在一个会话里批量抓取整个workload文件的计划, 保存成带版本号的二进制文件
+## 缓存的key是 (sql的hash, EXPLAIN类型, schema布局), schema布局变化(分区/副本不同)后旧计划不会被误用
+## 抓取, 校准和代价模型都使用workload_sql_file和get_plan_layout(), 保证key一致
+## 加载时只读取索引, 计划的行在第一次查询时才解码, advisor和代价模型在没有数据库的环境下也可以运行
+
+PLAN_CACHE_MAGIC = b'JSPC'
+PLAN_CACHE_VERSION = 1
+
+# EXPLAIN类型 -> 执行的语句前缀
+explain_statements = {
+    'explain': 'EXPLAIN',
+    'explain_verbose': "EXPLAIN FORMAT = 'verbose'",
+    'explain_analyze': 'EXPLAIN ANALYZE',
+}
+
+# 抓取计划, 校准代价因子和代价模型查找计划使用的workload文件
+workload_sql_file = 'workload/workload.sql'
+
+# 同一条sql的空白和结尾分号不影响key
+def normalize_sql(sql):
+    return re.sub(r'\s+', ' ', sql).strip().rstrip(';').strip()
+
+def sql_hash(sql):
+    return hashlib.sha1(normalize_sql(sql).encode('utf-8')).hexdigest()
+
+# schema布局: 每个表的列, 分区键, replica列和replica分区键. 抓取计划时数据库的物理设计
+def schema_layout(table_columns):
+    parts = []
+    for table_column in table_columns:
+        parts.append(f"{table_column.name}:{','.join(table_column.columns)}:{','.join(table_column.partition_keys)}"
+                     f":{','.join(table_column.replicas)}:{','.join(table_column.replica_partition_keys)}")
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+## 数据库当前的schema布局, 抓取和查找计划时默认使用. 没有设置时是ch_columns_ranges_meta的初始设计
+plan_layout = None
+
+def set_plan_layout(table_columns):
+    global plan_layout
+    plan_layout = schema_layout(table_columns)
+
+def get_plan_layout():
+    global plan_layout
+    if plan_layout is None:
+        from estimator.table_meta_store import build_table_columns
+        plan_layout = schema_layout(build_table_columns())
+    return plan_layout
+
+# layout为None时使用get_plan_layout()
+def plan_cache_key(sql, kind, layout=None):
+    if layout is None:
+        layout = get_plan_layout()
+    return f"{sql_hash(sql)}:{kind}:{layout}"
+
+
+class PlanCache:
+    def __init__(self):
+        self.entries = {} # key -> (columns, rows), 已解码的计划
+        self.index = {} # key -> 文件中的偏移, 还没有解码的计划
+        self.data = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries) + len(self.index)
+
+    def __contains__(self, key):
+        return key in self.entries or key in self.index
+
+    def put(self, sql, kind, columns, rows, layout=None):
+        key = plan_cache_key(sql, kind, layout)
+        self.index.pop(key, None)
+        self.entries[key] = (list(columns), [['' if cell is None else str(cell) for cell in row] for row in rows])
+
+    # 返回 (列名, 行), 没有缓存时返回None
+    def get(self, sql, kind='explain', layout=None):
+        key = plan_cache_key(sql, kind, layout)
+        entry = self.entries.get(key)
+        if entry is None and key in self.index:
+            entry = self.decode(self.index.pop(key))
+            self.entries[key] = entry
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    # 和 cursor(dictionary=True).fetchall() 的结果格式一致
+    def get_dicts(self, sql, kind='explain', layout=None):
+        entry = self.get(sql, kind, layout)
+        if entry is None:
+            return None
+        columns, rows = entry
+        return [dict(zip(columns, row)) for row in rows]
+
+    # 在一个会话中抓取sql_list中所有query的计划
+    # kinds: 要抓取的EXPLAIN类型. explain_analyze会真正执行query
+    def capture(self, connection, sql_list, kinds=('explain',), layout=None):
+        captured = 0
+        with connection.cursor() as cur:
+            for sql in sql_list:
+                for kind in kinds:
+                    try:
+                        cur.execute(f"{explain_statements[kind]} {normalize_sql(sql)}")
+                        rows = cur.fetchall()
+                    except Exception as e:
+                        logging.warning(f"Plan cache: {kind} failed for {normalize_sql(sql)[:80]}: {e}")
+                        continue
+                    columns = [column[0] for column in cur.description]
+                    self.put(sql, kind, columns, rows, layout)
+                    captured += 1
+        logging.info(f"Plan cache: captured {captured} plans for {len(sql_list)} queries, layout {layout or get_plan_layout()}")
+        return captured
+
+    def stats(self):
+        return {'plans': len(self), 'hits': self.hits, 'misses': self.misses}
+
+    ## 二进制格式:
+    ## magic(4B) version(u32) 计划数(u32)
+    ## 每个计划: key 计划的字节数(u32) 列数(u32) 列名 行数(u32) 每行的每个单元格
+    ## 字符串: 长度(u32) + utf-8
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 没有解码的计划也要写回
+        for key in list(self.index):
+            self.entries[key] = self.decode(self.index.pop(key))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(PLAN_CACHE_MAGIC)
+            f.write(struct.pack('<II', PLAN_CACHE_VERSION, len(self.entries)))
+            for key, (columns, rows) in self.entries.items():
+                write_text(f, key)
+                payload = encode_plan(columns, rows)
+                f.write(struct.pack('<I', len(payload)))
+                f.write(payload)
+        os.replace(tmp_path, path)
+
+    # 只读取每个计划的key和偏移, 行在get时才解码
+    @classmethod
+    def load(cls, path):
+        cache = cls()
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:4] != PLAN_CACHE_MAGIC:
+            raise ValueError(f"{path} is not a plan cache")
+        version, num_plans = struct.unpack_from('<II', data, 4)
+        if version != PLAN_CACHE_VERSION:
+            raise ValueError(f"Unsupported plan cache version {version} in {path}")
+        cache.data = data
+        offset = 12
+        for _ in range(num_plans):
+            key, offset = read_text(data, offset)
+            length, = struct.unpack_from('<I', data, offset)
+            cache.index[key] = offset + 4
+            offset += 4 + length
+        return cache
+
+    def decode(self, offset):
+        data = self.data
+        num_columns, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        columns = []
+        for _ in range(num_columns):
+            column, offset = read_text(data, offset)
+            columns.append(column)
+        num_rows, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        rows = []
+        for _ in range(num_rows):
+            row = []
+            for _ in range(num_columns):
+                cell, offset = read_text(data, offset)
+                row.append(cell)
+            rows.append(row)
+        return columns, rows
+
+
+def write_text(f, value):
+    f.write(encode_text(value))
+
+def read_text(data, offset):
+    length, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+def encode_plan(columns, rows):
+    parts = [struct.pack('<I', len(columns))]
+    parts.extend(encode_text(column) for column in columns)
+    parts.append(struct.pack('<I', len(rows)))
+    for row in rows:
+        parts.extend(encode_text(cell) for cell in row)
+    return b''.join(parts)
+
+def encode_text(value):
+    encoded = value.encode('utf-8')
+    return struct.pack('<I', len(encoded)) + encoded
+
+# workload文件: 每条sql以分号结尾, 可以跨行
+def read_sql_file(sql_file):
+    with open(sql_file, 'r', encoding='utf-8') as f:
+        content = f.read()
+    return [sql.strip() for sql in content.split(';') if sql.strip()]
+
+# mysql客户端打印的EXPLAIN表格的列
+plan_text_columns = ['id', 'estRows', 'task', 'access object', 'operator info']
+
+# 读取保存EXPLAIN输出的文本文件(例如estimator/ch_plan.txt), 每条query以 "Qn" 开头, 后面是mysql客户端打印的表格
+# 返回 {qry_idx: 行}, 每行的列和plan_text_columns一致
+def read_plan_text(file_path, encoding='gbk'):
+    sections = {}
+    current = None
+    with open(file_path, 'r', encoding=encoding) as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            header = re.match(r'^Q(\d+)\s*$', line)
+            if header:
+                current = int(header.group(1)) - 1
+                sections[current] = []
+                continue
+            if current is None or not line.startswith('|'):
+                continue
+            cells = line.split('|')[1:]
+            if len(cells) < len(plan_text_columns) or cells[0].strip() == 'id':
+                continue
+            # 第一列保留树形前缀, 只去掉表格的一个空格
+            row = [cells[0][1:].rstrip()] + [cell.strip() for cell in cells[1:len(plan_text_columns)]]
+            sections[current].append(row)
+    return sections
+
+
+## 当前使用的计划缓存, 第一次get_plan_cache时才读取文件
+plan_cache = None
+plan_cache_path = 'Output/plan_cache_ch.bin'
+
+def set_plan_cache(cache):
+    global plan_cache
+    plan_cache = cache
+
+# 设置缓存文件的路径, 不读取文件
+def set_plan_cache_path(path):
+    global plan_cache, plan_cache_path
+    plan_cache = None
+    plan_cache_path = path
+
+# 缓存文件不存在时返回空的PlanCache, 所有查询都是miss
+def get_plan_cache():
+    global plan_cache
+    if plan_cache is None:
+        if os.path.exists(plan_cache_path):
+            plan_cache = PlanCache.load(plan_cache_path)
+            logging.info(f"load plan cache: {len(plan_cache)} plans from {plan_cache_path}")
+        else:
+            logging.info(f"Plan cache {plan_cache_path} not found")
+            plan_cache = PlanCache()
+    return plan_cache
+
+
+if __name__ == "__main__":
+    import sys
+    # 抓取: python -m estimator.plan_cache capture <workload.sql> [explain,explain_verbose,explain_analyze]
+    # 导入已有的EXPLAIN文本, 不需要数据库: python -m estimator.plan_cache import <workload.sql> <ch_plan.txt>
+    command = sys.argv[1] if len(sys.argv) > 1 else 'capture'
+    sql_file = sys.argv[2] if len(sys.argv) > 2 else workload_sql_file
+    if os.path.exists(plan_cache_path):
+        cache = PlanCache.load(plan_cache_path)
+    else:
+        cache = PlanCache()
+
+    sql_list = read_sql_file(sql_file)
+    if command == 'import':
+        plan_file = sys.argv[3] if len(sys.argv) > 3 else 'estimator/ch_plan.txt'
+        for qry_idx, rows in read_plan_text(plan_file).items():
+            if qry_idx < len(sql_list):
+                cache.put(sql_list[qry_idx], 'explain', plan_text_columns, rows)
+    else:
+        kinds = tuple(sys.argv[3].split(',')) if len(sys.argv) > 3 else ('explain', 'explain_verbose', 'explain_analyze')
+        from config import get_connection
+        with get_connection(autocommit=False) as connection:
+            cache.capture(connection, sql_list, kinds)
+    cache.save(plan_cache_path)
+    print(cache.stats())
@@ -0,0 +1,403 @@
+import re
+import logging
+
+from estimator.operators import TreeNode, TableScan, TableReader, HashAgg, Sort, MergeJoin, HashJoin, Selection, Projection
+from estimator.ch_query_params import plan_tables, plan_table_index, param_index, param_names, param_name_index, PARAM_ROWS, PARAM_ROWSIZE
+from estimator.ch_query_card import table_default_rows
+from estimator.table_meta_store import columns_classes
+from estimator.plan_cache import get_plan_cache, get_plan_layout, read_sql_file, read_plan_text, plan_text_columns, workload_sql_file
+
+## 基于真实执行计划树的query代价模型
+## calculate_query_cost只对每个表计算 TableScan/Selection/TableReader, 没有计入连接, 聚合, 排序和投影的代价
+## PlanCostModel读取EXPLAIN得到的每条query的计划树(estimator/ch_plan.txt), 只解析一次并缓存
+## 评估一个配置时, 叶子扫描算子的基数来自Qcard参数(分区裁剪后的行数), 按裁剪比例自底向上传播到连接/聚合等算子
+## 每个算子按task对应的engine(root: Tidb, cop[tikv]: Tikv, tiflash: Tiflash)实例化operators中的算子类计算代价
+## 读取replica的表: TableReader下的子树改为在Tiflash上扫描replica, 行存仍要读取时再加一个Tiflash上的HashJoin, 和calculate_query_cost的处理一致
+## 没有计划的query(例如计划文件中的计划和sql读取的表对不上)不在plans中, 由calculate_query_cost按'operators'模型计算
+
+plan_columns = plan_text_columns
+
+# 算子id: 树形前缀 + 算子名 + _编号 + (Build)/(Probe)
+plan_id_pattern = re.compile(r'^(?P<prefix>[^A-Za-z]*)(?P<op>[A-Za-z]+)(?:_\d+)?(?:\((?P<role>Build|Probe)\))?')
+plan_table_pattern = re.compile(r'table:(\w+)')
+plan_column_pattern = re.compile(r'\bch\.(\w+)\.')
+plan_cte_pattern = re.compile(r'\bdata:(CTE_\d+)')
+
+scan_operators = {'TableFullScan', 'TableRangeScan', 'TableRowIDScan', 'IndexFullScan', 'IndexRangeScan'}
+reader_operators = {'TableReader', 'IndexReader', 'IndexLookUp', 'IndexMerge'}
+join_operators = {'HashJoin', 'IndexHashJoin', 'IndexJoin', 'IndexMergeJoin'}
+agg_operators = {'HashAgg', 'StreamAgg'}
+sort_operators = {'Sort', 'TopN'}
+
+expression_width = 8 # 投影/聚合输出的每一列按8字节估计
+
+
+def task_engine(task):
+    if 'tiflash' in task:
+        return 'Tiflash'
+    if 'tikv' in task:
+        return 'Tikv'
+    return 'Tidb'
+
+# 按顶层逗号切分operator info, 括号内的逗号不切分
+def split_top_level(text):
+    items = []
+    depth = 0
+    start = 0
+    for i, ch in enumerate(text):
+        if ch in '([':
+            depth += 1
+        elif ch in ')]':
+            depth -= 1
+        elif ch == ',' and depth == 0:
+            items.append(text[start:i].strip())
+            start = i + 1
+    last = text[start:].strip()
+    if last:
+        items.append(last)
+    return [item for item in items if item]
+
+
+class PlanNode(TreeNode):
+    def __init__(self, content, op, est_rows, task, access_object, operator_info, role=None):
+        super().__init__(content)
+        self.op = op
+        self.est_rows = est_rows
+        self.task = task
+        self.engine = task_engine(task)
+        self.access_object = access_object
+        self.operator_info = operator_info
+        self.role = role # Build / Probe / None
+        self.table = None # 扫描算子读取的表
+        self.tables = frozenset() # 子树中扫描的所有表
+        self.ctes = [] # 根节点: WITH子句的CTE计划树, EXPLAIN中和根节点同一层的 CTE_n
+        self.act_rows = None # EXPLAIN ANALYZE的实际行数
+        self.execution_info = '' # EXPLAIN ANALYZE的execution info
+
+    def __repr__(self):
+        return f"PlanNode(op={self.op}, estRows={self.est_rows}, task={self.task}, table={self.table})"
+
+
+## 解析EXPLAIN结果
+# rows: EXPLAIN返回的行, columns: 每一列的名称
+# aliases: 表别名 -> 表名, 用于解析access object里的 table:<别名>
+def build_plan_tree(rows, columns=plan_columns, aliases=None):
+    id_col = columns.index('id')
+    rows_col = columns.index('estRows')
+    task_col = columns.index('task')
+    access_col = columns.index('access object')
+    info_col = columns.index('operator info')
+
+    root = None
+    stack = [] # stack[depth]: 当前路径上每一层的节点
+    for row in rows:
+        match = plan_id_pattern.match(row[id_col])
+        if match is None:
+            continue
+        depth = len(match.group('prefix')) // 2
+        node = PlanNode(row[id_col].strip(), match.group('op'), float(row[rows_col]), row[task_col].strip(),
+                        row[access_col].strip(), row[info_col].strip(), match.group('role'))
+        if 'actRows' in columns:
+            node.act_rows = float(row[columns.index('actRows')] or 0)
+        if 'execution info' in columns:
+            node.execution_info = row[columns.index('execution info')]
+        del stack[depth:]
+        if depth == 0 and root is None:
+            root = node
+        elif depth == 0:
+            root.ctes.append(node)
+        elif stack:
+            stack[-1].add_child(node)
+        stack.append(node)
+
+    if root is not None:
+        tables = resolve_plan_tables(root, aliases or {})
+        for cte in root.ctes:
+            tables |= resolve_plan_tables(cte, aliases or {})
+        root.tables = frozenset(tables)
+    return root
+
+# 确定每个扫描算子读取的表: 优先用access object里的别名, 否则用算子和祖先operator info中出现的第一个 ch.<表>.
+# 无法确定时抛出ValueError, 不能把扫描按0代价计算
+def resolve_plan_tables(root, aliases, ancestors=()):
+    path = (root,) + ancestors
+    tables = set()
+    if root.op in scan_operators:
+        match = plan_table_pattern.search(root.access_object)
+        table = None
+        if match is not None:
+            alias = match.group(1)
+            table = alias if alias in plan_table_index else aliases.get(alias)
+        if table is None:
+            for node in path:
+                table = next((t for t in plan_column_pattern.findall(node.operator_info) if t in plan_table_index), None)
+                if table is not None:
+                    break
+        if table is None:
+            raise ValueError(f"cannot resolve table of {root.content} ({root.access_object})")
+        root.table = table
+        tables.add(table)
+    for child in root.children:
+        tables |= resolve_plan_tables(child, aliases, path)
+    root.tables = frozenset(tables)
+    return root.tables
+
+sql_keywords = {'where', 'join', 'on', 'inner', 'left', 'right', 'outer', 'cross', 'group', 'order', 'having', 'limit', 'union', 'and', 'or', 'as', 'select', 'from', 'natural', 'using', 'set', 'values'}
+sql_alias_pattern = re.compile(r'\b(' + '|'.join(plan_tables) + r')\s+(?:as\s+)?(\w+)', re.IGNORECASE)
+sql_table_pattern = re.compile(r'(?<![.\w])(' + '|'.join(plan_tables) + r')\b(?!\s*\.)', re.IGNORECASE)
+
+# 从一条sql中找出表的别名, 例如 "stock AS s_sub" 或 "order_line ol"
+# 别名只在一条query内有效: 同一个别名在不同query中可能指向不同的表(例如 s 在Q2中是stock, 在Q7中是supplier)
+def sql_table_aliases(sql):
+    aliases = {}
+    for table, alias in sql_alias_pattern.findall(sql):
+        if alias.lower() in sql_keywords:
+            continue
+        aliases.setdefault(alias, table.lower())
+    return aliases
+
+# sql读取的表
+def sql_tables(sql):
+    return frozenset(table.lower() for table in sql_table_pattern.findall(sql))
+
+# 解析一条query的计划并检查读取的表和sql一致, 不一致时返回None
+def build_query_plan(qry_idx, rows, columns, sql):
+    try:
+        root = build_plan_tree(rows, columns, sql_table_aliases(sql))
+    except ValueError as e:
+        logging.error(f"Q{qry_idx + 1}: {e}, the plan does not match the query")
+        return None
+    if root is not None and root.tables != sql_tables(sql):
+        logging.error(f"Q{qry_idx + 1}: plan reads {sorted(root.tables)} but the query reads {sorted(sql_tables(sql))}")
+        return None
+    return root
+
+# 解析保存EXPLAIN输出的文本文件, 返回 {qry_idx: 计划树的根节点}
+# 文件是手工保存的, 和sql_list对不上的计划丢弃, 这些query按'operators'模型计算
+def parse_plan_file(file_path, sql_list, encoding='gbk'):
+    plans = {}
+    for qry_idx, rows in read_plan_text(file_path, encoding).items():
+        if qry_idx >= len(sql_list):
+            continue
+        root = build_query_plan(qry_idx, rows, plan_columns, sql_list[qry_idx])
+        if root is not None:
+            plans[qry_idx] = root
+    return plans
+
+
+class PlanCostModel:
+    def __init__(self, plans):
+        self.plans = plans
+        self.row_widths = {}
+        self.nkeys = {}
+        for table, columns_class in zip(plan_tables, columns_classes):
+            table_columns = columns_class()
+            self.row_widths[table] = sum(table_columns.columns_size)
+            self.nkeys[table] = len(table_columns.primary_keys)
+        self.trace = None
+
+    # 参数向量, 和CompiledQueryPlan.param_vector一致
+    def param_vector(self, qparams):
+        params = getattr(qparams, 'params', None)
+        if params is not None:
+            return params
+        vector = [0] * len(param_names)
+        for name, value in vars(qparams).items():
+            idx = param_name_index.get(name)
+            if idx is not None:
+                vector[idx] = value
+        return vector
+
+    def has_plan(self, qry_idx):
+        return qry_idx in self.plans
+
+    # 计划中扫描的所有表(包括CTE)
+    def query_tables(self, qry_idx):
+        return self.plans[qry_idx].tables
+
+    def query_cost(self, qry_idx, qparams):
+        return self.evaluate(qry_idx, self.param_vector(qparams), qparams.scan_table_replica)
+
+    # vector: 参数向量, scan_table_replica: 要读取replica的表
+    def evaluate(self, qry_idx, vector, scan_table_replica):
+        root = self.plans[qry_idx]
+        scan_table_replica = frozenset(scan_table_replica)
+        # 先计算CTE, CTEFullScan按CTE的比例缩放
+        ctes = {}
+        cost = 0
+        for cte in root.ctes:
+            _, _, ratio, cte_cost = self.evaluate_node(cte, vector, scan_table_replica, frozenset(), ctes)
+            ctes[cte.content] = ratio
+            cost += cte_cost
+        _, _, _, root_cost = self.evaluate_node(root, vector, scan_table_replica, frozenset(), ctes)
+        return cost + root_cost
+
+    # 自底向上计算, 返回 (输出行数, 行宽, 相对于计划估计行数的比例, 子树代价)
+    # replica: 这个子树中改为读取replica的表, ctes: CTE名 -> 比例
+    def evaluate_node(self, node, vector, scan_table_replica, replica, ctes):
+        if node.op in reader_operators:
+            return self.evaluate_reader(node, vector, scan_table_replica, replica, ctes)
+
+        if node.op in scan_operators:
+            return self.evaluate_scan(node, vector, replica)
+
+        children = [self.evaluate_node(child, vector, scan_table_replica, replica, ctes) for child in node.children]
+        ratio = 1.0
+        if node.op == 'CTEFullScan':
+            match = plan_cte_pattern.search(node.operator_info)
+            ratio = ctes.get(match.group(1), 1.0) if match else 1.0
+        for child in children:
+            ratio *= child[2]
+        rows = node.est_rows * ratio
+        engine = 'Tiflash' if replica and node.engine != 'Tidb' else node.engine
+        cost = sum(child[3] for child in children)
+        child_rows, child_rowsize = (children[0][0], children[0][1]) if children else (rows, expression_width)
+        rowsize = child_rowsize
+
+        operator = None
+        if node.op == 'Selection':
+            operator = Selection(node.content, child_rows, len(split_top_level(node.operator_info)))
+        elif node.op == 'Projection':
+            num_funcs = len(split_top_level(node.operator_info))
+            operator = Projection(node.content, child_rows, num_funcs)
+            rowsize = num_funcs * expression_width
+        elif node.op in agg_operators:
+            group_by, agg_funcs = self.parse_aggregation(node.operator_info)
+            operator = HashAgg(node.content, rows, agg_funcs, 0, child_rows, child_rowsize, max(group_by, 1), child_rows)
+            rowsize = (group_by + agg_funcs) * expression_width
+        elif node.op in sort_operators:
+            sort_items = [item for item in split_top_level(node.operator_info) if not item.startswith(('offset:', 'count:'))]
+            operator = Sort(node.content, child_rows, child_rowsize, sort_items, 0)
+        elif node.op in join_operators and len(children) == 2:
+            build, probe = self.join_sides(node, children)
+            nkeys = max(node.operator_info.count('eq('), 1)
+            operator = HashJoin(node.content, build[0], 1, build[1], nkeys, probe[0], 1, probe[1])
+            rowsize = build[1] + probe[1]
+        elif node.op == 'MergeJoin' and len(children) == 2:
+            left, right = children
+            nkeys = max(node.operator_info.count('eq('), 1)
+            operator = MergeJoin(node.content, left[0], left[1], right[0], right[1], nkeys)
+            rowsize = left[1] + right[1]
+
+        if operator is not None:
+            cost += self.price(node, operator, engine)
+        return rows, rowsize, ratio, cost
+
+    # 扫描算子: 行数按Qcard给出的分区裁剪比例缩放计划的估计行数
+    def evaluate_scan(self, node, vector, replica):
+        table = node.table
+        is_replica = table in replica
+        table_idx = plan_table_index[table]
+        scanned = vector[param_index(table_idx, is_replica, PARAM_ROWS)]
+        ratio = scanned / table_default_rows[table]
+        rows = node.est_rows * ratio
+        rowsize = vector[param_index(table_idx, is_replica, PARAM_ROWSIZE)]
+        if rowsize == 0: ## 没有replica配置的表Qcard不更新rowsize, 使用整行宽度
+            rowsize = self.row_widths[table]
+        operator = TableScan(node.content, rows, rowsize)
+        return rows, rowsize, ratio, self.price(node, operator, 'Tiflash' if is_replica else node.engine)
+
+    # TableReader: 数据从存储层传输到TiDB. 子树读取的表要读replica时, 分别计算行存和列存两部分
+    def evaluate_reader(self, node, vector, scan_table_replica, replica, ctes):
+        targets = node.tables & scan_table_replica
+        if not targets:
+            engine = 'Tiflash' if any(child.engine == 'Tiflash' for child in node.children) else 'Tikv'
+            return self.evaluate_reader_side(node, vector, scan_table_replica, replica, ctes, engine)
+
+        rows, rowsize, ratio, cost = self.evaluate_reader_side(node, vector, scan_table_replica, replica | targets, ctes, 'Tiflash')
+        # query同时读取行存的列时, 行存也要扫描, 再和replica按主键做HashJoin
+        row_tables = [table for table in targets if vector[param_index(plan_table_index[table], False, PARAM_ROWSIZE)] != 0]
+        if row_tables:
+            row_rows, row_rowsize, _, row_cost = self.evaluate_reader_side(node, vector, scan_table_replica, replica, ctes, 'Tikv')
+            nkeys = max(self.nkeys[table] for table in row_tables)
+            join = HashJoin(node.content, row_rows, 1, row_rowsize, nkeys, rows, 1, rowsize)
+            cost += row_cost + self.price(node, join, 'Tiflash')
+            rowsize += row_rowsize
+        return rows, rowsize, ratio, cost
+
+    def evaluate_reader_side(self, node, vector, scan_table_replica, replica, ctes, engine):
+        children = [self.evaluate_node(child, vector, scan_table_replica, replica, ctes) for child in node.children]
+        if not children:
+            return node.est_rows, expression_width, 1.0, 0
+        # IndexLookUp: 最后一个子节点是回表读取的数据
+        rows, rowsize, ratio, _ = children[-1]
+        cost = sum(child[3] for child in children)
+        operator = TableReader(node.content, rows, rowsize)
+        return rows, rowsize, ratio, cost + self.price(node, operator, engine)
+
+    # 计算一个算子的代价. trace不为None时记录 (计划节点, 算子), 用于校准代价因子
+    def price(self, node, operator, engine):
+        operator.engine = engine
+        if self.trace is not None:
+            self.trace.append((node, operator))
+        return operator.calculate_cost()
+
+    # (Build)子节点作为build端, 没有标记时第一个子节点是build端
+    def join_sides(self, node, children):
+        if node.children[1].role == 'Build':
+            return children[1], children[0]
+        return children[0], children[1]
+
+    # 返回 (group by列数, 聚合函数数)
+    def parse_aggregation(self, operator_info):
+        group_by = 0
+        agg_funcs = 0
+        for item in split_top_level(operator_info):
+            if item.startswith('funcs:'):
+                agg_funcs += 1
+            elif item.startswith('group by:') or (agg_funcs == 0 and group_by > 0):
+                group_by += 1
+        return group_by, agg_funcs
+
+
+# 进程内共享的PlanCostModel, 第一次使用时解析计划文件
+plan_cost_model = None
+
+# 优先使用计划缓存中workload每条query的EXPLAIN结果, 缓存中没有时解析plan_file
+# sql_file要和抓取计划时的workload文件一致(plan_cache.workload_sql_file), 否则sql的hash对不上
+def load_plan_cost_model(plan_file='estimator/ch_plan.txt', sql_file=workload_sql_file, encoding='gbk'):
+    global plan_cost_model
+    sql_list = read_sql_file(sql_file)
+    plans = plans_from_cache(get_plan_cache(), sql_list)
+    if plans is None:
+        plans = parse_plan_file(plan_file, sql_list, encoding)
+        logging.warning(f"load query plans: plan cache is incomplete for {sql_file}, fall back to {len(plans)} queries from {plan_file}")
+    else:
+        logging.info(f"load query plans: {len(plans)} queries from plan cache")
+    missing = [f"Q{qry_idx + 1}" for qry_idx in range(len(sql_list)) if qry_idx not in plans]
+    if missing:
+        logging.warning(f"load query plans: no valid plan for {', '.join(missing)}, these queries use the operators cost model")
+    plan_cost_model = PlanCostModel(plans)
+    return plan_cost_model
+
+# 缓存中缺少任意一条query的计划时返回None
+# 缓存按sql的hash保存计划, 计划一定对应这条sql, 无法确定扫描的表时直接抛出ValueError
+def plans_from_cache(cache, sql_list, kind='explain', layout=None):
+    plans = {}
+    for qry_idx, sql in enumerate(sql_list):
+        entry = cache.get(sql, kind, layout)
+        if entry is None:
+            logging.warning(f"Plan cache: no {kind} plan for Q{qry_idx + 1} (layout {layout or get_plan_layout()})")
+            return None
+        columns, rows = entry
+        try:
+            root = build_plan_tree(rows, columns, sql_table_aliases(sql))
+        except ValueError as e:
+            raise ValueError(f"Plan cache: Q{qry_idx + 1}: {e}") from e
+        if root is None:
+            return None
+        plans[qry_idx] = root
+    return plans
+
+def get_plan_cost_model():
+    if plan_cost_model is None:
+        load_plan_cost_model()
+    return plan_cost_model
+
+def set_plan_cost_model(model):
+    global plan_cost_model
+    plan_cost_model = model
+
+# 计算指定第qry_idx条query在计划树代价模型下的代价
+def calculate_plan_query_cost(qry_idx, qparams_list):
+    return get_plan_cost_model().query_cost(qry_idx, qparams_list[qry_idx])
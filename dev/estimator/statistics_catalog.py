@@ -0,0 +1,295 @@
+import os
+import re
+import struct
+import logging
+from array import array
+from datetime import datetime, date
+from decimal import Decimal
+
+import numpy as np
+
+## 列统计目录
+## ch_partition_meta里每个*_Meta类的keys_partition_cnt是手动填写的, 数据变化后就不准了;
+## 注释掉的代码对每个分区每个分区键执行一次 SELECT count(*) ... WHERE key <= v, 在搜索过程中调用太慢
+## StatisticsCatalog对每个表的partitionable_columns建立等深直方图, 每个表只扫描一次(TiDB或者dumpling导出的.sql文件),
+## 持久化成紧凑的二进制文件, 之后任意边界的分区行数都可以由直方图估计, 不需要访问数据库
+
+CATALOG_MAGIC = b'JSTC'
+CATALOG_VERSION = 1
+
+# 直方图只保存数值, 日期转换成时间戳
+def histogram_value(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day).timestamp()
+    if isinstance(value, (int, float, Decimal)):
+        return float(value)
+    if isinstance(value, str):
+        if value == 'NULL':
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp()
+    raise ValueError(f"Unsupported histogram value: {value!r}")
+
+
+## 等深直方图
+## upper_bounds[k]: 第k个桶的上界(包含), upper_bounds[0]是列的最小值
+## counts_le[k]: <= upper_bounds[k]的行数; counts_lt[k]: < upper_bounds[k]的行数
+## 桶内按均匀分布做线性插值
+class ColumnHistogram:
+    def __init__(self, upper_bounds, counts_le, counts_lt, null_count=0):
+        self.upper_bounds = np.asarray(upper_bounds, dtype=np.float64)
+        self.counts_le = np.asarray(counts_le, dtype=np.float64)
+        self.counts_lt = np.asarray(counts_lt, dtype=np.float64)
+        self.null_count = null_count
+
+    @classmethod
+    def build(cls, values, num_buckets=64, null_count=0):
+        values = np.sort(np.asarray(values, dtype=np.float64))
+        n = len(values)
+        if n == 0:
+            return cls([], [], [], null_count)
+        positions = np.linspace(0, n - 1, min(num_buckets, n) + 1).round().astype(np.int64)
+        upper_bounds = np.unique(values[positions])
+        counts_le = np.searchsorted(values, upper_bounds, side='right')
+        counts_lt = np.searchsorted(values, upper_bounds, side='left')
+        return cls(upper_bounds, counts_le, counts_lt, null_count)
+
+    @property
+    def row_count(self):
+        if len(self.counts_le) == 0:
+            return 0
+        return float(self.counts_le[-1])
+
+    # 估计 < value 的行数
+    def count_less_than(self, value):
+        bounds = self.upper_bounds
+        if len(bounds) == 0:
+            return 0.0
+        if value <= bounds[0]:
+            return 0.0
+        if value > bounds[-1]:
+            return float(self.counts_le[-1])
+        k = int(np.searchsorted(bounds, value, side='left'))
+        lower = bounds[k - 1]
+        if value == bounds[k]:
+            return float(self.counts_lt[k])
+        fraction = (value - lower) / (bounds[k] - lower)
+        return float(self.counts_le[k - 1] + (self.counts_lt[k] - self.counts_le[k - 1]) * fraction)
+
+    # 估计第q(0~1)分位的值, count_less_than的反函数
+    def quantile(self, q):
+        bounds = self.upper_bounds
+        # 折线: 每个上界处 < 的行数和 <= 的行数
+        counts = np.empty(2 * len(bounds))
+        counts[0::2] = self.counts_lt
+        counts[1::2] = self.counts_le
+        return float(np.interp(q * self.row_count, counts, np.repeat(bounds, 2)))
+
+    # 估计 [lower, upper) 内的行数, None表示没有边界
+    def range_rows(self, lower=None, upper=None):
+        high = self.row_count if upper is None else self.count_less_than(histogram_value(upper))
+        low = 0.0 if lower is None else self.count_less_than(histogram_value(lower))
+        return max(high - low, 0.0)
+
+
+class StatisticsCatalog:
+    def __init__(self):
+        self.tables = {} # table_name -> {'count': 行数, 'columns': {column: ColumnHistogram}}
+
+    def add_table(self, table_name, count, histograms):
+        self.tables[table_name] = {'count': count, 'columns': histograms}
+
+    def has_column(self, table_name, column):
+        return table_name in self.tables and column in self.tables[table_name]['columns']
+
+    def table_count(self, table_name):
+        return self.tables[table_name]['count']
+
+    def histogram(self, table_name, column):
+        return self.tables[table_name]['columns'][column]
+
+    def range_rows(self, table_name, column, lower=None, upper=None):
+        return self.histogram(table_name, column).range_rows(lower, upper)
+
+    # 按RANGE分区的边界估计每个分区的行数
+    # bounds: 每个分区 VALUES LESS THAN 的值, 和update_meta生成的ranges一致, 最后一个分区是MAXVALUE
+    def partition_counts(self, table_name, column, bounds):
+        histogram = self.histogram(table_name, column)
+        edges = [None] + list(bounds[:-1]) + [None]
+        return [round(histogram.range_rows(edges[i], edges[i + 1])) for i in range(len(bounds))]
+
+    # 等深分区的边界(VALUES LESS THAN), 每个分区的行数相同, 最后一个边界是最大值
+    def equi_depth_bounds(self, table_name, column, count):
+        histogram = self.histogram(table_name, column)
+        bounds = [histogram.quantile(j / count) for j in range(1, count)]
+        bounds.append(float(histogram.upper_bounds[-1]))
+        return bounds
+
+    ## 单次扫描构建: rows是表的所有行(按columns的顺序), 所有partitionable_columns同时收集
+    def build_table(self, table_name, columns, partitionable_columns, rows, num_buckets=64):
+        positions = [columns.index(column) for column in partitionable_columns]
+        values = [array('d') for _ in partitionable_columns]
+        null_counts = [0] * len(partitionable_columns)
+        count = 0
+        for row in rows:
+            count += 1
+            for i, position in enumerate(positions):
+                value = histogram_value(row[position])
+                if value is None:
+                    null_counts[i] += 1
+                else:
+                    values[i].append(value)
+        histograms = {}
+        for i, column in enumerate(partitionable_columns):
+            histograms[column] = ColumnHistogram.build(np.frombuffer(values[i], dtype=np.float64), num_buckets, null_counts[i])
+        self.add_table(table_name, count, histograms)
+        logging.info(f"Statistics catalog: table {table_name}, {count} rows, {len(histograms)} histograms")
+
+    # 扫描TiDB, 每个表一次 SELECT
+    def build_from_tidb(self, table_columns, connection, num_buckets=64, fetch_size=10000):
+        for table_column in table_columns:
+            with connection.cursor() as cur:
+                cur.execute(f"SELECT {', '.join(table_column.partitionable_columns)} FROM {table_column.name};")
+                self.build_table(table_column.name, table_column.partitionable_columns, table_column.partitionable_columns, fetch_rows(cur, fetch_size), num_buckets)
+
+    # 扫描dumpling导出的数据文件 {dump_dir}/{database}.{table}.*.sql
+    def build_from_dump(self, table_columns, dump_dir, database='ch_bak', num_buckets=64):
+        for table_column in table_columns:
+            sql_files = sorted(f for f in os.listdir(dump_dir) if f.startswith(f"{database}.{table_column.name}.") and f.endswith(".sql"))
+            if not sql_files:
+                logging.info(f"Statistics catalog: no dump files for table {table_column.name} in {dump_dir}")
+                continue
+            rows = dump_rows([os.path.join(dump_dir, f) for f in sql_files])
+            self.build_table(table_column.name, table_column.columns, table_column.partitionable_columns, rows, num_buckets)
+
+    ## 二进制格式:
+    ## magic(4B) version(u32) 表的数量(u32)
+    ## 每个表: 表名 行数(i64) 列的数量(u32)
+    ## 每列: 列名 null行数(i64) 桶数(u32) upper_bounds/counts_le/counts_lt 三个float64数组
+    ## 字符串: 长度(u16) + utf-8
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(CATALOG_MAGIC)
+            f.write(struct.pack('<II', CATALOG_VERSION, len(self.tables)))
+            for table_name, table in self.tables.items():
+                write_string(f, table_name)
+                f.write(struct.pack('<qI', table['count'], len(table['columns'])))
+                for column, histogram in table['columns'].items():
+                    write_string(f, column)
+                    f.write(struct.pack('<qI', histogram.null_count, len(histogram.upper_bounds)))
+                    f.write(histogram.upper_bounds.astype('<f8').tobytes())
+                    f.write(histogram.counts_le.astype('<f8').tobytes())
+                    f.write(histogram.counts_lt.astype('<f8').tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        catalog = cls()
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:4] != CATALOG_MAGIC:
+            raise ValueError(f"{path} is not a statistics catalog")
+        version, num_tables = struct.unpack_from('<II', data, 4)
+        if version != CATALOG_VERSION:
+            raise ValueError(f"Unsupported statistics catalog version {version} in {path}")
+        offset = 12
+        for _ in range(num_tables):
+            table_name, offset = read_string(data, offset)
+            count, num_columns = struct.unpack_from('<qI', data, offset)
+            offset += 12
+            histograms = {}
+            for _ in range(num_columns):
+                column, offset = read_string(data, offset)
+                null_count, num_bounds = struct.unpack_from('<qI', data, offset)
+                offset += 12
+                arrays = []
+                for _ in range(3):
+                    arrays.append(np.frombuffer(data, dtype='<f8', count=num_bounds, offset=offset))
+                    offset += num_bounds * 8
+                histograms[column] = ColumnHistogram(arrays[0], arrays[1], arrays[2], null_count)
+            catalog.add_table(table_name, count, histograms)
+        return catalog
+
+
+def write_string(f, value):
+    encoded = value.encode('utf-8')
+    f.write(struct.pack('<H', len(encoded)))
+    f.write(encoded)
+
+def read_string(data, offset):
+    length, = struct.unpack_from('<H', data, offset)
+    offset += 2
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+def fetch_rows(cur, fetch_size):
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if not rows:
+            break
+        yield from rows
+
+# 和tools/reorganize/table_data_modify.py解析dump文件的方式一致: 每行一个 (v1,v2,...) 元组
+dump_value_pattern = re.compile(r"'(.*?)'|(-?\d+\.\d+)|(-?\d+)|(NULL)")
+
+def dump_rows(sql_files):
+    for sql_file in sql_files:
+        with open(sql_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line.startswith('('):
+                    continue
+                values = []
+                for quoted, decimal_value, int_value, null in dump_value_pattern.findall(line.rstrip(',;')):
+                    if null:
+                        values.append(None)
+                    elif decimal_value or int_value:
+                        values.append(decimal_value or int_value)
+                    else:
+                        values.append(quoted)
+                yield values
+
+
+## 当前使用的统计目录. 为None时*_Meta类使用手动填写的keys_partition_cnt
+statistics_catalog = None
+
+def set_statistics_catalog(catalog):
+    global statistics_catalog
+    statistics_catalog = catalog
+
+def get_statistics_catalog():
+    return statistics_catalog
+
+# 文件存在时加载并启用统计目录
+def load_statistics_catalog(path):
+    if not os.path.exists(path):
+        logging.info(f"Statistics catalog {path} not found, use keys_partition_cnt")
+        return None
+    catalog = StatisticsCatalog.load(path)
+    set_statistics_catalog(catalog)
+    return catalog
+
+
+if __name__ == "__main__":
+    import sys
+    from estimator.ch_columns_ranges_meta import Customer_columns, District_columns, History_columns, Item_columns, Nation_columns, New_order_columns, Order_line_columns, Orders_columns, Region_columns, Stock_columns, Supplier_columns, Warehouse_columns
+
+    table_columns = [Customer_columns(), District_columns(), History_columns(), Item_columns(), Nation_columns(), New_order_columns(), Order_line_columns(), Orders_columns(), Region_columns(), Stock_columns(), Supplier_columns(), Warehouse_columns()]
+    catalog = StatisticsCatalog()
+    # 指定dump目录时扫描dump文件, 否则扫描TiDB
+    if len(sys.argv) > 1:
+        catalog.build_from_dump(table_columns, sys.argv[1])
+    else:
+        from config import get_connection
+        with get_connection(autocommit=False) as connection:
+            catalog.build_from_tidb(table_columns, connection)
+    catalog.save('Output/statistics_catalog_ch.bin')
@@ -0,0 +1,91 @@
+import copy
+
+from estimator.ch_partition_meta import Customer_Meta, District_Meta, History_Meta, Item_Meta, Nation_Meta, New_Order_Meta, Order_Line_Meta, Orders_Meta, Region_Meta, Stock_Meta, Supplier_Meta, Warehouse_Meta
+from estimator.ch_columns_ranges_meta import Customer_columns, District_columns, History_columns, Item_columns, Nation_columns, New_order_columns, Order_line_columns, Orders_columns, Region_columns, Stock_columns, Supplier_columns, Warehouse_columns
+
+## 表元数据的原型和写时复制视图
+## 原来每次计算reward之后reset_table_meta都要清空table_meta, 重新构造24个*_Meta对象
+## TableMetaStore只构造一次24个原型(基础统计: count, keys_partition_cnt, 没有分区键), 之后不再修改
+## TableMetaView是一次评估使用的table_meta: 没有分区的表直接读原型, update_meta写入时才复制出这个表的meta(overlay)
+## 评估结束后reset()丢弃overlay即可
+## 原型只读, fork出来的进程直接共享; 视图只保存overlay, pickle的开销也很小
+
+# 顺序和advisor.update_meta里的table_dict一致, table_meta[idx + 12]是replica的元数据
+meta_classes = [Customer_Meta, District_Meta, History_Meta, Item_Meta, Nation_Meta, New_Order_Meta, Order_Line_Meta, Orders_Meta, Region_Meta, Stock_Meta, Supplier_Meta, Warehouse_Meta]
+columns_classes = [Customer_columns, District_columns, History_columns, Item_columns, Nation_columns, New_order_columns, Order_line_columns, Orders_columns, Region_columns, Stock_columns, Supplier_columns, Warehouse_columns]
+
+
+# 构造24个*_Meta对象: 前12个是原表, 后12个是replica(isreplica=True)
+def build_table_meta():
+    table_meta = [meta_class() for meta_class in meta_classes]
+    for meta_class in meta_classes:
+        replica_meta = meta_class()
+        replica_meta.isreplica = True
+        table_meta.append(replica_meta)
+    return table_meta
+
+def build_table_columns():
+    return [columns_class() for columns_class in columns_classes]
+
+
+class TableMetaStore:
+    def __init__(self):
+        self.prototypes = build_table_meta()
+
+    def new_view(self):
+        return TableMetaView(self)
+
+
+class TableMetaView:
+    def __init__(self, store):
+        self.store = store
+        self.overlays = {} # idx -> 这次评估中被修改的meta
+
+    def __len__(self):
+        return len(self.store.prototypes)
+
+    def __getitem__(self, idx):
+        meta = self.overlays.get(idx)
+        if meta is None:
+            return self.store.prototypes[idx]
+        return meta
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    # 返回可以修改的meta, 第一次修改时从原型复制
+    # update_partition_metadata会原地修改keys, 复制时换成新的列表, keys_partition_cnt等基础统计和原型共享
+    def writable(self, idx):
+        meta = self.overlays.get(idx)
+        if meta is None:
+            meta = copy.copy(self.store.prototypes[idx])
+            meta.keys = []
+            meta.partition_cnt = []
+            meta.partition_range = []
+            self.overlays[idx] = meta
+        return meta
+
+    # 丢弃一个表的overlay, 恢复成原型
+    def discard(self, idx):
+        self.overlays.pop(idx, None)
+
+    # 丢弃所有overlay
+    def reset(self):
+        self.overlays.clear()
+
+
+table_meta_store = None
+
+# 进程内共享的TableMetaStore, 第一次使用时构造
+def get_table_meta_store():
+    global table_meta_store
+    if table_meta_store is None:
+        table_meta_store = TableMetaStore()
+    return table_meta_store
+
+# update_meta写入table_meta[idx]之前调用: TableMetaView返回overlay, 普通列表直接返回原对象
+def writable_table_meta(table_meta, idx):
+    if isinstance(table_meta, TableMetaView):
+        return table_meta.writable(idx)
+    return table_meta[idx]
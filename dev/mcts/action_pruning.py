@@ -0,0 +1,114 @@
+from estimator.ch_query_card import qcard_classes
+from estimator.query_operators import query_operators
+
+## 按代价相关性裁剪action空间
+## get_possible_actions列出所有表的所有可分区列, replica列和replica分区列, 其中很多action不会改变任何query的代价
+## 搜索开始前对workload做一次静态分析(Qcard的tables/keys/columns/operators, query_operators的tables, tp_column_usage):
+##   remove replica (T, c): 有query读取T时改变行存/列存的rowsize; c有更新时改变移除replica的reward. 两者都不满足时无关
+##   replica_partition (T, c): 只有T上有过滤条件时才会用replica的分区元数据计算基数(Qcard.get_query_card), 否则无关
+##   partition (T, c): 同时移除c的replica; T上有过滤条件或者移除c的replica相关时才相关
+##     分区键不是过滤条件的key(Qcard.keys)时不能裁剪分区, 但分区元数据仍会改变partition_cnt估计的扫描行数, 所以保留
+## 等价的action: 同一个表上没有query读取, 不可分区, 大小和更新频率都相同的列, 移除其中任何一列对reward的影响完全相同
+## 每个等价类在一个状态下只保留下标最小的可用列, 移除多列的组合仍然可以到达
+
+class ActionPruning:
+    # schema: ConfigSchema, table_columns: ch_columns_ranges_meta的*_columns(列的大小)
+    # qcard_list: 已经init的Qcard列表, tp_column_usage: 表 -> 列 -> 更新频率
+    def __init__(self, schema, table_columns, qcard_list, tp_column_usage):
+        self.schema = schema
+        read_tables = set()
+        filtered_tables = set()
+        read_columns = {}
+        for qcard in qcard_list:
+            for table_idx, table_name in enumerate(qcard.tables):
+                read_tables.add(table_name)
+                read_columns.setdefault(table_name, set()).update(qcard.columns[table_idx])
+                if qcard.operators[table_idx]:
+                    filtered_tables.add(table_name)
+        for query_info in query_operators:
+            read_tables.update(table for table in query_info['tables'] if not table.endswith('_replica'))
+
+        columns_size = {table_column.name: dict(zip(table_column.columns, table_column.columns_size)) for table_column in table_columns}
+
+        # 每个表允许的action的列位图, 下标和schema.columns一致
+        self.partition_masks = []
+        self.remove_replica_masks = []
+        self.replica_partition_masks = []
+        # 每个表remove replica的等价类, 每个等价类是一个列位图(至少2列)
+        self.replica_classes = []
+        for idx, name in enumerate(schema.names):
+            columns = schema.columns[idx]
+            tp_usage = tp_column_usage.get(name, {})
+            table_read = name in read_tables
+            table_filtered = name in filtered_tables
+            remove_replica_mask = 0
+            partition_mask = 0
+            classes = {}
+            for i, column in enumerate(columns):
+                bit = 1 << i
+                removal_relevant = table_read or tp_usage.get(column, 0) != 0
+                if removal_relevant:
+                    remove_replica_mask |= bit
+                if table_filtered or removal_relevant:
+                    partition_mask |= bit
+                if removal_relevant and not schema.partitionable_masks[idx] & bit and column not in read_columns.get(name, ()):
+                    key = (columns_size[name].get(column), tp_usage.get(column, 0))
+                    classes[key] = classes.get(key, 0) | bit
+            self.remove_replica_masks.append(remove_replica_mask)
+            self.partition_masks.append(partition_mask & schema.partitionable_masks[idx])
+            self.replica_partition_masks.append(schema.partitionable_masks[idx] if table_filtered else 0)
+            self.replica_classes.append([mask for mask in classes.values() if mask & (mask - 1)])
+
+    @classmethod
+    def from_profile(cls, schema, table_columns, profile):
+        qcard_list = profile.qcard_list
+        if qcard_list is None:
+            qcard_list = [qcard_class() for qcard_class in qcard_classes]
+            for qcard in qcard_list:
+                qcard.init()
+        return cls(schema, table_columns, qcard_list, profile.tp_column_usage)
+
+    # 第idx个表可用的remove replica列: 去掉无关的列, 每个等价类只保留下标最小的列
+    def replica_candidates(self, idx, candidates):
+        candidates &= self.remove_replica_masks[idx]
+        for class_mask in self.replica_classes[idx]:
+            available = candidates & class_mask
+            if available:
+                candidates = (candidates & ~class_mask) | (available & -available)
+        return candidates
+
+    # 过滤dict格式State的action列表
+    def filter(self, actions):
+        schema = self.schema
+        replica_masks = {}
+        kept = []
+        for action in actions:
+            action_type, table_name, column_name = action
+            idx = schema.table_index[table_name]
+            bit = 1 << schema.column_index[idx][column_name]
+            if action_type == 'partition':
+                allowed = self.partition_masks[idx]
+            elif action_type == 'replica_partition':
+                allowed = self.replica_partition_masks[idx]
+            else:
+                replica_masks[idx] = replica_masks.get(idx, 0) | bit
+                continue
+            if allowed & bit:
+                kept.append(action)
+        for idx, candidates in replica_masks.items():
+            allowed = self.replica_candidates(idx, candidates)
+            for i, column in enumerate(schema.columns[idx]):
+                if allowed >> i & 1:
+                    kept.append(('remove replica', schema.names[idx], column))
+        return kept
+
+    def stats(self):
+        schema = self.schema
+        total = pruned = 0
+        for idx in range(len(schema.names)):
+            partitionable = bin(schema.partitionable_masks[idx]).count('1')
+            total += 2 * partitionable + len(schema.columns[idx])
+            pruned += 2 * partitionable - bin(self.partition_masks[idx]).count('1') - bin(self.replica_partition_masks[idx]).count('1')
+            pruned += len(schema.columns[idx]) - bin(self.remove_replica_masks[idx]).count('1')
+        equivalent = sum(bin(mask).count('1') - 1 for classes in self.replica_classes for mask in classes)
+        return {'actions': total, 'pruned': pruned, 'equivalent': equivalent, 'classes': sum(len(classes) for classes in self.replica_classes)}
@@ -0,0 +1,64 @@
+import time
+
+## 随时可停止(anytime)的MCTS
+## 原来monte_carlo_tree_search固定执行iterations轮, 结束后再从根节点沿best_child(c_param=0)找最佳配置
+## SearchBudget决定什么时候停止: 轮数用完, 超过时间预算, 或者最佳reward连续patience轮没有提升
+## BestConfiguration在反向传播时记录目前为止reward最高的配置, 每轮O(1), 搜索中任何时候都可以取出当前最佳配置
+
+class SearchBudget:
+    # iterations: 最多的轮数, None表示不限制
+    # time_budget: 最长的搜索时间(秒), None表示不限制
+    # patience: 最佳reward连续多少轮没有提升时停止(提升的阈值见BestConfiguration.min_improvement), None表示不检测收敛
+    def __init__(self, iterations=None, time_budget=None, patience=None):
+        if iterations is None and time_budget is None and patience is None:
+            raise ValueError("SearchBudget needs iterations, time_budget or patience")
+        self.iterations = iterations
+        self.time_budget = time_budget
+        self.patience = patience
+        self.start_time = None
+        self.stop_reason = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    # 第iteration轮开始前检查是否停止, best: BestConfiguration
+    def exhausted(self, iteration, best):
+        if self.iterations is not None and iteration >= self.iterations:
+            self.stop_reason = 'iterations'
+        elif self.time_budget is not None and self.elapsed() >= self.time_budget:
+            self.stop_reason = 'time_budget'
+        elif self.patience is not None and iteration - best.improved_iteration >= self.patience:
+            self.stop_reason = 'converged'
+        return self.stop_reason is not None
+
+
+class BestConfiguration:
+    def __init__(self, min_improvement=0.0):
+        self.min_improvement = min_improvement
+        self.reward = None
+        self.state = None # reward最高的rollout的终止状态
+        self.node = None # 这次rollout开始的树节点
+        self.iteration = None # 找到最佳配置的轮次
+        self.improved_iteration = 0 # 最佳reward最近一次提升超过min_improvement的轮次
+
+    # 反向传播时调用. state是不可变的CompactState, 只保存引用
+    def update(self, iteration, reward, state, node=None):
+        if self.reward is not None and reward <= self.reward:
+            return False
+        if self.reward is None or reward - self.reward > self.min_improvement:
+            self.improved_iteration = iteration
+        self.reward = reward
+        self.state = state
+        self.node = node
+        self.iteration = iteration
+        return True
+
+    @property
+    def tables(self):
+        return self.state.tables if self.state is not None else None
+
+    def stats(self):
+        return {'reward': self.reward, 'iteration': self.iteration, 'depth': self.node.depth if self.node is not None else None}
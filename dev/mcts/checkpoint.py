@@ -0,0 +1,180 @@
+import os
+import json
+import struct
+import logging
+
+import numpy as np
+
+from mcts.compact_state import CompactState
+
+## 搜索树的检查点
+## 6000轮的monte_carlo_tree_search要运行几个小时, 进程中断后整棵树就丢失了
+## 检查点不pickle Node/State对象(每个节点都带着所有表的dict), 而是把树展开成扁平数组:
+##   节点: 深度, 配置的统计(state_visits, state_reward)
+##   边: 父节点, 子节点, action下标, visits, reward, reward平方和, 先验概率
+##   action保存成字符串表的下标, 节点的状态不保存, 加载时从根节点的配置沿边重放action得到
+## 使用置换表时树是DAG, 节点按BFS顺序编号, 每个节点只保存一次, 多个父节点之间保存多条边
+##
+## 文件格式: magic(4B) version(u32) header长度(u32) header(JSON) 节点数组 边数组(小端)
+## header保存schema, 根节点的配置, action字符串表, 已完成的轮数, 最佳配置和workload的tag
+
+CHECKPOINT_MAGIC = b'JSMT'
+CHECKPOINT_VERSION = 1
+
+# (数组名, dtype), 按这个顺序写在header之后
+node_arrays = [('depth', '<i4'), ('state_visits', '<i8'), ('state_reward', '<f8')]
+edge_arrays = [('parent', '<i4'), ('child', '<i4'), ('action', '<i4'), ('visits', '<i8'), ('reward', '<f8'), ('sq_reward', '<f8'), ('prior', '<f8')]
+
+
+# 检查点只能在相同的表和列上加载
+def schema_signature(schema):
+    return [[name, list(columns)] for name, columns in zip(schema.names, schema.columns)]
+
+# BFS遍历, 返回节点列表和 节点id -> 编号
+def flatten_tree(root):
+    nodes = [root]
+    index = {id(root): 0}
+    for node in nodes:
+        for child in node.children:
+            if id(child) not in index:
+                index[id(child)] = len(nodes)
+                nodes.append(child)
+    return nodes, index
+
+# iterations: 已完成的轮数, best: BestConfiguration, tag: workload的标识(和RewardCache的tag一致)
+def save_checkpoint(path, root, iterations=0, best=None, tag=None):
+    nodes, index = flatten_tree(root)
+    action_index = {}
+    node_data = {name: np.zeros(len(nodes), dtype=dtype) for name, dtype in node_arrays}
+    edges = {name: [] for name, _ in edge_arrays}
+    for node_id, node in enumerate(nodes):
+        node_data['depth'][node_id] = node.depth
+        node_data['state_visits'][node_id] = node.state_visits
+        node_data['state_reward'][node_id] = node.state_reward
+        if not node.children:
+            continue
+        visits, rewards, sq_rewards, priors = node.children_stats()
+        for i, (child, action) in enumerate(zip(node.children, node.child_actions)):
+            edges['parent'].append(node_id)
+            edges['child'].append(index[id(child)])
+            edges['action'].append(action_index.setdefault(tuple(action), len(action_index)))
+            edges['visits'].append(visits[i])
+            edges['reward'].append(rewards[i])
+            edges['sq_reward'].append(sq_rewards[i])
+            edges['prior'].append(priors[i])
+
+    state = root.state
+    header = {
+        'tag': tag,
+        'iterations': iterations,
+        'schema': schema_signature(state.schema),
+        'root_tables': [{key: table[key] for key in ('name', 'partition_keys', 'replicas', 'replica_partition_keys')} for table in state.tables],
+        'root_stats': [int(root.visits), float(root.reward), float(root._sq_reward)],
+        'actions': [list(action) for action in action_index],
+        'nodes': len(nodes),
+        'edges': len(edges['parent']),
+        'best': None,
+    }
+    if best is not None and best.reward is not None:
+        header['best'] = {'reward': best.reward, 'iteration': best.iteration, 'tables': best.tables}
+    encoded = json.dumps(header, ensure_ascii=False).encode('utf-8')
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(CHECKPOINT_MAGIC)
+        f.write(struct.pack('<II', CHECKPOINT_VERSION, len(encoded)))
+        f.write(encoded)
+        for name, dtype in node_arrays:
+            f.write(node_data[name].tobytes())
+        for name, dtype in edge_arrays:
+            f.write(np.asarray(edges[name], dtype=dtype).tobytes())
+    os.replace(tmp_path, path)
+    logging.info(f"save checkpoint: {len(nodes)} nodes, {header['edges']} edges, {iterations} iterations to {path}")
+
+def read_checkpoint(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != CHECKPOINT_MAGIC:
+        raise ValueError(f"{path} is not a search tree checkpoint")
+    version, header_length = struct.unpack_from('<II', data, 4)
+    if version != CHECKPOINT_VERSION:
+        raise ValueError(f"Unsupported checkpoint version {version} in {path}")
+    offset = 12
+    header = json.loads(data[offset:offset + header_length].decode('utf-8'))
+    offset += header_length
+    arrays = {}
+    for specs, count in ((node_arrays, header['nodes']), (edge_arrays, header['edges'])):
+        for name, dtype in specs:
+            arrays[name] = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += count * np.dtype(dtype).itemsize
+    return header, arrays
+
+# 按原来的比例缩小visits, 平均reward不变. 热启动时旧workload的统计只作为先验, 新的rollout很快就能覆盖
+def decay_stats(visits, reward, decay):
+    if decay is None or visits == 0:
+        return visits, reward
+    decayed = int(visits * decay)
+    return decayed, reward * decayed / visits
+
+# 加载检查点, 重建搜索树. 返回 (根节点, header)
+# schema: ConfigSchema, 必须和保存检查点时的表和列一致; profile: 新节点使用的WorkloadProfile
+# node_class: 根节点的类, 子节点由new_child创建; transpositions: 置换表, 为None时不使用
+# decay: 热启动时visits的缩放比例(例如0.1), None表示原样恢复(中断后继续搜索)
+# 父节点的状态在当前profile下(例如ActionPruning变化后)不能执行的action, 边和只能经过这条边到达的子树都不恢复
+def load_checkpoint(path, schema, profile=None, node_class=None, transpositions=None, decay=None):
+    if node_class is None:
+        from mcts.mcts import Node
+        node_class = Node
+    header, arrays = read_checkpoint(path)
+    if header['schema'] != schema_signature(schema):
+        raise ValueError(f"Checkpoint {path} was saved for a different schema")
+
+    actions = [tuple(action) for action in header['actions']]
+    root = node_class(CompactState.from_tables(schema, header['root_tables'], profile=profile))
+    if transpositions is not None:
+        root.transpositions = transpositions
+        transpositions.register(root)
+    visits, reward = decay_stats(header['root_stats'][0], header['root_stats'][1], decay)
+    root.visits = visits
+    root.reward = reward
+    root._sq_reward = decay_stats(header['root_stats'][0], header['root_stats'][2], decay)[1]
+
+    depth = arrays['depth']
+    nodes = [root] + [None] * (header['nodes'] - 1)
+    legal_actions = {} # 节点编号 -> 可执行的action集合
+    dropped = 0
+    for parent_id, child_id, action_id, edge_visits, edge_reward, edge_sq_reward, prior in zip(
+            arrays['parent'], arrays['child'], arrays['action'], arrays['visits'], arrays['reward'], arrays['sq_reward'], arrays['prior']):
+        parent = nodes[parent_id]
+        action = actions[action_id]
+        if parent is None:
+            # 父节点没有重建: 先出现的入边都被丢弃了
+            dropped += 1
+            continue
+        if parent_id not in legal_actions:
+            legal_actions[parent_id] = set(parent.state.get_possible_actions())
+        if action not in legal_actions[parent_id]:
+            dropped += 1
+            continue
+        child = nodes[child_id]
+        if child is None:
+            # BFS编号保证第一次出现的边的父节点已经重建
+            child = parent.new_child(parent.state.take_action(action))
+            child.depth = int(depth[child_id])
+            nodes[child_id] = child
+        parent.add_child(child, action)
+        slot = len(parent.children) - 1
+        parent.child_visits[slot], parent.child_rewards[slot] = decay_stats(int(edge_visits), float(edge_reward), decay)
+        parent.child_sq_rewards[slot] = decay_stats(int(edge_visits), float(edge_sq_reward), decay)[1]
+        parent.child_priors[slot] = prior
+
+    for node, state_visits, state_reward in zip(nodes, arrays['state_visits'], arrays['state_reward']):
+        if node is not None:
+            node.state_visits, node.state_reward = decay_stats(int(state_visits), float(state_reward), decay)
+    restored = sum(node is not None for node in nodes)
+    logging.info(f"load checkpoint: {restored}/{len(nodes)} nodes, {header['edges'] - dropped}/{header['edges']} edges, "
+                 f"{header['iterations']} iterations from {path}")
+    return root, header
@@ -0,0 +1,170 @@
+from mcts.mcts import State
+
+## 紧凑的MCTS状态表示
+## State.take_action每次都deepcopy所有表的dict, simulate还要再deepcopy一次整个state
+## CompactState用固定的列下标(ch_columns_ranges_meta里每个表的columns顺序)表示每个表的配置:
+##   replicas: 位图(int), 第i位表示第i列有replica
+##   partition_keys / replica_partition_keys: 列下标的tuple, 保留加入顺序(分区裁剪用keys[0], 顺序会影响reward)
+## 状态不可变, take_action只替换被修改的那个表的配置, 其余表共享
+## 需要candidate dict格式时(calculate_reward, json输出)通过tables属性转换
+
+# 所有表的列下标, 由table_columns(ch_columns_ranges_meta里的*_columns类)构建, 整个搜索共享
+class ConfigSchema:
+    def __init__(self, table_columns):
+        self.names = [table_column.name for table_column in table_columns]
+        self.table_index = {name: idx for idx, name in enumerate(self.names)}
+        self.columns = [table_column.columns for table_column in table_columns]
+        self.partitionable_columns = [table_column.partitionable_columns for table_column in table_columns]
+        self.column_index = [{column: i for i, column in enumerate(columns)} for columns in self.columns]
+        # 每个表所有列的位图, 可分区列的位图
+        self.full_masks = [(1 << len(columns)) - 1 for columns in self.columns]
+        self.partitionable_masks = []
+        for idx, partitionable_columns in enumerate(self.partitionable_columns):
+            mask = 0
+            for column in partitionable_columns:
+                mask |= 1 << self.column_index[idx][column]
+            self.partitionable_masks.append(mask)
+
+    def columns_to_mask(self, table_idx, columns):
+        mask = 0
+        for column in columns:
+            mask |= 1 << self.column_index[table_idx][column]
+        return mask
+
+    def mask_to_columns(self, table_idx, mask):
+        return [column for i, column in enumerate(self.columns[table_idx]) if mask >> i & 1]
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class CompactState(State):
+    # configs: 每个表一个 (partition_keys, replicas, replica_partition_keys) 三元组, 顺序和schema.names一致
+    def __init__(self, schema, configs, action=None, profile=None):
+        super().__init__(None, action, profile)
+        self.schema = schema
+        self.configs = configs
+        self._tables = None
+        self._hash = None
+
+    @classmethod
+    def from_tables(cls, schema, tables, profile=None):
+        configs = [None] * len(schema.names)
+        for table in tables:
+            idx = schema.table_index[table['name']]
+            column_index = schema.column_index[idx]
+            partition_keys = tuple(column_index[column] for column in table['partition_keys'])
+            replicas = schema.columns_to_mask(idx, table['replicas'])
+            replica_partition_keys = tuple(column_index[column] for column in table['replica_partition_keys'])
+            configs[idx] = (partition_keys, replicas, replica_partition_keys)
+        return cls(schema, tuple(configs), None, profile)
+
+    # 转换回candidate dict格式, 转换结果缓存
+    @property
+    def tables(self):
+        if self._tables is None:
+            self._tables = self.to_tables()
+        return self._tables
+
+    @tables.setter
+    def tables(self, value):
+        # State.__init__会设置tables, CompactState的tables由configs生成
+        self._tables = value
+
+    def to_tables(self):
+        schema = self.schema
+        tables = []
+        for idx, (partition_keys, replicas, replica_partition_keys) in enumerate(self.configs):
+            columns = schema.columns[idx]
+            tables.append({
+                'name': schema.names[idx],
+                'columns': columns,
+                'partitionable_columns': schema.partitionable_columns[idx],
+                'partition_keys': [columns[i] for i in partition_keys],
+                'replicas': schema.mask_to_columns(idx, replicas),
+                'replica_partition_keys': [columns[i] for i in replica_partition_keys],
+            })
+        return tables
+
+    # 一个表可能的动作, get_possible_actions和take_action的增量更新使用(见State.get_possible_actions)
+    def table_actions(self, idx):
+        schema = self.schema
+        pruning = self.profile.action_pruning
+        partition_keys, replicas, replica_partition_keys = self.configs[idx]
+        name = schema.names[idx]
+        columns = schema.columns[idx]
+        partitionable = schema.partitionable_masks[idx]
+        partition_mask = keys_mask(partition_keys)
+        replica_partition_mask = keys_mask(replica_partition_keys)
+
+        ## 初始默认全表replica, action移除列的replica
+        partition_candidates = partitionable & ~replica_partition_mask & ~partition_mask
+        replica_candidates = replicas & ~partition_mask
+        replica_partition_candidates = partitionable & replicas & ~replica_partition_mask
+
+        # 去掉不会改变reward的action
+        if pruning is not None:
+            partition_candidates &= pruning.partition_masks[idx]
+            replica_candidates = pruning.replica_candidates(idx, replica_candidates)
+            replica_partition_candidates &= pruning.replica_partition_masks[idx]
+
+        actions = []
+        for i, column in enumerate(columns):
+            bit = 1 << i
+            if partition_candidates & bit:
+                actions.append(('partition', name, column))
+            if replica_candidates & bit:
+                actions.append(('remove replica', name, column))
+            if replica_partition_candidates & bit:
+                actions.append(('replica_partition', name, column))
+        return tuple(actions)
+
+    def get_table_actions(self):
+        if self._table_actions is None:
+            self._table_actions = [self.table_actions(idx) for idx in range(len(self.configs))]
+        return self._table_actions
+
+    def take_action(self, action):
+        # 只替换被修改的表的配置, 其余表共享
+        action_type, table_name, column_name = action
+        idx = self.schema.table_index[table_name]
+        column_idx = self.schema.column_index[idx][column_name]
+        partition_keys, replicas, replica_partition_keys = self.configs[idx]
+        bit = 1 << column_idx
+        if action_type == 'partition':
+            partition_keys = partition_keys + (column_idx,)
+            replicas = replicas & ~bit ## 初始默认全表replica, action移除列的replica
+        elif action_type == 'remove replica':
+            replicas = replicas & ~bit
+        elif action_type == 'replica_partition':
+            replica_partition_keys = replica_partition_keys + (column_idx,)
+        configs = self.configs[:idx] + ((partition_keys, replicas, replica_partition_keys),) + self.configs[idx + 1:]
+        new_state = CompactState(self.schema, configs, action, self.profile)
+        # 只有被修改的表的action会变化
+        if self._table_actions is not None:
+            table_actions = list(self._table_actions)
+            table_actions[idx] = new_state.table_actions(idx)
+            new_state._table_actions = table_actions
+        return new_state
+
+    def key(self):
+        return self.configs
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.configs)
+        return self._hash
+
+    def __eq__(self, other):
+        return isinstance(other, CompactState) and self.configs == other.configs
+
+    # 状态不可变, simulate里的deepcopy不需要复制
+    def __deepcopy__(self, memo):
+        return self
+
+
+def keys_mask(column_idxs):
+    mask = 0
+    for i in column_idxs:
+        mask |= 1 << i
+    return mask
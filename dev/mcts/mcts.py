@@ -1,6 +1,8 @@
 import math
 import random
 import copy
+from itertools import chain
+import numpy as np
 from fpdf import FPDF
 import time
 import logging
@@ -8,12 +10,19 @@ import random
 
 from estimator.ch_query_card import *
 from log.logging_config import setup_logging
-from workload.workload_analyzer import get_normalized_column_usage, tp_column_usage
+from workload.workload_analyzer import get_normalized_column_usage, tp_column_usage, get_default_workload_profile
+from mcts.reward_cache import config_fingerprint
+from mcts.tracing import tracer, DEBUG, INFO, WARNING
 
 class State:
-    def __init__(self, tables, action=None):
+    def __init__(self, tables, action=None, profile=None):
         self.tables = tables # 记录每个表的分区键和副本情况
         self.action = action # 即将执行的三元组(action_type, table_name, column_name)
+        if profile is None:
+            profile = get_default_workload_profile()
+        self.profile = profile # workload的列使用情况(WorkloadProfile), 整个搜索共享
+        self._table_actions = None # 每个表可执行的action, 第一次get_possible_actions时计算
+        self._actions = None
 
     # action设置优先级。根据normalized_usage列的查询更新情况对action进行排序---------------
     def sort_actions(self, actions, normalized_usage, zero_values):
@@ -24,54 +33,71 @@ class State:
             else:
                 return random.uniform(1 - zero_values, 1)
 
-        actions.sort(key=action_key)
-        return actions
+        # actions可能是get_possible_actions返回的tuple, 排序结果是新的列表
+        return sorted(actions, key=action_key)
 
+    # 可执行的action, 返回不可变的tuple, 调用方不能修改
+    # 每个表的action分别缓存, take_action只重新计算被修改的表, 其余表的action从父状态继承
+    # 顺序固定(表的顺序), 需要随机顺序的调用方自己打乱
     def get_possible_actions(self):
-        # 获取可能的动作（选择分区键或设置副本）
+        if self._actions is None:
+            self._actions = tuple(chain.from_iterable(self.get_table_actions()))
+        return self._actions
+
+    # 每个表的action的tuple, 顺序和self.tables一致
+    def get_table_actions(self):
+        if self._table_actions is None:
+            self._table_actions = [self.table_actions(table) for table in self.tables]
+        return self._table_actions
+
+    def table_actions(self, table):
+        # 获取一个表可能的动作（选择分区键或设置副本）
         actions = []
-        for table in self.tables:
-            #partition_candidates = set(table['partitionable_columns']) - set(table['replicas'])
-            #replica_candidates = set(table['columns']) - set(table['partition_keys'])
-            #replica_partition_candidates = set(table['partitionable_columns']) & set(table['replicas'])
-
-            ## 初始默认全表replica, action移除列的replica
-            partition_candidates = set(table['partitionable_columns']) - set(table['replica_partition_keys'])
-            replica_candidates = set(table['columns']) - set(table['partition_keys'])
-            replica_partition_candidates = set(table['partitionable_columns']) & set(table['replicas'])
-
-            #print("partition_candidates:", partition_candidates)
-            #print("replica_partition_candidates:", replica_partition_candidates)
-
-            # for column in partition_candidates:
-            #     if column not in table['partition_keys']:
-            #         actions.append(('partition', table['name'], column))
-            # for column in replica_candidates:
-            #     if column not in table['replicas']:
-            #         actions.append(('replica', table['name'], column))
-            # for column in replica_partition_candidates:
-            #     if column not in table['replica_partition_keys']:
-            #         actions.append(('replica_partition', table['name'], column))
-
-            ## 初始默认全表replica, action移除列的replica
-            for column in partition_candidates:
-                if column not in table['partition_keys']:
-                    actions.append(('partition', table['name'], column))
-            for column in replica_candidates:
-                if column in table['replicas']:  
-                    actions.append(('remove replica', table['name'], column))
-            for column in replica_partition_candidates:
-                if column not in table['replica_partition_keys']:
-                    actions.append(('replica_partition', table['name'], column))
-
-        random.shuffle(actions)  # 打乱actions的顺序
-        return actions
+        #partition_candidates = set(table['partitionable_columns']) - set(table['replicas'])
+        #replica_candidates = set(table['columns']) - set(table['partition_keys'])
+        #replica_partition_candidates = set(table['partitionable_columns']) & set(table['replicas'])
+
+        ## 初始默认全表replica, action移除列的replica
+        partition_candidates = set(table['partitionable_columns']) - set(table['replica_partition_keys'])
+        replica_candidates = set(table['columns']) - set(table['partition_keys'])
+        replica_partition_candidates = set(table['partitionable_columns']) & set(table['replicas'])
+
+        #print("partition_candidates:", partition_candidates)
+        #print("replica_partition_candidates:", replica_partition_candidates)
+
+        # for column in partition_candidates:
+        #     if column not in table['partition_keys']:
+        #         actions.append(('partition', table['name'], column))
+        # for column in replica_candidates:
+        #     if column not in table['replicas']:
+        #         actions.append(('replica', table['name'], column))
+        # for column in replica_partition_candidates:
+        #     if column not in table['replica_partition_keys']:
+        #         actions.append(('replica_partition', table['name'], column))
+
+        ## 初始默认全表replica, action移除列的replica
+        for column in partition_candidates:
+            if column not in table['partition_keys']:
+                actions.append(('partition', table['name'], column))
+        for column in replica_candidates:
+            if column in table['replicas']:  
+                actions.append(('remove replica', table['name'], column))
+        for column in replica_partition_candidates:
+            if column not in table['replica_partition_keys']:
+                actions.append(('replica_partition', table['name'], column))
+
+        # 去掉不会改变reward的action
+        if self.profile.action_pruning is not None:
+            actions = self.profile.action_pruning.filter(actions)
+        return tuple(actions)
 
     def take_action(self, action):
         # 返回新的状态给新节点
         new_tables = [copy.deepcopy(table) for table in self.tables]
-        for table in new_tables:
+        changed = None
+        for idx, table in enumerate(new_tables):
             if table['name'] == action[1]:
+                changed = idx
                 if action[0] == 'partition':
                     # logging.info(f"partition action: {action}")
                     # logging.info(f"table replica: {table['replicas']}")
@@ -84,7 +110,13 @@ class State:
                     table['replicas'].remove(action[2])  ## 初始默认全表replica, action移除列的replica
                 elif action[0] == 'replica_partition':
                     table['replica_partition_keys'].append(action[2])
-        return State(new_tables, action)
+        new_state = State(new_tables, action, self.profile)
+        # 只有被修改的表的action会变化
+        if self._table_actions is not None and changed is not None:
+            table_actions = list(self._table_actions)
+            table_actions[changed] = new_state.table_actions(new_tables[changed])
+            new_state._table_actions = table_actions
+        return new_state
 
     # def is_terminal(self):
     #     # 判断是否为终止状态
@@ -97,31 +129,160 @@ class State:
         # 计算当前状态的收益
         return calculate_reward(self.tables)
 
+    # 配置的规范化key, 用于置换表
+    def key(self):
+        return config_fingerprint(self.tables)
+
+# action的先验, 越大越优先. 分析查询访问多的列适合做分区键, 访问少(更新多)的列适合移除replica
+def action_prior(action, normalized_usage):
+    action_type, table_name, column_name = action
+    usage = normalized_usage.get(table_name, {}).get(column_name, 0)
+    if action_type == 'remove replica':
+        return 1 - usage
+    return usage
+
 class Node:
+    # 子节点选择策略: 'ucb1', 'ucb1_tuned', 'puct'
+    policy = 'ucb1'
+    # 子节点扩展策略, 用set_expansion_policy设置
+    # 'widening': 渐进扩展, 访问visits次的节点最多 widening_k * visits^widening_alpha 个子节点
+    # 'fixed': 每个节点最多max_children个子节点
+    expansion = 'widening'
+    widening_k = 1.0
+    widening_alpha = 0.5
+    max_children = 50
+
     def __init__(self, state, parent=None, depth=0):
         self.state = state
         self.parent = parent
         self.children = []
+        self.child_actions = [] # 每个子节点对应的action. 置换表连接的子节点, state.action是它第一个父节点的action
+        self.depth = depth  # 添加深度属性
+        self._ordered_actions = None # 按先验排序的action, 第一次扩展时生成
+        # 置换表, 子节点继承父节点的置换表. None表示不使用
+        self.transpositions = parent.transpositions if parent is not None else None
+        # 配置的统计, 使用置换表时所有父节点共享
+        self.state_visits = 0
+        self.state_reward = 0
+
+        # 子节点的visits, reward, reward平方和, 先验概率存放在连续数组中, 下标为子节点的slot
+        # best_child一次向量化计算所有子节点的UCB
+        self.child_visits = np.zeros(4, dtype=np.int64)
+        self.child_rewards = np.zeros(4, dtype=np.float64)
+        self.child_sq_rewards = np.zeros(4, dtype=np.float64)
+        self.child_priors = np.ones(4, dtype=np.float64)
+        self.num_slots = 0
+
+        # 节点自己的统计存放在父节点的数组中, 根节点存放在对象属性中
+        self.slot = parent.allocate_slot() if parent is not None else None
+        self._visits = 0
+        self._reward = 0
+        self._sq_reward = 0
         self.visits = 0
         self.reward = 0
-        self.depth = depth  # 添加深度属性
+
+    # 为新的子节点分配数组下标, 数组满时容量翻倍
+    def allocate_slot(self):
+        if self.num_slots == len(self.child_visits):
+            capacity = 2 * len(self.child_visits)
+            self.child_visits = np.resize(self.child_visits, capacity)
+            self.child_rewards = np.resize(self.child_rewards, capacity)
+            self.child_sq_rewards = np.resize(self.child_sq_rewards, capacity)
+            self.child_priors = np.resize(self.child_priors, capacity)
+            self.child_visits[self.num_slots:] = 0
+            self.child_rewards[self.num_slots:] = 0
+            self.child_sq_rewards[self.num_slots:] = 0
+            self.child_priors[self.num_slots:] = 1
+        slot = self.num_slots
+        self.num_slots += 1
+        return slot
+
+    @property
+    def visits(self):
+        if self.parent is None:
+            return self._visits
+        return self.parent.child_visits[self.slot]
+
+    @visits.setter
+    def visits(self, value):
+        if self.parent is None:
+            self._visits = value
+        else:
+            self.parent.child_visits[self.slot] = value
+
+    @property
+    def reward(self):
+        if self.parent is None:
+            return self._reward
+        return self.parent.child_rewards[self.slot]
+
+    @reward.setter
+    def reward(self, value):
+        if self.parent is None:
+            self._reward = value
+        else:
+            self.parent.child_rewards[self.slot] = value
+
+    # 配置被访问的总次数. 使用置换表时节点可能有多个父节点, visits只是第一个父节点的边上的次数,
+    # 选择的探索项和渐进扩展都要用所有父节点共享的state_visits
+    @property
+    def total_visits(self):
+        if self.transpositions is not None:
+            return self.state_visits
+        return self.visits
+
+    # 选择策略为puct时使用的先验概率
+    @property
+    def prior(self):
+        if self.parent is None:
+            return 1.0
+        return self.parent.child_priors[self.slot]
+
+    @prior.setter
+    def prior(self, value):
+        if self.parent is not None:
+            self.parent.child_priors[self.slot] = value
+
+    # 子节点的(visits, rewards, reward平方和, priors)数组, 顺序和self.children一致
+    def children_stats(self):
+        n = len(self.children)
+        if n == self.num_slots:
+            return self.child_visits[:n], self.child_rewards[:n], self.child_sq_rewards[:n], self.child_priors[:n]
+        slots = [child.slot for child in self.children]
+        return self.child_visits[slots], self.child_rewards[slots], self.child_sq_rewards[slots], self.child_priors[slots]
+
+    # 按先验(action_prior, 列的查询更新情况)从高到低排序的action, 每个节点只排序一次
+    # 渐进扩展按这个顺序依次加入子节点, 先验高的action先扩展. 先验相同时保持get_possible_actions的顺序, 结果是确定的
+    def ordered_actions(self):
+        if self._ordered_actions is None:
+            normalized_usage = self.state.profile.normalized_usage
+            actions = self.state.get_possible_actions()
+            self._ordered_actions = sorted(actions, key=lambda action: action_prior(action, normalized_usage), reverse=True)
+        return self._ordered_actions
+
+    # 当前访问次数下允许的子节点数, 不超过可执行的action数
+    def allowed_children(self):
+        num_actions = len(self.ordered_actions())
+        if self.expansion == 'fixed':
+            return min(self.max_children, num_actions)
+        allowed = max(1, int(self.widening_k * self.total_visits ** self.widening_alpha))
+        return min(allowed, num_actions)
 
     def is_fully_expanded(self):
         # 判断节点是否已经完全扩展. 即是否所有可能的动作都已经尝试过
         # return len(self.children) == len(self.state.get_possible_actions())        
     
         # 测试部分action扩展. 对于一些意义不大的列, 不需要扩展
-        # 获取列的查询更新信息, 设置action优先级
-        qcard_list = [Q1card(), Q2card(), Q3card(), Q4card(), Q5card(), Q6card(), Q7card(), Q8card(), Q9card(), Q10card(), Q11card(), Q12card(), Q13card(), Q14card(), Q15card(), Q16card(), Q17card(), Q18card(), Q19card(), Q20card(), Q21card(), Q22card()]
-        for qcard in qcard_list:
-            qcard.init()           
-        normalized_usage, zero_values, zero_values_num, ap_values_num = get_normalized_column_usage(qcard_list, tp_column_usage)
-        # logging.info(f"zero_values_num: {zero_values_num}")
-        # logging.info(f"ap_values_num: {ap_values_num}")
+        # 列的查询更新信息在self.state.profile中, 整个搜索只计算一次
+        # logging.info(f"zero_values_num: {self.state.profile.zero_values_num}")
+        # logging.info(f"ap_values_num: {self.state.profile.ap_values_num}")
 
         # 减去意义不大的列的扩展
-        #return len(self.children) >= (len(self.state.get_possible_actions()) - zero_values_num)
-        return len(self.children) >= 50
+        #return len(self.children) >= (len(self.state.get_possible_actions()) - self.state.profile.zero_values_num)
+        # return len(self.children) >= 50
+        # 固定50个子节点时, 浅层节点访问次数多却只能在50个子节点中选择, 深层节点访问很少也要先扩展50个子节点
+        # 渐进扩展让子节点数随访问次数增长
+        return len(self.children) >= self.allowed_children()
     #(len(self.state.get_possible_actions()) - ap_values_num - zero_values_num) #### 初始默认全表replica, action移除列的replica
 
     def is_actual_fully_expanded(self):
@@ -129,79 +290,108 @@ class Node:
         # return len(self.children) == len(self.state.get_possible_actions())        
     
         # 测试部分action扩展. 对于一些意义不大的列, 不需要扩展
-        # 获取列的查询更新信息, 设置action优先级
-        qcard_list = [Q1card(), Q2card(), Q3card(), Q4card(), Q5card(), Q6card(), Q7card(), Q8card(), Q9card(), Q10card(), Q11card(), Q12card(), Q13card(), Q14card(), Q15card(), Q16card(), Q17card(), Q18card(), Q19card(), Q20card(), Q21card(), Q22card()]
-        for qcard in qcard_list:
-            qcard.init()           
-        normalized_usage, zero_values, zero_values_num, ap_values_num = get_normalized_column_usage(qcard_list, tp_column_usage)
-        # logging.info(f"zero_values_num: {zero_values_num}")
-        # logging.info(f"ap_values_num: {ap_values_num}")
+        # 列的查询更新信息在self.state.profile中, 整个搜索只计算一次
+        zero_values_num = self.state.profile.zero_values_num
 
         # 减去意义不大的列的扩展
         return len(self.children) >= (len(self.state.get_possible_actions()) - zero_values_num)
 
         
 
-    def best_child(self, c_param=1):
+    def best_child(self, c_param=1, policy=None):
         # 使用UCB1策略选择最佳子节点
         if not self.children:
-            print(self.state.tables)
-            raise ValueError("No children to select from")
-        for child in self.children:
-            if child.visits == 0:
-                print("child.visits == 0")
-                print(child.depth)
-                print(child.state.tables)
-        choices_weights = [
-            (child.reward / child.visits) + c_param * math.sqrt((math.log(self.visits) / child.visits))
-            for child in self.children
-        ]
-        # for child in self.children:
-        #     print("(child.reward / child.visits): ", (child.reward / child.visits))
-        #     print("cparams: ", c_param * math.sqrt((math.log(self.visits) / child.visits)))
-        # print("best child: ",choices_weights.index(max(choices_weights)))
-        logging.info(f"best child: {choices_weights.index(max(choices_weights))}")
-        return self.children[choices_weights.index(max(choices_weights))]
+            # 错误很少出现, 不受采样限制
+            tracer.emit(WARNING, 'no_children', depth=self.depth, tables=lambda: self.state.tables)
+            raise ValueError(f"No children to select from, depth: {self.depth}")
+        visits, rewards, sq_rewards, priors = self.children_stats()
+        if tracer.debug_active and not visits.all():
+            tracer.emit(DEBUG, 'unvisited_children', depth=self.depth, count=int((visits == 0).sum()))
+
+        if policy is None:
+            policy = self.policy
+        parent_visits = max(self.total_visits, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.transpositions is None:
+                mean = rewards / visits
+            else:
+                # 使用置换表时, exploitation用配置在所有父节点下的平均reward
+                state_visits = np.array([child.state_visits for child in self.children], dtype=np.float64)
+                state_rewards = np.array([child.state_reward for child in self.children], dtype=np.float64)
+                mean = np.where(state_visits > 0, state_rewards / state_visits, rewards / visits)
+            if policy == 'ucb1':
+                weights = mean + c_param * np.sqrt(math.log(parent_visits) / visits)
+            elif policy == 'ucb1_tuned':
+                variance = sq_rewards / visits - mean * mean + np.sqrt(2 * math.log(parent_visits) / visits)
+                weights = mean + c_param * np.sqrt(math.log(parent_visits) / visits * np.minimum(0.25, variance))
+            elif policy == 'puct':
+                mean = np.where(visits > 0, mean, 0.0)
+                weights = mean + c_param * priors * math.sqrt(parent_visits) / (1 + visits)
+            else:
+                raise ValueError(f"Unsupported selection policy: {policy}")
+        # 没有访问过的子节点优先选择
+        if policy != 'puct':
+            weights = np.where(visits > 0, weights, np.inf)
+        best = int(np.argmax(weights))
+        # print("best child: ", best)
+        if tracer.debug_active:
+            tracer.emit(DEBUG, 'best_child', depth=self.depth, child=best)
+        return self.children[best]
     
     # 找到最大reward的节点
     def best_reward_node(self):
         if not self.children:
-            print(self.state.tables)
-            raise ValueError("No children to select from")
-        for child in self.children:
-            if child.visits == 0:
-                print("child.visits == 0")
-                print(child.depth)
-                print(child.state.tables)
-        choices_weights = [
-            child.reward for child in self.children
-        ]
-        return self.children[choices_weights.index(max(choices_weights))]
+            # 错误很少出现, 不受采样限制
+            tracer.emit(WARNING, 'no_children', depth=self.depth, tables=lambda: self.state.tables)
+            raise ValueError(f"No children to select from, depth: {self.depth}")
+        _, rewards, _, _ = self.children_stats()
+        return self.children[int(np.argmax(rewards))]
+
+    # 平均reward最高的访问过的子节点, 没有访问过的子节点时返回None. 用于搜索结束后选择最佳配置
+    # 搜索提前停止时可能有没有访问过的子节点, best_child(c_param=0)会选到平均reward为nan/inf的子节点
+    def best_visited_child(self):
+        if not self.children:
+            return None
+        visits, rewards, _, _ = self.children_stats()
+        if not visits.any():
+            return None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.transpositions is None:
+                mean = rewards / visits
+            else:
+                state_visits = np.array([child.state_visits for child in self.children], dtype=np.float64)
+                state_rewards = np.array([child.state_reward for child in self.children], dtype=np.float64)
+                mean = np.where(state_visits > 0, state_rewards / state_visits, rewards / visits)
+        mean = np.where(visits > 0, mean, -np.inf)
+        return self.children[int(np.argmax(mean))]
 
     def expand(self):
-        # 扩展节点
-        actions = self.state.get_possible_actions()
-
-        # 获取列的查询更新信息, 设置action优先级
-        qcard_list = [Q1card(), Q2card(), Q3card(), Q4card(), Q5card(), Q6card(), Q7card(), Q8card(), Q9card(), Q10card(), Q11card(), Q12card(), Q13card(), Q14card(), Q15card(), Q16card(), Q17card(), Q18card(), Q19card(), Q20card(), Q21card(), Q22card()]
-        for qcard in qcard_list:
-            qcard.init()        
-        normalized_usage, zero_values, _, _ = get_normalized_column_usage(qcard_list, tp_column_usage)
-        actions = self.state.sort_actions(actions, normalized_usage, zero_values)
-        logging.info(f"get actions: {actions[:10]}")
+        # 扩展节点. action按列的查询更新信息排好序, 依次选择第一个没有尝试过的action
+        actions = self.ordered_actions()
+        if tracer.debug_active:
+            tracer.emit(DEBUG, 'actions', depth=self.depth, count=len(actions), actions=lambda: actions[:10])
 
         #print("expand node depth:", self.depth)
         #print("actions:", actions)
+        tried_actions = set(self.child_actions)
         for action in actions:
-            if action not in [child.state.action for child in self.children]:
+            if action not in tried_actions:
                 new_state = self.state.take_action(action)
-                child_node = Node(new_state, self, self.depth + 1)  # 更新子节点的深度
-                self.children.append(child_node)
+                # 置换表里已经有相同配置的节点, 直接连接
+                if self.transpositions is not None:
+                    existing = self.transpositions.lookup(new_state)
+                    if existing is not None:
+                        self.add_child(existing, action)
+                        if tracer.active:
+                            tracer.emit(INFO, 'expand', depth=self.depth, action=action, transposition=True)
+                        return existing
+                child_node = self.new_child(new_state)  # 更新子节点的深度
+                self.add_child(child_node, action)
                 #print("take action:", action)
                 # print("append child to node depth:", self.depth)
                 # print("child action:", action)
-                logging.info(f"append child to node depth: {self.depth}")
-                logging.info(f"child action: {action}")
+                if tracer.active:
+                    tracer.emit(INFO, 'expand', depth=self.depth, action=action, transposition=False)
                 return child_node
         raise Exception("Should never reach here")
     
@@ -210,27 +400,75 @@ class Node:
         actions = self.state.get_possible_actions()
 
         # 不设置action优先级
-        logging.info(f"get actions: {actions[:10]}")
+        if tracer.debug_active:
+            tracer.emit(DEBUG, 'actions', depth=self.depth, count=len(actions), actions=lambda: actions[:10])
 
         #print("expand node depth:", self.depth)
         #print("actions:", actions)
+        tried_actions = set(self.child_actions)
         for action in actions:
-            if action not in [child.state.action for child in self.children]:
+            if action not in tried_actions:
                 new_state = self.state.take_action(action)
-                child_node = Node(new_state, self, self.depth + 1)  # 更新子节点的深度
-                self.children.append(child_node)
+                child_node = self.new_child(new_state)  # 更新子节点的深度
+                self.add_child(child_node, action)
                 #print("take action:", action)
                 # print("append child to node depth:", self.depth)
                 # print("child action:", action)
-                logging.info(f"append child to node depth: {self.depth}")
-                logging.info(f"child action: {action}")
+                if tracer.active:
+                    tracer.emit(INFO, 'expand', depth=self.depth, action=action)
                 return child_node
         raise Exception("Should never reach here")    
 
+    # 创建子节点, 子类(例如共享内存统计的节点)可以重写
+    def new_child(self, state):
+        return Node(state, self, self.depth + 1)
+
+    # 加入子节点. 子节点由new_child创建时已经在本节点分配了slot;
+    # 置换表连接的已有节点在本节点重新分配一个slot, 保证children[i]的边统计在数组下标i
+    def add_child(self, child, action=None):
+        if child.parent is not self:
+            self.allocate_slot()
+        elif self.transpositions is not None:
+            self.transpositions.register(child)
+        self.children.append(child)
+        self.child_actions.append(action if action is not None else child.state.action)
+
     def update(self, reward):
         # 更新节点的访问次数和奖励
         self.visits += 1
         self.reward += reward
+        if self.parent is None:
+            self._sq_reward += reward * reward
+        else:
+            self.parent.child_sq_rewards[self.slot] += reward * reward
+
+# 设置所有节点的子节点扩展策略
+# expansion: 'widening' 或 'fixed', 其余参数为None时保持当前值
+def set_expansion_policy(expansion, widening_k=None, widening_alpha=None, max_children=None):
+    if expansion not in ('widening', 'fixed'):
+        raise ValueError(f"Unsupported expansion policy: {expansion}")
+    Node.expansion = expansion
+    if widening_k is not None:
+        Node.widening_k = widening_k
+    if widening_alpha is not None:
+        Node.widening_alpha = widening_alpha
+    if max_children is not None:
+        Node.max_children = max_children
+
+# 使用置换表时沿选择路径反向传播. path: 从根节点到叶节点的节点列表
+# 边的统计存放在父节点的数组中, 配置的统计在节点的state_visits/state_reward上
+def backpropagate_path(path, reward):
+    root = path[0]
+    root.update(reward)
+    root.state_visits += 1
+    root.state_reward += reward
+    for parent, node in zip(path, path[1:]):
+        slot = next(i for i, child in enumerate(parent.children) if child is node)
+        parent.child_visits[slot] += 1
+        parent.child_rewards[slot] += reward
+        parent.child_sq_rewards[slot] += reward * reward
+        node.state_visits += 1
+        node.state_reward += reward
 
 def calculate_reward(tables):
     # 假设的收益计算模型
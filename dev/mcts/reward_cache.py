@@ -0,0 +1,90 @@
+import os
+import pickle
+import logging
+from collections import OrderedDict
+
+## 缓存calculate_reward的结果. MCTS的随机rollout经常落到已经评估过的配置上,
+## 同一个配置的reward只和每个表的partition_keys, replicas, replica_partition_keys有关
+
+# 配置的规范化指纹
+# 与candidates列表中表的顺序无关, 也与replicas列的顺序无关
+# partition_keys和replica_partition_keys保留顺序: update_partition_metadata按keys[0]做分区裁剪, 顺序不同reward可能不同
+def config_fingerprint(candidates):
+    fingerprint = []
+    for candidate in candidates:
+        fingerprint.append((
+            candidate['name'],
+            tuple(candidate['partition_keys']),
+            tuple(sorted(candidate['replicas'])) if candidate['replicas'] is not None else None,
+            tuple(candidate['replica_partition_keys']),
+        ))
+    fingerprint.sort(key=lambda item: item[0])
+    return tuple(fingerprint)
+
+
+class RewardCache:
+    def __init__(self, capacity=100000, tag=None):
+        self.capacity = capacity # 最多缓存的配置数, 超过后按LRU淘汰
+        self.tag = tag # 标识workload, 只加载相同tag的缓存文件
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, candidates):
+        key = config_fingerprint(candidates)
+        reward = self.entries.get(key)
+        if reward is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return reward
+
+    def put(self, candidates, reward):
+        key = config_fingerprint(candidates)
+        self.entries[key] = reward
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    # 持久化到磁盘, 下一次在相同workload上运行advisor时可以直接加载
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'tag': self.tag, 'entries': list(self.entries.items())}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    # 从磁盘加载缓存, 文件不存在或tag不一致时返回False
+    def load(self, path):
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('tag') != self.tag:
+            logging.info(f"Skip reward cache {path}: tag {data.get('tag')} != {self.tag}")
+            return False
+        for key, reward in data['entries']:
+            self.entries[key] = reward
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return True
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate()}
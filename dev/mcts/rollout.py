@@ -0,0 +1,108 @@
+import math
+import random
+
+from mcts.mcts import action_prior
+
+## 可替换的rollout策略
+## 原来的rollout每一步从所有action中均匀随机选择, 一直执行到max_depth, 然后完整计算一次reward
+## 大部分随机rollout的结果是噪声, 搜索需要几千次rollout才能得到有用的信号
+## 策略:
+##   'random': 原来的均匀随机策略
+##   'greedy': 每一步选择先验最高的action
+##   'epsilon_greedy': 以epsilon的概率随机选择, 否则选择先验最高的action
+##   'truncated': 执行k步之后停止, 用截断的配置的reward作为价值估计.
+##                截断的配置改动的表少, 增量计算只需要重新计算很少的query, 相同的浅层配置也容易命中reward缓存
+## action的先验(mcts.action_prior)和渐进扩展的顺序一致, 来自profile.normalized_usage
+## 每个策略记录rollout次数, 耗时(rollouts/sec)和reward的方差
+
+
+class RolloutPolicy:
+    name = None
+    max_steps = None # rollout最多执行的步数, None表示执行到max_depth
+
+    def __init__(self):
+        self.rollouts = 0
+        self.elapsed = 0.0
+        # Welford算法累计reward的均值和方差
+        self.reward_mean = 0.0
+        self.reward_m2 = 0.0
+
+    def choose(self, state, actions, profile):
+        raise NotImplementedError
+
+    # 记录一次rollout(包括reward计算)的耗时和reward
+    def record(self, elapsed, reward):
+        self.rollouts += 1
+        self.elapsed += elapsed
+        delta = reward - self.reward_mean
+        self.reward_mean += delta / self.rollouts
+        self.reward_m2 += delta * (reward - self.reward_mean)
+
+    def stats(self):
+        variance = self.reward_m2 / (self.rollouts - 1) if self.rollouts > 1 else 0.0
+        return {
+            'policy': self.name,
+            'rollouts': self.rollouts,
+            'rollouts_per_sec': self.rollouts / self.elapsed if self.elapsed > 0 else 0.0,
+            'reward_mean': self.reward_mean,
+            'reward_std': math.sqrt(variance),
+            'reward_var': variance,
+        }
+
+
+class RandomRollout(RolloutPolicy):
+    name = 'random'
+
+    def choose(self, state, actions, profile):
+        return random.choice(actions)
+
+
+class GreedyRollout(RolloutPolicy):
+    name = 'greedy'
+
+    # 先验相同时随机选择
+    def choose(self, state, actions, profile):
+        normalized_usage = profile.normalized_usage
+        priors = [action_prior(action, normalized_usage) for action in actions]
+        best = max(priors)
+        return random.choice([action for action, prior in zip(actions, priors) if prior == best])
+
+
+class EpsilonGreedyRollout(GreedyRollout):
+    name = 'epsilon_greedy'
+
+    def __init__(self, epsilon=0.2):
+        super().__init__()
+        self.epsilon = epsilon
+
+    def choose(self, state, actions, profile):
+        if random.random() < self.epsilon:
+            return random.choice(actions)
+        return super().choose(state, actions, profile)
+
+
+class TruncatedRollout(RolloutPolicy):
+    name = 'truncated'
+
+    # steps: 执行的步数, base: 每一步选择action的策略
+    def __init__(self, steps=3, base=None):
+        super().__init__()
+        self.max_steps = steps
+        self.base = base if base is not None else EpsilonGreedyRollout()
+
+    def choose(self, state, actions, profile):
+        return self.base.choose(state, actions, profile)
+
+
+rollout_policies = {
+    'random': RandomRollout,
+    'greedy': GreedyRollout,
+    'epsilon_greedy': EpsilonGreedyRollout,
+    'truncated': TruncatedRollout,
+}
+
+def make_rollout_policy(name, **kwargs):
+    if name not in rollout_policies:
+        raise ValueError(f"Unsupported rollout policy: {name}")
+    return rollout_policies[name](**kwargs)
+
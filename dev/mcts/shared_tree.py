@@ -0,0 +1,120 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+from mcts.mcts import Node
+
+## 树并行mcts的共享节点统计
+## 节点的visits和reward不放在Python对象属性里, 而是放在共享内存的NumPy数组中, 用node_id下标访问
+## 主进程负责选择和扩展(树结构只在主进程里修改), rollout进程直接按路径上的node_id更新数组, 不需要pickle整棵树
+## 选择时在路径上加virtual loss, 让并发的选择走向不同的分支, rollout完成后再撤销
+
+class SharedNodeStats:
+    # capacity: 最多的节点数. 每轮mcts最多扩展一个节点, iterations + 1就够用
+    # name: 为None时创建新的共享内存, 否则attach到已有的共享内存(rollout进程)
+    def __init__(self, capacity, name=None):
+        self.capacity = capacity
+        size = capacity * 2 * np.dtype(np.float64).itemsize
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        data = np.ndarray((2, capacity), dtype=np.float64, buffer=self.shm.buf)
+        if self.owner:
+            data[:] = 0
+        self.visits = data[0]
+        self.reward = data[1]
+        self.size = 0 # 已分配的node_id数
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def allocate(self):
+        if self.size >= self.capacity:
+            raise RuntimeError(f"Shared node stats capacity {self.capacity} exceeded")
+        node_id = self.size
+        self.size += 1
+        return node_id
+
+    # 选择时加virtual loss: visits + 1, reward + virtual_loss
+    def add_virtual_loss(self, path_ids, virtual_loss):
+        self.visits[path_ids] += 1
+        self.reward[path_ids] += virtual_loss
+
+    # rollout完成: 撤销virtual loss并加上真实reward, 加virtual loss时已经计入了visits
+    def backpropagate(self, path_ids, reward, virtual_loss):
+        self.reward[path_ids] += reward - virtual_loss
+
+    def close(self):
+        self.visits = None
+        self.reward = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedStatsNode(Node):
+    def __init__(self, state, stats, parent=None, depth=0):
+        self.stats = stats
+        self.node_id = stats.allocate()
+        super().__init__(state, parent, depth)
+
+    # 搜索过程中统计在共享内存中, detach之后和Node一样存放在父节点的数组中
+    @property
+    def visits(self):
+        if self.stats is None:
+            return Node.visits.fget(self)
+        return self.stats.visits[self.node_id]
+
+    @visits.setter
+    def visits(self, value):
+        if self.stats is None:
+            Node.visits.fset(self, value)
+        else:
+            self.stats.visits[self.node_id] = value
+
+    @property
+    def reward(self):
+        if self.stats is None:
+            return Node.reward.fget(self)
+        return self.stats.reward[self.node_id]
+
+    @reward.setter
+    def reward(self, value):
+        if self.stats is None:
+            Node.reward.fset(self, value)
+        else:
+            self.stats.reward[self.node_id] = value
+
+    def children_stats(self):
+        if self.stats is None:
+            return super().children_stats()
+        ids = [child.node_id for child in self.children]
+        n = len(ids)
+        return self.stats.visits[ids], self.stats.reward[ids], np.zeros(n), np.ones(n)
+
+    def new_child(self, state):
+        return SharedStatsNode(state, self.stats, self, self.depth + 1)
+
+    # 从根节点到当前节点的node_id
+    def path_ids(self):
+        ids = []
+        node = self
+        while node is not None:
+            ids.append(node.node_id)
+            node = node.parent
+        return ids
+
+    # 搜索结束, 把共享内存里的统计复制回Node的统计数组, 之后可以释放共享内存
+    def detach(self):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            visits = int(node.stats.visits[node.node_id])
+            reward = float(node.stats.reward[node.node_id])
+            node.stats = None
+            node.visits = visits
+            node.reward = reward
+            stack.extend(node.children)
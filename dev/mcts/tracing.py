@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+
+## 搜索循环的结构化跟踪
+## 原来MCTS的每一轮都要print(i), logging.info(f"get actions: {actions[:10]}"), 每条query的代价, 每个rollout的action...
+## 几千轮搜索下字符串格式化和I/O本身就是可观的开销
+## Tracer:
+##   级别: DEBUG(每个rollout action, 每条query的代价) / INFO(每轮的扩展和reward)
+##   采样: 每sample_every轮记录一轮, 在start_iteration中决定
+##   延迟格式化: 字段可以是无参函数, 只有记录时才调用; JSON序列化和写文件在后台线程中进行
+##   输出: JSON lines, 每行 {"ts", "iter", "level", "event", 字段...}
+## 调用方先检查 tracer.active / tracer.debug_active 再调用emit, 关闭跟踪时每个跟踪点只有一次属性读取
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+OFF = 100
+
+trace_levels = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'off': OFF}
+
+
+class Tracer:
+    def __init__(self):
+        self.level = OFF
+        self.sample_every = 1
+        self.path = None
+        self.iteration = None
+        self.active = False # 当前轮是否记录INFO及以上的事件
+        self.debug_active = False # 当前轮是否记录DEBUG事件
+        self.records = None
+        self.writer = None
+        self.pid = None
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return self.level < OFF
+
+    # path: JSON lines文件, level: 'debug'/'info'/'warning'/'off', sample_every: 每几轮记录一轮
+    # batch_size: 后台线程每次最多写入的记录数, flush_interval: 后台线程刷新文件的间隔(秒)
+    def configure(self, path, level='info', sample_every=1, batch_size=1024, flush_interval=1.0):
+        self.close()
+        if level not in trace_levels:
+            raise ValueError(f"Unsupported trace level: {level}")
+        self.level = trace_levels[level]
+        self.sample_every = max(1, sample_every)
+        self.path = path
+        if not self.enabled:
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.records = queue.SimpleQueue()
+        self.pid = os.getpid()
+        self.writer = threading.Thread(target=self.write_records, args=(path, batch_size, flush_interval), daemon=True)
+        self.writer.start()
+
+    # 每轮开始时调用, 决定这一轮是否记录
+    def start_iteration(self, iteration):
+        self.iteration = iteration
+        sampled = self.enabled and iteration % self.sample_every == 0
+        self.active = sampled and self.level <= INFO
+        self.debug_active = sampled and self.level <= DEBUG
+
+    # 结束一轮, 轮次之外的调用(例如单独计算reward)不记录
+    def end_iteration(self):
+        self.active = False
+        self.debug_active = False
+
+    # fields的值是无参函数时, 在这里调用得到真正的值
+    def emit(self, level, event, **fields):
+        if level < self.level or self.records is None or os.getpid() != self.pid:
+            # fork出的子进程没有写线程, 不记录
+            return
+        for key, value in fields.items():
+            if callable(value):
+                fields[key] = value()
+        self.records.put((time.time(), self.iteration, level, event, fields))
+
+    def write_records(self, path, batch_size, flush_interval):
+        level_names = {value: name for name, value in trace_levels.items()}
+        with open(path, 'a', encoding='utf-8') as f:
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    record = self.records.get(timeout=flush_interval)
+                except queue.Empty:
+                    f.flush()
+                    last_flush = time.monotonic()
+                    continue
+                batch = [record]
+                while len(batch) < batch_size:
+                    try:
+                        batch.append(self.records.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = False
+                lines = []
+                for record in batch:
+                    if record is None:
+                        stop = True
+                        continue
+                    ts, iteration, level, event, fields = record
+                    line = {'ts': ts, 'iter': iteration, 'level': level_names.get(level, level), 'event': event}
+                    line.update(fields)
+                    try:
+                        lines.append(json.dumps(line, ensure_ascii=False, default=str))
+                    except (TypeError, ValueError):
+                        self.dropped += 1
+                if lines:
+                    f.write('\n'.join(lines) + '\n')
+                if stop:
+                    break
+                if time.monotonic() - last_flush >= flush_interval:
+                    f.flush()
+                    last_flush = time.monotonic()
+
+    # 写完队列中的记录后停止后台线程
+    def close(self):
+        if self.writer is not None and os.getpid() == self.pid:
+            self.records.put(None)
+            self.writer.join()
+        self.writer = None
+        self.records = None
+        self.level = OFF
+        self.active = False
+        self.debug_active = False
+
+
+## 进程内共享的Tracer, 默认关闭. 用tracer.configure开启, 模块直接引用这个对象
+tracer = Tracer()
+atexit.register(tracer.close)
@@ -0,0 +1,27 @@
+## 置换表(transposition table)
+## 不同的action顺序可能到达同一个配置, 例如先给A表加分区键再移除B表的replica, 和反过来的顺序结果相同
+## Node.expand通过置换表查找相同配置的节点, 找到时直接连到已有节点上, 搜索树变成DAG, 同一个配置的统计不再分散
+## 反向传播沿选择路径进行(backpropagate_path): 边的统计存放在父节点的数组中, 配置的统计(state_visits/state_reward)在节点上, 所有父节点共享
+## best_child用配置的平均reward做exploitation, 用边的访问次数做exploration (UCT with transpositions)
+
+class TranspositionTable:
+    def __init__(self):
+        self.nodes = {} # state.key() -> Node
+        self.lookups = 0
+        self.hits = 0 # 消除的重复配置数
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def lookup(self, state):
+        self.lookups += 1
+        node = self.nodes.get(state.key())
+        if node is not None:
+            self.hits += 1
+        return node
+
+    def register(self, node):
+        self.nodes.setdefault(node.state.key(), node)
+
+    def stats(self):
+        return {'states': len(self.nodes), 'lookups': self.lookups, 'duplicates_eliminated': self.hits}
@@ -18,6 +18,7 @@ from estimator.ch_partition_meta import *
 from estimator.ch_query_card import *
 from estimator.ch_query_cost import *
 from estimator.ch_columns_ranges_meta import *
+from estimator.table_meta_store import get_table_meta_store, TableMetaView, build_table_meta, build_table_columns, writable_table_meta
 
 
 # update metadata given the partition and replica candidate
@@ -101,10 +102,10 @@ def update_meta(table_columns, table_meta, candidates):
 
             if i == 0: 
                 # 更新meta类的分区元信息
-                table_meta[idx].update_partition_metadata(partition_keys, table_ranges)
+                writable_table_meta(table_meta, idx).update_partition_metadata(partition_keys, table_ranges)
             elif i==1:
                 # 更新replica_meta类的分区元信息
-                table_meta[idx + 12].update_partition_metadata(partition_keys, table_ranges)
+                writable_table_meta(table_meta, idx + 12).update_partition_metadata(partition_keys, table_ranges)
 
 # 更新每个Qcard类的rowSize
 def update_rowsize(table_columns, candidates):
@@ -246,111 +247,18 @@ def update_rowsize(table_columns, candidates):
 
 def reset_table_meta(table_meta):
     #reset keys, partition_cnt, partition_range in table_meta
+    if isinstance(table_meta, TableMetaView):
+        table_meta.reset()
+        return
     table_meta.clear()
-    customer_meta = Customer_Meta()
-    district_meta = District_Meta()
-    history_meta = History_Meta()
-    item_meta = Item_Meta()
-    nation_meta = Nation_Meta()
-    new_order_meta = New_Order_Meta()
-    order_line_meta = Order_Line_Meta()
-    orders_meta = Orders_Meta()
-    region_meta = Region_Meta()
-    stock_meta = Stock_Meta()
-    supplier_meta = Supplier_Meta()
-    warehouse_meta = Warehouse_Meta()
-    table_meta.extend([customer_meta, district_meta, history_meta, item_meta, nation_meta, new_order_meta, order_line_meta, orders_meta, region_meta, stock_meta, supplier_meta, warehouse_meta])
-
-    customer_replica_meta = Customer_Meta()
-    district_replica_meta = District_Meta()
-    history_replica_meta = History_Meta()
-    item_replica_meta = Item_Meta()
-    nation_replica_meta = Nation_Meta()
-    new_order_replica_meta = New_Order_Meta()
-    order_line_replica_meta = Order_Line_Meta()
-    orders_replica_meta = Orders_Meta()
-    region_replica_meta = Region_Meta()
-    stock_replica_meta = Stock_Meta()
-    supplier_replica_meta = Supplier_Meta()
-    warehouse_replica_meta = Warehouse_Meta()
-
-    customer_replica_meta.isreplica = True
-    district_replica_meta.isreplica = True
-    history_replica_meta.isreplica = True
-    item_replica_meta.isreplica = True
-    nation_replica_meta.isreplica = True
-    new_order_replica_meta.isreplica = True
-    order_line_replica_meta.isreplica = True
-    orders_replica_meta.isreplica = True
-    region_replica_meta.isreplica = True
-    stock_replica_meta.isreplica = True
-    supplier_replica_meta.isreplica = True
-    warehouse_replica_meta.isreplica = True
-
-    table_meta.extend([customer_replica_meta, district_replica_meta, history_replica_meta, item_replica_meta, nation_replica_meta, new_order_replica_meta, order_line_replica_meta, orders_replica_meta, region_replica_meta, stock_replica_meta, supplier_replica_meta, warehouse_replica_meta])    
+    table_meta.extend(build_table_meta())
 
 def init_table_columns_meta():
     # 1. 初始化表参数
-    table_meta = []
-    customer_meta = Customer_Meta()
-    district_meta = District_Meta()
-    history_meta = History_Meta()
-    item_meta = Item_Meta()
-    nation_meta = Nation_Meta()
-    new_order_meta = New_Order_Meta()
-    order_line_meta = Order_Line_Meta()
-    orders_meta = Orders_Meta()
-    region_meta = Region_Meta()
-    stock_meta = Stock_Meta()
-    supplier_meta = Supplier_Meta()
-    warehouse_meta = Warehouse_Meta()
-    # append的顺序要求一致
-    table_meta.extend([customer_meta, district_meta, history_meta, item_meta, nation_meta, new_order_meta, order_line_meta, orders_meta, region_meta, stock_meta, supplier_meta, warehouse_meta]) 
-
-    # 初始化列存表的参数
-    customer_replica_meta = Customer_Meta()
-    district_replica_meta = District_Meta()
-    history_replica_meta = History_Meta()
-    item_replica_meta = Item_Meta()
-    nation_replica_meta = Nation_Meta()
-    new_order_replica_meta = New_Order_Meta()
-    order_line_replica_meta = Order_Line_Meta()
-    orders_replica_meta = Orders_Meta()
-    region_replica_meta = Region_Meta()
-    stock_replica_meta = Stock_Meta()
-    supplier_replica_meta = Supplier_Meta()
-    warehouse_replica_meta = Warehouse_Meta()
-
-    customer_replica_meta.isreplica = True
-    district_replica_meta.isreplica = True
-    history_replica_meta.isreplica = True
-    item_replica_meta.isreplica = True
-    nation_replica_meta.isreplica = True
-    new_order_replica_meta.isreplica = True
-    order_line_replica_meta.isreplica = True
-    orders_replica_meta.isreplica = True
-    region_replica_meta.isreplica = True
-    stock_replica_meta.isreplica = True
-    supplier_replica_meta.isreplica = True
-    warehouse_replica_meta.isreplica = True
-
-    table_meta.extend([customer_replica_meta, district_replica_meta, history_replica_meta, item_replica_meta, nation_replica_meta, new_order_replica_meta, order_line_replica_meta, orders_replica_meta, region_replica_meta, stock_replica_meta, supplier_replica_meta, warehouse_replica_meta])
+    table_meta = get_table_meta_store().new_view()
 
     # 2. 初始化表的列参数
-    table_columns = []
-    customer_columns = Customer_columns()
-    district_columns = District_columns()
-    history_columns = History_columns()    
-    item_columns = Item_columns()
-    nation_columns = Nation_columns()
-    new_order_columns = New_order_columns()
-    order_line_columns = Order_line_columns()    
-    orders_columns = Orders_columns()
-    region_columns = Region_columns()
-    stock_columns = Stock_columns()
-    supplier_columns = Supplier_columns()
-    warehouse_columns = Warehouse_columns()
-    table_columns.extend([customer_columns, district_columns, history_columns, item_columns, nation_columns, new_order_columns, order_line_columns, orders_columns, region_columns, stock_columns, supplier_columns, warehouse_columns])    
+    table_columns = build_table_columns()
 
     return table_meta, table_columns
 
@@ -0,0 +1,52 @@
+import copy
+import random
+
+from advisor import State, IncrementalRewardEvaluator, build_table_columns, calculate_reward, calibrate_reward_normalization
+from estimator.ch_query_cost import get_query_cost_model, set_query_cost_model
+from estimator.table_meta_store import get_table_meta_store
+
+## 检查增量计算的reward和完整计算一致
+## 从默认配置出发随机走若干步, 每一步只修改一个表, 增量计算器只重新计算依赖这个表的query
+## python test_incremental_reward.py 或 pytest test_incremental_reward.py
+
+
+def default_tables(table_columns):
+    return [{'name': table_column.name, 'columns': table_column.columns,
+             'partitionable_columns': table_column.partitionable_columns,
+             'partition_keys': table_column.partition_keys, 'replicas': table_column.columns,
+             'replica_partition_keys': table_column.replica_partition_keys} for table_column in table_columns]
+
+def check_incremental_reward(model, walks=5, steps=8, seed=0):
+    table_columns = build_table_columns()
+    tables = default_tables(table_columns)
+    previous_model = get_query_cost_model()
+    set_query_cost_model(model)
+    try:
+        calibrate_reward_normalization(table_columns, tables)
+        evaluator = IncrementalRewardEvaluator(table_columns)
+        random.seed(seed)
+        for _ in range(walks):
+            state = State(copy.deepcopy(tables))
+            for _ in range(steps):
+                actions = state.get_possible_actions()
+                if not actions:
+                    break
+                state = state.take_action(random.choice(actions))
+                expected = calculate_reward(table_columns, get_table_meta_store().new_view(), state.tables)
+                reward = evaluator.calculate_reward(state.tables)
+                assert abs(reward - expected) <= 1e-9 * max(1.0, abs(expected)), f"{model}: incremental {reward}, full {expected}"
+    finally:
+        set_query_cost_model(previous_model)
+        calibrate_reward_normalization(table_columns, tables)
+
+def test_incremental_reward_operators():
+    check_incremental_reward('operators')
+
+def test_incremental_reward_plan():
+    check_incremental_reward('plan')
+
+
+if __name__ == "__main__":
+    for model in ('operators', 'plan'):
+        check_incremental_reward(model)
+        print(f"{model}: incremental reward ok")
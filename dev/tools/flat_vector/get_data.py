@@ -1,34 +1,12 @@
-import mysql.connector
-from mysql.connector import MySQLConnection
 from typing import Dict, List, Any
 import re
 import sys
 import os
 sys.path.append(os.path.expanduser("/data3/dzh/project/grep/dev"))
-from config import Config
+from estimator.plan_cache import get_plan_cache, set_plan_cache_path
 import csv
 import time
 
-def get_connection(autocommit: bool = True) -> MySQLConnection:
-    config = Config()  # 假设您有一个Config类提供配置
-    db_conf = {
-        "host": config.TIDB_HOST,
-        "port": config.TIDB_PORT,
-        "user": config.TIDB_USER,
-        "password": config.TIDB_PASSWORD,
-        "database": "ch",
-        "autocommit": autocommit,
-        "use_pure": True
-    }
-
-    if config.ca_path:
-        db_conf.update({
-            "ssl_verify_cert": True,
-            "ssl_verify_identity": True,
-            "ssl_ca": config.ca_path
-        })
-    return mysql.connector.connect(**db_conf)
-
 def extract_plan_features(plan: List[Dict[str, Any]]) -> Dict[str, float]:
     """解析EXPLAIN VERBOSE输出并提取特征"""
     features = {
@@ -107,36 +85,25 @@ def extract_plan_features(plan: List[Dict[str, Any]]) -> Dict[str, float]:
     return features
 
 def get_query_plan_features(sql: str) -> Dict[str, float]:
-    """执行EXPLAIN VERBOSE并提取特征"""
-    with get_connection(autocommit=False) as connection:
-        with connection.cursor(dictionary=True) as cur:
-            cur.execute(f"EXPLAIN FORMAT = 'verbose' {sql}")
-            plan = cur.fetchall()
-    return extract_plan_features(plan)
+    """从计划缓存读取EXPLAIN VERBOSE的结果并提取特征"""
+    plan = get_plan_cache().get_dicts(sql, 'explain_verbose')
+    return extract_plan_features(plan or [])
 
 def batch_collect_features(sql_queries: List[str]) -> List[Dict[str, float]]:
     """批量收集多个SQL查询的特征"""
     features_list = []
     for sql in sql_queries:
-        try:
-            with get_connection(autocommit=False) as connection:
-                with connection.cursor(dictionary=True) as cur:
-                    cur.execute(f"EXPLAIN FORMAT = 'verbose' {sql}")
-                    plan = cur.fetchall()
-                    features = extract_plan_features(plan)
-                    features_list.append(features)
-        except Exception as e:
-            print(f"Error processing SQL: {sql}\nError: {str(e)}")
+        plan = get_plan_cache().get_dicts(sql, 'explain_verbose')
+        if plan is None:
+            print(f"No cached plan for SQL: {sql}")
             features_list.append({})  # 添加空字典作为占位符
+            continue
+        features_list.append(extract_plan_features(plan))
     return features_list
 
 def get_query_execution_time(sql: str) -> float:
-    """执行EXPLAIN ANALYZE并提取总执行时间（单位：ms，取第一个算子的time，来自execution info字段）"""
-    with get_connection(autocommit=False) as connection:
-        with connection.cursor(dictionary=True) as cur:
-            cur.execute(f"EXPLAIN ANALYZE {sql}")
-            analyze_result = cur.fetchall()
-    import re
+    """从计划缓存读取EXPLAIN ANALYZE的结果并提取总执行时间（单位：ms，取第一个算子的time，来自execution info字段）"""
+    analyze_result = get_plan_cache().get_dicts(sql, 'explain_analyze')
     if not analyze_result:
         return 0.0
     exec_info = analyze_result[0].get('execution info', '')
@@ -170,6 +137,8 @@ if __name__ == "__main__":
     # start_time = time.time()
     sql_file = "../../workload/workloadd.sql"
     csv_file = "sql_features_with_time111.csv"
+    # 计划由 python -m estimator.plan_cache capture workload/workloadd.sql 批量抓取
+    set_plan_cache_path("../../Output/plan_cache_ch.bin")
     with open(sql_file, "r", encoding="utf-8") as f:
         sql_content = f.read()
     sql_list = [s.strip() for s in sql_content.split(';') if s.strip()]
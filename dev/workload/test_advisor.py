@@ -861,6 +861,7 @@ def generate_tp(max_txn_cnt):
 ## max_txn_cnt : max cnt of txn and qry; ratio[0,1]: tp ratio
 def generate_workload(max_txn_cnt, ratio):
   txn_cnt = 0
+  workload_start = time.time()
   ## GET SYNC TIME AND SYNC_COUNT
   start_sync_time, start_count = sync_metrics_collector.direct_get_tiflash_syncing_data_freshness_count()
 
@@ -938,6 +939,10 @@ def generate_workload(max_txn_cnt, ratio):
   for i in range(22):
     print(wl_stats.query_lat[i])  
 
+  # 保存计数, advisor按每条query和每种事务的到达率加权reward
+  from workload.workload_analyzer import save_workload_statistics
+  save_workload_statistics(wl_stats, 'Output/workload_statistics_ch.json', time.time() - workload_start)
+
 
 # 测试事务执行期间的 query 延迟, 这里的tp的并发度是n
 def test_query_latency_with_tp(max_txn_cnt, max_qry_cnt, n, m):
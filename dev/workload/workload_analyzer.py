@@ -1,5 +1,9 @@
 import sys
 import os
+import re
+import json
+import hashlib
+import logging
 
 sys.path.append(os.path.expanduser("/data3/dzh/project/grep/dev"))
 
@@ -14,10 +18,12 @@ from estimator.ch_columns_ranges_meta import Customer_columns, District_columns,
 # 对于列的关联程度, 识别一个sql同时访问的column, 包括join投影操作, 将join操作涉及的列, 投影操作的列之间连边, 次数越多代表关联程度越高. 对于关连高的列, 在action中, 将这两个列设置replicas的action绑定到一起.
 
 # 分析ap负载, 获取每个列的查询频率
-def analyze_column_usage(qcard_list):
+# query_weights: 每条query的权重(到达率), 为None时每条query计1次
+def analyze_column_usage(qcard_list, query_weights=None):
     column_usage = {}
 
-    for qcard in qcard_list:
+    for qry_idx, qcard in enumerate(qcard_list):
+        weight = 1 if query_weights is None else query_weights[qry_idx]
         for table_idx, columns in enumerate(qcard.columns):
             # print(table_idx)
             table_name = qcard.tables[table_idx]
@@ -26,15 +32,185 @@ def analyze_column_usage(qcard_list):
             for column in columns:
                 if column not in column_usage[table_name]:
                     column_usage[table_name][column] = 0
-                column_usage[table_name][column] += 1
+                column_usage[table_name][column] += weight
 
     return column_usage
 
 # 分析tp负载, 获取每个列的更新频率
 tp_column_usage = {'district': {'d_next_o_id': 1, 'd_ytd': 1}, 'stock': {'s_quantity': 1, 's_ytd': 1, 's_order_cnt': 1, 's_remote_cnt': 1}, 'customer': {'c_balance': 2, 'c_ytd_payment': 1, 'c_payment_cnt': 1}, 'warehouse': {'w_ytd': 1}, 'orders': {'o_carrier_id': 1}, 'order_line': {'ol_delivery_d': 1}}
 
+# 每种事务更新的列, 每种事务各执行一次时合起来就是tp_column_usage
+txn_types = ['neworder', 'payment', 'orderstatus', 'delivery', 'stocklevel']
+txn_column_updates = {
+    'neworder': {'district': {'d_next_o_id': 1}, 'stock': {'s_quantity': 1, 's_ytd': 1, 's_order_cnt': 1, 's_remote_cnt': 1}},
+    'payment': {'district': {'d_ytd': 1}, 'customer': {'c_balance': 1, 'c_ytd_payment': 1, 'c_payment_cnt': 1}, 'warehouse': {'w_ytd': 1}},
+    'delivery': {'orders': {'o_carrier_id': 1}, 'order_line': {'ol_delivery_d': 1}, 'customer': {'c_balance': 1}},
+}
+
+# 语句日志中识别事务类型的语句, 表名可能带后缀(例如 district_part2)
+txn_statement_patterns = {
+    'neworder': re.compile(r'update\s+district\w*\s+set\s+d_next_o_id', re.IGNORECASE),
+    'payment': re.compile(r'update\s+warehouse\w*\s+set\s+w_ytd', re.IGNORECASE),
+    'orderstatus': re.compile(r'select\s+ol_i_id,\s*ol_supply_w_id,\s*ol_quantity,\s*ol_amount,\s*ol_delivery_d\s+from\s+order_line', re.IGNORECASE),
+    'delivery': re.compile(r'update\s+orders\w*\s+set\s+o_carrier_id', re.IGNORECASE),
+    'stocklevel': re.compile(r'select\s+count\(\*\)\s+from\s+stock\w*\s+where\s+s_w_id', re.IGNORECASE),
+}
+
+# sql的指纹: 去掉常量和多余的空白, 同一条query的不同参数得到相同的指纹
+def sql_fingerprint(sql):
+    sql = re.sub(r"'[^']*'", '?', sql)
+    sql = re.sub(r'\b\d+(\.\d+)?\b', '?', sql)
+    sql = sql.replace('{}', '?')
+    return re.sub(r'\s+', ' ', sql).strip().rstrip(';').strip().lower()
+
+
+## workload的到达率
+## calculate_reward原来对22条query等权求和, 移除replica的reward使用固定的tp_column_usage
+## WorkloadRates保存每条query的到达率和每种事务的执行率(来自驱动程序的Workload_Statistics计数或语句日志)
+## query的权重是到达率归一化到平均为1, 代价按权重加权求和; tp_column_usage按事务执行率加权
+## 所有到达率相同时权重都是1, 和原来的等权结果一致
+class WorkloadRates:
+    # query_rates: 22条query的到达率, txn_rates: 事务类型 -> 执行率, txn_latency: 事务类型 -> 平均延迟
+    # latency_weighted: 事务的权重再乘以平均延迟, 按事务占用的时间而不是次数计算更新的影响
+    def __init__(self, query_rates=None, txn_rates=None, txn_latency=None, latency_weighted=False):
+        self.query_rates = [1.0] * len(qcard_classes) if query_rates is None else [float(rate) for rate in query_rates]
+        self.txn_rates = {txn: 1.0 for txn in txn_types} if txn_rates is None else {txn: float(txn_rates.get(txn, 0.0)) for txn in txn_types}
+        self.txn_latency = dict(txn_latency or {})
+        self.latency_weighted = latency_weighted
+        self._query_weights = None
+        self._tp_column_usage = None
+
+    # 每条query的权重, 平均为1. 没有任何query时退化成等权
+    def query_weights(self):
+        if self._query_weights is None:
+            n = len(self.query_rates)
+            total = sum(self.query_rates)
+            if total <= 0:
+                self._query_weights = [1.0] * n
+            else:
+                self._query_weights = [n * rate / total for rate in self.query_rates]
+        return self._query_weights
+
+    # 更新数据的事务的权重, 平均为1
+    def txn_weights(self):
+        weights = {}
+        for txn in txn_column_updates:
+            weight = self.txn_rates[txn]
+            if self.latency_weighted:
+                weight *= self.txn_latency.get(txn, 1.0)
+            weights[txn] = weight
+        total = sum(weights.values())
+        if total <= 0:
+            return {txn: 1.0 for txn in txn_column_updates}
+        return {txn: len(weights) * weight / total for txn, weight in weights.items()}
+
+    # query和事务权重的指纹, 作为reward缓存tag的一部分. 到达率或更新率变化后, 按旧权重计算的reward不再使用
+    def fingerprint(self):
+        weights = {
+            'query': [round(weight, 9) for weight in self.query_weights()],
+            'txn': {txn: round(weight, 9) for txn, weight in self.txn_weights().items()},
+        }
+        return hashlib.sha1(json.dumps(weights, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+    # 按事务权重合并每种事务更新的列, 格式和tp_column_usage一致
+    def tp_column_usage(self):
+        if self._tp_column_usage is None:
+            usage = {}
+            for txn, weight in self.txn_weights().items():
+                for table, columns in txn_column_updates[txn].items():
+                    table_usage = usage.setdefault(table, {})
+                    for column, updates in columns.items():
+                        table_usage[column] = table_usage.get(column, 0) + weight * updates
+            self._tp_column_usage = usage
+        return self._tp_column_usage
+
+    # wl_stats: 驱动程序(workload/test_*.py)的Workload_Statistics, elapsed: 统计的时长(秒), 为None时直接使用计数
+    @classmethod
+    def from_statistics(cls, wl_stats, elapsed=None, latency_weighted=False):
+        stats = wl_stats if isinstance(wl_stats, dict) else vars(wl_stats)
+        scale = 3600.0 / elapsed if elapsed else 1.0 # 每小时的次数
+        query_rates = [cnt * scale for cnt in stats['query_cnt']]
+        txn_rates = {}
+        txn_latency = {}
+        for txn in txn_types:
+            cnt = stats.get(f'{txn}_cnt', 0)
+            txn_rates[txn] = cnt * scale
+            if cnt:
+                txn_latency[txn] = stats.get(f'{txn}_lat_sum', 0.0) / cnt
+        return cls(query_rates, txn_rates, txn_latency, latency_weighted)
+
+    # 语句日志: 每行一条语句, 可以带时间戳和延迟前缀 "<unix时间戳>\t<延迟(秒)>\t<sql>"
+    # sql_file: workload的22条query, 按指纹匹配日志中的query
+    @classmethod
+    def from_statement_log(cls, log_path, sql_file, latency_weighted=False):
+        with open(sql_file, 'r', encoding='utf-8') as f:
+            sqls = [sql.strip() for sql in f.read().split(';') if sql.strip()]
+        query_index = {sql_fingerprint(sql): idx for idx, sql in enumerate(sqls)}
+
+        stats = {'query_cnt': [0] * len(sqls)}
+        for txn in txn_types:
+            stats[f'{txn}_cnt'] = 0
+            stats[f'{txn}_lat_sum'] = 0.0
+        first_ts = None
+        last_ts = None
+        with open(log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                sql = parts[-1].strip()
+                if not sql:
+                    continue
+                latency = 0.0
+                if len(parts) >= 3:
+                    ts = float(parts[0])
+                    latency = float(parts[1])
+                    first_ts = ts if first_ts is None else min(first_ts, ts)
+                    last_ts = ts if last_ts is None else max(last_ts, ts)
+                qry_idx = query_index.get(sql_fingerprint(sql))
+                if qry_idx is not None:
+                    stats['query_cnt'][qry_idx] += 1
+                    continue
+                for txn, pattern in txn_statement_patterns.items():
+                    if pattern.search(sql):
+                        stats[f'{txn}_cnt'] += 1
+                        stats[f'{txn}_lat_sum'] += latency
+                        break
+        elapsed = last_ts - first_ts if first_ts is not None and last_ts > first_ts else None
+        return cls.from_statistics(stats, elapsed, latency_weighted)
+
+
+# 驱动程序结束时保存Workload_Statistics的计数, 之后advisor用load_workload_rates加载
+def save_workload_statistics(wl_stats, path, elapsed=None):
+    stats = dict(vars(wl_stats))
+    stats['elapsed'] = elapsed
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(stats, f, indent=2)
+
+## 当前使用的到达率, 为None时等权
+workload_rates = None
+
+def set_workload_rates(rates):
+    global workload_rates
+    workload_rates = rates
+
+def get_workload_rates():
+    global workload_rates
+    if workload_rates is None:
+        workload_rates = WorkloadRates()
+    return workload_rates
+
+# 加载save_workload_statistics保存的计数, 文件不存在时返回None, 使用等权的workload
+def load_workload_rates(path, latency_weighted=False):
+    if not os.path.exists(path):
+        logging.info(f"Workload statistics {path} not found, use uniform query weights")
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        stats = json.load(f)
+    rates = WorkloadRates.from_statistics(stats, stats.get('elapsed'), latency_weighted)
+    set_workload_rates(rates)
+    return rates
+
 # 将每个列的查询频率和更新频率结合在一起
-def generate_column_usage(qcard_list, tp_column_usage):
+def generate_column_usage(qcard_list, tp_column_usage, query_weights=None):
     # 初始化 columns_usage
     tables = [Customer_columns(), District_columns(), Item_columns(), New_order_columns(), Orders_columns(), Order_line_columns(), Stock_columns(), Warehouse_columns(), History_columns(), Nation_columns(), Supplier_columns(), Region_columns()]
     columns_usage = {}
@@ -42,7 +218,7 @@ def generate_column_usage(qcard_list, tp_column_usage):
         columns_usage[table.name] = {column: 0 for column in table.columns}
 
     # 获取 ap_column_usage
-    ap_column_usage = analyze_column_usage(qcard_list)
+    ap_column_usage = analyze_column_usage(qcard_list, query_weights)
 
     # 将 ap_column_usage 的数值加到 columns_usage 中
     for table, columns in ap_column_usage.items():
@@ -88,11 +264,86 @@ def normalize_column_usage(column_usage):
 
     return normalized_usage, zero_values, zero_values_num, ap_values_num
 
-def get_normalized_column_usage(qcard_list, tp_column_usage):
-    final_usage = generate_column_usage(qcard_list, tp_column_usage)
+def get_normalized_column_usage(qcard_list, tp_column_usage, query_weights=None):
+    final_usage = generate_column_usage(qcard_list, tp_column_usage, query_weights)
     normalized_usage, zero_values, zero_values_num, ap_values_num = normalize_column_usage(final_usage)
     return normalized_usage, zero_values, zero_values_num, ap_values_num
 
+## 一次搜索中workload不变, 列的使用情况只需要计算一次
+## WorkloadProfile缓存get_normalized_column_usage的结果, 注入到State/Node中, workload变化时调用invalidate重新计算
+class WorkloadProfile:
+    def __init__(self, qcard_list=None, tp_column_usage=tp_column_usage, query_weights=None):
+        self.qcard_list = qcard_list # None: 使用CH的22条query
+        self.tp_column_usage = tp_column_usage
+        self.query_weights = query_weights # None: 每条query等权
+        self.action_pruning = None # 按代价相关性裁剪action(mcts/action_pruning.py), None表示不裁剪
+        self.computed = False
+        self._normalized_usage = None
+        self._zero_values = None
+        self._zero_values_num = None
+        self._ap_values_num = None
+
+    # workload变化时调用, 下一次访问时重新计算
+    def invalidate(self, qcard_list=None, tp_column_usage=None, query_weights=None):
+        if qcard_list is not None:
+            self.qcard_list = qcard_list
+        if tp_column_usage is not None:
+            self.tp_column_usage = tp_column_usage
+        if query_weights is not None:
+            self.query_weights = query_weights
+        self.computed = False
+
+    def compute(self):
+        qcard_list = self.qcard_list
+        if qcard_list is None:
+            qcard_list = [qcard_class() for qcard_class in qcard_classes]
+            for qcard in qcard_list:
+                qcard.init()
+        self._normalized_usage, self._zero_values, self._zero_values_num, self._ap_values_num = get_normalized_column_usage(qcard_list, self.tp_column_usage, self.query_weights)
+        self.computed = True
+
+    @property
+    def normalized_usage(self):
+        if not self.computed:
+            self.compute()
+        return self._normalized_usage
+
+    @property
+    def zero_values(self):
+        if not self.computed:
+            self.compute()
+        return self._zero_values
+
+    @property
+    def zero_values_num(self):
+        if not self.computed:
+            self.compute()
+        return self._zero_values_num
+
+    @property
+    def ap_values_num(self):
+        if not self.computed:
+            self.compute()
+        return self._ap_values_num
+
+    # 按到达率构造profile
+    @classmethod
+    def from_rates(cls, rates, qcard_list=None):
+        return cls(qcard_list, rates.tp_column_usage(), rates.query_weights())
+
+    # 搜索中State会被deepcopy, profile在整个搜索中共享, 不复制
+    def __deepcopy__(self, memo):
+        return self
+
+# 默认的CH workload profile, 没有注入profile的State共享这一个
+default_profile = None
+
+def get_default_workload_profile():
+    global default_profile
+    if default_profile is None:
+        default_profile = WorkloadProfile()
+    return default_profile
+
 if __name__ == "__main__":
     qcard_list = [Q1card(), Q2card(), Q3card(), Q4card(), Q5card(), Q6card(), Q7card(), Q8card(), Q9card(), Q10card(), Q11card(), Q12card(), Q13card(), Q14card(), Q15card(), Q16card(), Q17card(), Q18card(), Q19card(), Q20card(), Q21card(), Q22card()]
     for qcard in qcard_list: